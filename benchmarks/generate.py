@@ -0,0 +1,63 @@
+"""Compares building commands through the forms, through `ffmpeg.core` and from cached `ffmpeg.templates`
+
+    python benchmarks/generate.py [number]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+if not settings.configured:
+    settings.configure(USE_I18N=False)
+    django.setup()
+
+from ffmpeg import core, templates  # noqa: E402
+from ffmpeg.codecs import Codec  # noqa: E402
+from ffmpeg.filters import ScaleFilter  # noqa: E402
+from ffmpeg.generator import Command  # noqa: E402
+from ffmpeg.utils import StreamSpecifier  # noqa: E402
+
+
+def with_forms(i: int):
+    cmd = Command(input="input-%d.mp4" % i, output="output-%d.mp4" % i, overwrite=True, duration="00:10:00",
+                  ss_position="00:00:05")
+    cmd.add_codec(Codec(codec="aac", stream=StreamSpecifier.Audio))
+    cmd.add_codec(Codec(copy=True, stream=StreamSpecifier.Video))
+    cmd.add_filter(ScaleFilter(width=1280, height=720))
+    return cmd.generate(as_str=False)
+
+
+def with_core(i: int):
+    cmd = core.Command("input-%d.mp4" % i, "output-%d.mp4" % i, overwrite=True, duration="00:10:00",
+                       ss_position="00:00:05", codecs=[core.Codec("aac", "a"), core.Codec(copy=True, stream="v")],
+                       filters=[core.ScaleFilter(width=1280, height=720)])
+    return cmd.generate(as_str=False)
+
+
+# A job shape, built once like a module level preset
+CODECS = (core.Codec("aac", "a"), core.Codec(copy=True, stream="v"))
+FILTERS = (core.ScaleFilter(width=1280, height=720),)
+
+
+def with_template(i: int):
+    return templates.render("input-%d.mp4" % i, "output-%d.mp4" % i, overwrite=True, duration="00:10:00",
+                            ss_position="00:00:05", codecs=CODECS, filters=FILTERS)
+
+
+def main(number: int = 10000):
+    assert with_forms(0) == with_core(0) == with_template(0)
+    results = {}
+    for name, build in (("forms", with_forms), ("core", with_core), ("template", with_template)):
+        seconds = min(timeit.repeat(lambda: [build(i) for i in range(number)], number=1, repeat=3))
+        results[name] = seconds
+        print("%-8s %8.1f us/command  %8.0f commands/s" % (name, seconds / number * 1e6, number / seconds))
+    print("speedup core %.1fx, template %.1fx" % (results["forms"] / results["core"],
+                                                  results["forms"] / results["template"]))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
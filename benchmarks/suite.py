@@ -0,0 +1,272 @@
+"""Benchmarks of the hot paths, run offline against the fake ffmpeg and ffprobe in benchmarks/fake
+
+    python benchmarks/suite.py                      # every benchmark
+    python benchmarks/suite.py generate probe       # those whose name contains any of the words
+    python benchmarks/suite.py --save results.json  # keep the numbers, e.g. per release
+    python benchmarks/suite.py --compare results.json --threshold 0.2
+
+The fake programs print output recorded from ffmpeg 7.0.2 (benchmarks/data) and exit at once, so the numbers
+measure this package and not ffmpeg. Every benchmark reports the best of `--repeat` rounds as time per operation.
+`--compare` lists each benchmark against the saved numbers and exits with status 1 when one got slower by more
+than `--threshold`.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import timeit
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HERE = os.path.join(ROOT, "benchmarks")
+FAKE_FFMPEG = os.path.join(HERE, "fake", "ffmpeg")
+FAKE_FFPROBE = os.path.join(HERE, "fake", "ffprobe")
+DATA = os.path.join(HERE, "data")
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import django  # noqa: E402
+from django.conf import settings as django_settings  # noqa: E402
+
+if not django_settings.configured:
+    django_settings.configure(USE_I18N=False)
+    django.setup()
+
+from ffmpeg import settings  # noqa: E402
+
+settings.configure(FFMPEG_PATH=FAKE_FFMPEG, FFPROBE_PATH=FAKE_FFPROBE, FFMPEG_CACHE_DIR=None)
+
+from ffmpeg import core, ffmpeg, ffprobe, runner, scheduler, templates  # noqa: E402
+from ffmpeg.codecs import Codec  # noqa: E402
+from ffmpeg.filters import BitstreamChannelFilter, FFmpegFilter, ScaleFilter  # noqa: E402
+from ffmpeg.generator import Command  # noqa: E402
+from ffmpeg.utils import StreamSpecifier  # noqa: E402
+
+# Streams in the ffprobe output of the probe benchmarks
+PROBE_STREAMS = 256
+
+# Jobs of a scheduler benchmark round
+JOBS = 200
+
+BENCHMARKS = []
+
+
+def benchmark(number: int, operations: int = 1):
+    """Registers a benchmark: a generator that yields the operation to time and tears down after it
+
+    :param number: Calls of the operation in a round
+    :param operations: Operations done by a call, the result is per operation
+    """
+    def register(setup):
+        BENCHMARKS.append((setup.__name__, contextlib.contextmanager(setup), number, operations))
+        return setup
+    return register
+
+
+def _read(name: str) -> str:
+    with open(os.path.join(DATA, name)) as f:
+        return f.read()
+
+
+@benchmark(2000)
+def generate_simple():
+    yield lambda: Command(input="input.mp4", output="output.mp4").generate(as_str=False)
+
+
+def _heavy_forms():
+    cmd = Command(input="input.mp4", output="output.mp4", overwrite=True, loglevel="error", stream_loop=1,
+                  duration="00:10:00", ss_position="00:00:05", add_ss_position_before_input=True,
+                  to_position="00:20:00", file_size_limit=10 ** 9, aspect="1.7777")
+    cmd.add_codec(Codec(codec="libx264", stream=StreamSpecifier.Video, preset="veryfast", threads=2))
+    cmd.add_codec(Codec(codec="aac", stream=StreamSpecifier.Audio))
+    cmd.add_filter(ScaleFilter(width=1280, height=720))
+    cmd.add_filter(BitstreamChannelFilter(stream=StreamSpecifier.Video, filters=[FFmpegFilter.h264_mp4toannexb]))
+    return cmd.generate(as_str=False)
+
+
+@benchmark(500)
+def generate_heavy():
+    yield _heavy_forms
+
+
+HEAVY_CORE = dict(overwrite=True, loglevel="error", stream_loop=1, duration="00:10:00", ss_position="00:00:05",
+                  add_ss_position_before_input=True, to_position="00:20:00", file_size_limit=10 ** 9,
+                  aspect="1.7777")
+
+
+def _heavy_codecs():
+    return [core.Codec("libx264", "v", preset="veryfast", threads=2), core.Codec("aac", "a")]
+
+
+def _heavy_filters():
+    return [core.ScaleFilter(width=1280, height=720), core.BitstreamChannelFilter("v", ["h264_mp4toannexb"])]
+
+
+@benchmark(5000)
+def generate_heavy_core():
+    yield lambda: core.Command("input.mp4", "output.mp4", codecs=_heavy_codecs(), filters=_heavy_filters(),
+                               **HEAVY_CORE).generate(as_str=False)
+
+
+@benchmark(20000)
+def generate_heavy_template():
+    codecs, filters = tuple(_heavy_codecs()), tuple(_heavy_filters())
+    assert templates.render("input.mp4", "output.mp4", codecs=codecs, filters=filters, **HEAVY_CORE) == _heavy_forms()
+    yield lambda: templates.render("input.mp4", "output.mp4", codecs=codecs, filters=filters, **HEAVY_CORE)
+
+
+@benchmark(200)
+def parse_codecs():
+    output = _read("codecs.txt")
+    yield lambda: ffmpeg._parse_codecs(output)
+
+
+@benchmark(200)
+def parse_formats():
+    output = _read("formats.txt")
+    yield lambda: ffmpeg._parse_formats(output)
+
+
+@benchmark(200)
+def capability_table():
+    codecs, formats = ffmpeg._parse_codecs(_read("codecs.txt")), ffmpeg._parse_formats(_read("formats.txt"))
+    yield lambda: ffmpeg.CapabilityTable(codecs, formats, [])
+
+
+@benchmark(20)
+def capability_discovery():
+    # Four runs of the fake ffmpeg and their parsing, what a process pays for its first Codec without a disk cache
+    yield lambda: ffmpeg.CapabilityRegistry(cache_dir=None).load()
+
+
+@contextlib.contextmanager
+def _probe_file():
+    """A media file and the fake ffprobe set up to report `PROBE_STREAMS` streams for it"""
+    attributes = json.loads(_read("probe.json"))
+    streams = attributes['streams']
+    attributes['streams'] = [dict(streams[i % len(streams)], index=i) for i in range(PROBE_STREAMS)]
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "probe.json")
+        with open(output, "w") as f:
+            json.dump(attributes, f, indent=4)
+        path = os.path.join(directory, "input.mp4")
+        open(path, "wb").close()
+        with mock.patch.dict(os.environ, FAKE_FFPROBE_OUTPUT=output):
+            yield path, attributes
+
+
+@benchmark(200)
+def probe_cached():
+    # A cache hit still decodes the stored JSON, its cost grows with the stream list
+    cache = ffprobe.MemoryProbeCache()
+    with _probe_file() as (path, _):
+        ffprobe.get_file_attributes(path, cache=cache)
+        yield lambda: ffprobe.get_file_attributes(path, cache=cache)
+
+
+@benchmark(200)
+def probe_info():
+    with _probe_file() as (path, attributes):
+        yield lambda: ffprobe.ProbeInfo(path, attributes)
+
+
+@benchmark(20)
+def probe_process():
+    with _probe_file() as (path, _):
+        yield lambda: ffprobe.get_file_attributes(path, cache=False)
+
+
+def _run_jobs(sched: scheduler.Scheduler):
+    jobs = [sched.submit([FAKE_FFMPEG, "-i", "input.mp4", "output.mp4"]) for _ in range(JOBS)]
+    for job in jobs:
+        job.wait()
+
+
+@benchmark(1, JOBS)
+def scheduler_overhead():
+    # Jobs that finish at once, what remains is queueing, dispatch and handing the result back
+    result = runner.Result([FAKE_FFMPEG], 0, b"", "", 0.0)
+    with mock.patch.object(runner, "run", return_value=result), \
+            scheduler.Scheduler(concurrency=4, max_pending=JOBS) as sched:
+        yield lambda: _run_jobs(sched)
+
+
+@benchmark(1, JOBS)
+def scheduler_fake_ffmpeg():
+    # As scheduler_overhead, with a process started for every job
+    with scheduler.Scheduler(concurrency=4, max_pending=JOBS) as sched:
+        yield lambda: _run_jobs(sched)
+
+
+@benchmark(50)
+def runner_fake_ffmpeg():
+    yield lambda: runner.run([FAKE_FFMPEG, "-i", "input.mp4", "output.mp4"])
+
+
+def run_benchmarks(names: list = None, repeat: int = 5) -> dict:
+    """Seconds per operation of the benchmarks whose name contains any of `names`, all by default"""
+    results = {}
+    for name, setup, number, operations in BENCHMARKS:
+        if names and not any(part in name for part in names):
+            continue
+        with setup() as operation:
+            seconds = min(timeit.repeat(operation, number=number, repeat=repeat))
+        results[name] = seconds / number / operations
+        print("%-26s %12.2f us/op  %12.0f op/s" % (name, results[name] * 1e6, 1 / results[name]), flush=True)
+    return results
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Names of the benchmarks more than `threshold` (0.1 is 10%) slower than in `baseline`"""
+    slower = []
+    for name, seconds in sorted(results.items()):
+        before = baseline.get(name)
+        if not before:
+            continue
+        change = seconds / before - 1
+        flag = ""
+        if change > threshold:
+            slower.append(name)
+            flag = "  SLOWER"
+        print("%-26s %+7.1f%%%s" % (name, change * 100, flag))
+    return slower
+
+
+def main(argv: list = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("names", nargs="*", help="Run only the benchmarks whose name contains one of these")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--save", help="Write the results, with the commit and Python version, to this file")
+    parser.add_argument("--compare", help="Compare with results written by --save")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    options = parser.parse_args(argv)
+
+    results = run_benchmarks(options.names, options.repeat)
+    if options.save:
+        with open(options.save, "w") as f:
+            json.dump({'commit': _commit(), 'python': platform.python_version(), 'machine': platform.machine(),
+                       'results': results}, f, indent=2, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        print("\ncompared with %s" % (baseline.get('commit') or options.compare))
+        if compare(results, baseline['results'], options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,28 +1,43 @@
 from django import forms
 
-from .utils import BaseFilter
-from .ffmpeg import get_codecs
+from . import core
+from .forms import BaseFilter
+from .ffmpeg import get_codecs, get_capabilities
+
+
+def _codec_choices():
+    # Evaluated by the field on first use, importing this module does not start ffmpeg
+    return [(c['name'], c['name']) for c in get_codecs()]
+
+
+class CodecChoiceField(forms.ChoiceField):
+    """Accepts codec, encoder and decoder names of the ffmpeg build, checked against the capability index"""
+
+    def valid_value(self, value):
+        table = get_capabilities()
+        return table.has_codec(value) or table.can_encode(value) or table.can_decode(value)
 
 
 class Codec(BaseFilter):
     def __init__(self, **kwargs):
         super(Codec, self).__init__(data=kwargs)
 
-    codec = forms.ChoiceField(choices=[(c['name'], c['name']) for c in get_codecs()], required=False)
+    codec = CodecChoiceField(choices=_codec_choices, required=False)
     copy = forms.BooleanField(initial=False, required=False)
     before_input = forms.BooleanField(initial=False, required=False)
+    # -preset, e.g. veryfast for libx264, see `encoders.plan_encoder`
+    preset = forms.CharField(required=False)
+    # -threads, 0 lets the encoder pick
+    threads = forms.IntegerField(min_value=0, required=False)
 
     def clean(self):
-        if not self.cleaned_data['copy'] and not self.cleaned_data['codec']:
+        if not self.cleaned_data.get('copy') and not self.cleaned_data.get('codec'):
             raise forms.ValidationError("Codec is not defined.")
         return super(Codec, self).clean()
 
-    def generate(self, as_str: bool = True):
+    def core(self) -> core.Codec:
         self.validate()
-        stream = self.cleaned_data['stream']
-        args = ["-c:" + str(stream) if stream else "-c"]
-        if self.cleaned_data['copy']:
-            args.append("copy")
-        else:
-            args.append(self.cleaned_data['codec'])
-        return " ".join(args) if as_str else args
+        return core.Codec(**self.cleaned_data)
+
+    def generate(self, as_str: bool = True):
+        return self.core().generate(as_str)
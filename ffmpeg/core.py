@@ -0,0 +1,387 @@
+"""Command building without form validation
+
+The classes take the options of the forms in `generator`, `codecs` and `filters`, check them once when they are
+created and render argument vectors directly. Use them to build many commands at once, the forms stay as the
+adapter for Django admin and other form based UIs and generate through these classes.
+
+    cmd = Command("input.mp4", "output.mp4", duration="00:10:00", codecs=[Codec(copy=True, stream="v")])
+    cmd.generate(as_str=False)
+    ['/usr/bin/ffmpeg', '-i', 'input.mp4', '-t', '00:10:00', '-c:v', 'copy', 'output.mp4']
+"""
+import datetime
+import re
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+from logging import getLogger
+
+from . import settings
+from .ffmpeg import get_capabilities
+from .filtergraph import FilterChain, FilterGraph, FilterNode
+from .utils import format_seconds, time_to_seconds
+
+# `runner` is imported when a command runs, it brings in asyncio, which takes longer to import than everything else
+
+logger = getLogger("ffmpeg.core")
+
+# Values of utils.StreamSpecifier, utils.LogLevel and filters.FOAR
+STREAMS = ("v", "a", "s")
+LOG_LEVELS = ("quite", "panic", "fatal", "error", "warning", "info", "verbose", "debug", "trace")
+FOAR_VALUES = ("disable", "decrease", "increase")
+
+# Inputs and outputs ffmpeg reads from stdin or writes to stdout
+PIPE_INPUTS = ("pipe:0", "pipe:", "-")
+PIPE_OUTPUTS = ("pipe:1", "pipe:", "-")
+
+# The input formats of the forms' TimeFields, "%H:%M:%S.%f" and "%H:%M:%S"
+_TIME = re.compile(r"^(\d{1,2}):(\d{1,2}):(\d{1,2})(?:\.(\d{1,6}))?$")
+
+
+class _Quoted(str):
+    """Argument (a file path or a filtergraph) quoted only when the command is rendered as a string"""
+
+
+def _time(name: str, value):
+    if value is None or value == "" or isinstance(value, datetime.time):
+        return value or None
+    match = _TIME.match(str(value).strip())
+    try:
+        if not match:
+            raise ValueError
+        hours, minutes, seconds, fraction = match.groups()
+        return datetime.time(int(hours), int(minutes), int(seconds), int((fraction or "0").ljust(6, "0")))
+    except ValueError:
+        raise ValueError("%s is not a valid time: %r" % (name, value))
+
+
+def _choice(name: str, value, choices: tuple):
+    if value is None or value == "":
+        return None
+    value = str(value)
+    if value not in choices:
+        raise ValueError("%s must be one of %s, got %r" % (name, ", ".join(choices), value))
+    return value
+
+
+def _integer(name: str, value, min_value: int = None, max_value: int = None):
+    if value is None or value == "":
+        return None
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise ValueError("%s is not an integer: %r" % (name, value))
+    if (min_value is not None and value < min_value) or (max_value is not None and value > max_value):
+        raise ValueError("%s is out of range: %d" % (name, value))
+    return value
+
+
+class Codec:
+    """-c[:stream] codec or -c[:stream] copy, with the encoder's -preset and -threads when given"""
+
+    __slots__ = ("codec", "stream", "copy", "before_input", "preset", "threads")
+
+    def __init__(self, codec: str = None, stream: str = None, copy: bool = False, before_input: bool = False,
+                 preset: str = None, threads: int = None):
+        self.stream = _choice("stream", stream, STREAMS)
+        self.copy = bool(copy)
+        self.before_input = bool(before_input)
+        self.codec = codec or None
+        self.preset = preset or None
+        # 0 lets the encoder pick, which is usually one thread per core
+        self.threads = _integer("threads", threads, min_value=0)
+        if not self.copy:
+            if not self.codec:
+                raise ValueError("Codec is not defined.")
+            table = get_capabilities()
+            if not (table.has_codec(codec) or table.can_encode(codec) or table.can_decode(codec)):
+                raise ValueError("Unknown codec: %s" % codec)
+
+    def generate(self, as_str: bool = True):
+        suffix = ":" + self.stream if self.stream else ""
+        args = ["-c" + suffix, "copy" if self.copy else self.codec]
+        if not self.copy:
+            if self.preset:
+                args.extend(["-preset" + suffix, self.preset])
+            if self.threads is not None:
+                args.extend(["-threads" + suffix, str(self.threads)])
+        return " ".join(args) if as_str else args
+
+
+class BitstreamChannelFilter:
+    """-bsf:stream filter1,filter2"""
+
+    __slots__ = ("stream", "filters")
+
+    def __init__(self, stream: str, filters: list):
+        self.stream = _choice("stream", stream, STREAMS)
+        self.filters = ",".join(str(f) for f in filters) if not isinstance(filters, str) else filters
+        if not self.stream or not self.filters or len(self.filters) > 255:
+            raise ValueError("Bitstream filter needs a stream and up to 255 characters of filters.")
+
+    def generate(self, as_str: bool = True):
+        args = ["-bsf:" + self.stream, self.filters]
+        return " ".join(args) if as_str else args
+
+
+class ScaleFilter:
+    """scale=width:height, see `filters.ScaleFilter` for the options"""
+
+    __slots__ = ("width", "height", "uiw", "uih", "scale_width", "scale_height", "kar", "foar")
+
+    stream = "v"
+
+    def __init__(self, width: int = None, height: int = None, uiw: bool = False, uih: bool = False,
+                 scale_width: int = None, scale_height: int = None, kar: bool = False, foar: str = "disable"):
+        self.width = _integer("width", width)
+        self.height = _integer("height", height)
+        self.uiw = bool(uiw)
+        self.uih = bool(uih)
+        self.scale_width = _integer("scale_width", scale_width, 1, 10)
+        self.scale_height = _integer("scale_height", scale_height, 1, 10)
+        self.kar = bool(kar)
+        self.foar = _choice("foar", foar, FOAR_VALUES) or "disable"
+        if self.kar and self.foar != "disable":
+            raise ValueError("KAR and FOAR can not be set define at the same time")
+        if not self.uiw and not self.width:
+            raise ValueError("Please define width or uiw")
+        if not self.uih and not self.height:
+            raise ValueError("Please define height or uiw.")
+
+    def expression(self) -> str:
+        """The filter itself, e.g. scale=1920:1080, for use in a filtergraph"""
+        width = "iw" if self.uiw else str(self.width)
+        height = "ih" if self.uih else str(self.height)
+        if self.scale_width:
+            width = width + "*" + str(self.scale_width)
+        if self.scale_height:
+            height = height + "*" + str(self.scale_height)
+        if self.kar:
+            height = "-1"
+        scale = "scale=" + width + ":" + height
+        if self.foar != "disable":
+            scale = scale + ":force_original_aspect_ratio=" + self.foar
+        return scale
+
+    def generate(self, as_str: bool = True):
+        args = ["-filter:v", self.expression()]
+        return " ".join(args) if as_str else args
+
+
+class Command:
+    """An ffmpeg command, the options are those of `generator.Command`
+
+    :param output: Output file path, None only when the caller adds the outputs (see `generator.MultiOutputCommand`)
+    :param codecs: `Codec`s
+    :param filters: `ScaleFilter`s, `BitstreamChannelFilter`s and `filtergraph.FilterNode`s of the video chain
+    :param filter_complex: A `filtergraph.FilterGraph`
+    :param keyframe_index: A `keyframes.KeyframeIndex` for accurate and fast `ss_position` seeks
+    :param filter_threads: Threads of the filtergraphs, ffmpeg uses one per core by default
+    :param input_args: Options without a field of their own, put right before `-i`, e.g. ["-skip_frame", "nokey"]
+    :param output_args: Options without a field of their own, put right before the output
+
+    `input` may be "pipe:0" and `output` "pipe:1" (with a `format`), `run(stdin=..., stdout=...)` streams them.
+    """
+
+    __slots__ = ("input", "output", "loglevel", "overwrite", "stream_loop", "duration", "add_duration_before_input",
+                 "to_position", "ss_position", "add_ss_position_before_input", "sseof_position", "file_size_limit",
+                 "itsoffset", "timestamp", "timestamp_now", "vn", "aspect", "codecs", "filters", "filter_complex",
+                 "keyframe_index", "input_format", "format", "filter_threads", "input_args", "output_args", "path",
+                 "args")
+
+    def __init__(self, input: str, output: str = None, loglevel: str = None, overwrite: bool = None,
+                 stream_loop: int = None, duration=None, add_duration_before_input: bool = False, to_position=None,
+                 ss_position=None, add_ss_position_before_input: bool = False, sseof_position=None,
+                 file_size_limit: int = None, itsoffset=None, timestamp: datetime.datetime = None,
+                 timestamp_now: bool = False, vn: bool = False, aspect=None, codecs=(), filters=(),
+                 filter_complex: FilterGraph = None, keyframe_index=None, input_format: str = None,
+                 format: str = None, filter_threads: int = None, input_args=(), output_args=(),
+                 path: str = settings.DEFAULT):
+        if not input:
+            raise ValueError("Input file path is required.")
+        self.input = input
+        self.output = output
+        self.loglevel = _choice("loglevel", loglevel, LOG_LEVELS)
+        self.overwrite = overwrite
+        self.stream_loop = _integer("stream_loop", stream_loop, min_value=-1)
+        self.duration = _time("duration", duration)
+        self.add_duration_before_input = bool(add_duration_before_input)
+        self.to_position = _time("to_position", to_position)
+        self.ss_position = _time("ss_position", ss_position)
+        self.add_ss_position_before_input = bool(add_ss_position_before_input)
+        self.sseof_position = _time("sseof_position", sseof_position)
+        self.file_size_limit = _integer("file_size_limit", file_size_limit, min_value=0)
+        self.itsoffset = _time("itsoffset", itsoffset)
+        if isinstance(timestamp, str):
+            timestamp = datetime.datetime.fromisoformat(timestamp) if timestamp else None
+        self.timestamp = timestamp
+        self.timestamp_now = bool(timestamp_now)
+        self.vn = bool(vn)
+        if aspect is not None and aspect != "":
+            try:
+                aspect = Decimal(str(aspect))
+            except InvalidOperation:
+                raise ValueError("aspect is not a number: %r" % aspect)
+        self.aspect = aspect or None
+        self.codecs = list(codecs)
+        self.filters = list(filters)
+        self.filter_complex = filter_complex
+        self.keyframe_index = keyframe_index
+        self.input_format = input_format or None
+        self.format = format or None
+        self.filter_threads = _integer("filter_threads", filter_threads, min_value=1)
+        self.input_args = [str(arg) for arg in input_args]
+        self.output_args = [str(arg) for arg in output_args]
+        if self.output in PIPE_OUTPUTS and not self.format:
+            raise ValueError("Writing to a pipe needs an output format.")
+        self.path = settings.resolve(path, "FFMPEG_PATH")
+        self.args = []
+
+    def _seek_keyframe(self):
+        """Keyframe the input seek lands on when a keyframe index is used, otherwise None"""
+        if self.keyframe_index is None or not self.ss_position:
+            return None
+        return self.keyframe_index.before(time_to_seconds(self.ss_position))
+
+    def _add_keyframe_seek(self, keyframe: float, before_input: bool):
+        # Fast input seek to the keyframe, then decode and drop only the frames up to the requested position
+        offset = time_to_seconds(self.ss_position) - keyframe
+        if before_input:
+            if keyframe:
+                self.args.extend(["-ss", format_seconds(keyframe)])
+        elif offset > 0:
+            self.args.extend(["-ss", format_seconds(offset)])
+
+    def _add_codecs(self, before: bool = False):
+        for codec in self.codecs:
+            if before == codec.before_input:
+                self.args.extend(codec.generate(as_str=False))
+
+    def _add_input(self):
+        args = self.args
+        if self.loglevel:
+            args.extend(["-loglevel", self.loglevel])
+        if self.filter_threads:
+            args.extend(["-filter_threads", str(self.filter_threads)])
+            if self.filter_complex:
+                args.extend(["-filter_complex_threads", str(self.filter_threads)])
+        if self.duration and self.add_duration_before_input:
+            args.extend(["-t", str(self.duration)])
+        if self.itsoffset:
+            args.extend(["-itsoffset", str(self.itsoffset)])
+        if self.stream_loop:
+            args.extend(["-stream_loop", str(self.stream_loop)])
+        keyframe = self._seek_keyframe()
+        if keyframe is not None:
+            self._add_keyframe_seek(keyframe, before_input=True)
+        elif self.ss_position and self.add_ss_position_before_input:
+            args.extend(["-ss", str(self.ss_position)])
+        self._add_codecs(before=True)
+        if self.input_format:
+            args.extend(["-f", self.input_format])
+        args.extend(self.input_args)
+        args.extend(["-i", _Quoted(self.input)])
+
+    def _add_output_options(self):
+        args = self.args
+        if self.overwrite is not None:
+            args.append("-y" if self.overwrite else "-n")
+        if self.duration and not self.add_duration_before_input:
+            args.extend(["-t", str(self.duration)])
+        if self.file_size_limit:
+            args.extend(["-fs", str(self.file_size_limit)])
+        keyframe = self._seek_keyframe()
+        if self.to_position:
+            # Output timestamps start at the keyframe after an input seek
+            args.extend(["-to", format_seconds(max(0.0, time_to_seconds(self.to_position) - keyframe))
+                         if keyframe else str(self.to_position)])
+        if keyframe is not None:
+            self._add_keyframe_seek(keyframe, before_input=False)
+        elif self.ss_position and not self.add_ss_position_before_input:
+            args.extend(["-ss", str(self.ss_position)])
+        if self.sseof_position:
+            args.extend(["-sseof", str(self.sseof_position)])
+        if self.timestamp_now:
+            args.extend(["-timestamp", "now"])
+        elif self.timestamp:
+            args.extend(["-timestamp", str(self.timestamp)])
+        if self.vn:
+            args.append("-vn")
+        if self.aspect:
+            args.extend(["-aspect", str(self.aspect)])
+        if self.format:
+            args.extend(["-f", self.format])
+
+    def _add_filters(self):
+        if self.filter_complex:
+            self.args.extend(["-filter_complex", _Quoted(str(self.filter_complex))])
+        # Filters of a stream are joined into one chain, ffmpeg keeps only the last of repeated -filter options
+        chains = OrderedDict()
+        for flt in self.filters:
+            if isinstance(flt, FilterNode):
+                chains.setdefault("v", FilterChain()).append(flt)
+            elif isinstance(flt, ScaleFilter):
+                chains.setdefault(flt.stream, FilterChain()).append(FilterNode.parse(flt.expression()))
+            else:
+                self.args.extend(flt.generate(as_str=False))
+        FilterGraph(*chains.values()).optimize()
+        for stream, chain in chains.items():
+            if chain.nodes:
+                self.args.extend(["-filter:" + stream, str(chain)])
+
+    @staticmethod
+    def _quote(arg: str):
+        if isinstance(arg, _Quoted):
+            return '"' + arg.replace('"', '\\"').replace("'", "\\'") + '"'
+        return arg
+
+    def _render(self, as_str: bool):
+        return " ".join(self._quote(arg) for arg in self.args) if as_str else [str(arg) for arg in self.args]
+
+    def generate(self, as_str: bool = True) -> str or []:
+        """
+        Generates FFmpeg command
+        :param as_str: Return command as string else it will came as List
+        :return: String or List, the list is an argument vector that can be executed without a shell
+        """
+        if not self.output:
+            raise ValueError("Output file path is required.")
+        self.args = [self.path]
+        self._add_input()
+        self._add_output_options()
+        self._add_codecs()
+        self._add_filters()
+        self.args.extend(self.output_args)
+        self.args.append(_Quoted(self.output))
+        return self._render(as_str)
+
+    def expected_duration(self) -> float:
+        """Seconds of media the command will write, based on the duration ffprobe reports for the input"""
+        from .ffprobe import get_file_attributes
+
+        total = float(get_file_attributes(self.input)['format']['duration'])
+        if self.to_position:
+            total = min(total, time_to_seconds(self.to_position))
+        if self.ss_position:
+            total -= time_to_seconds(self.ss_position)
+        if self.duration:
+            total = min(total, time_to_seconds(self.duration))
+        return max(0.0, total)
+
+    def _run_options(self, kwargs: dict) -> dict:
+        if self.input in PIPE_INPUTS and kwargs.get('stdin') is None:
+            raise ValueError("%s reads from stdin, pass the data as stdin." % self.input)
+        if kwargs.get('on_progress') and 'duration' not in kwargs and self.input not in PIPE_INPUTS:
+            try:
+                kwargs['duration'] = self.expected_duration()
+            except Exception:
+                logger.warning("Duration of %s is unknown, progress comes without ETA", self.input, exc_info=True)
+        return kwargs
+
+    def run(self, **kwargs) -> "runner.Result":
+        """Runs the command and waits for it, see `runner.run` for the options"""
+        from . import runner
+        return runner.run(self.generate(as_str=False), **self._run_options(kwargs))
+
+    async def run_async(self, **kwargs) -> "runner.Result":
+        """Runs the command from an event loop, see `runner.run_async` for the options"""
+        from . import runner
+        return await runner.run_async(self.generate(as_str=False), **self._run_options(kwargs))
@@ -0,0 +1,144 @@
+"""Encoder choice and thread tuning from the capabilities of the ffmpeg build and the host
+
+    plan = plan_encoder("h264", jobs=16)  # libx264 when present, else libopenh264, ...
+    command = plan.apply(Command(input="input.mp4", output="output.mp4"))
+
+ffmpeg starts as many threads as there are cores for every encoder and filtergraph, so 16 jobs on 16 cores run
+hundreds of threads that evict each other's caches. A plan splits the cores between the jobs instead.
+
+Hardware encoders are listed by builds that support them even when the host has no such device, they are only
+chosen with `hardware=True`.
+"""
+import copy
+import os
+
+from . import core
+from .ffmpeg import get_capabilities
+
+# Software encoders of a codec, preferred first: the fastest for comparable quality at their `PRESETS`
+SOFTWARE_ENCODERS = {
+    'h264': ("libx264", "libopenh264"),
+    'hevc': ("libx265", "libkvazaar"),
+    'av1': ("libsvtav1", "librav1e", "libaom-av1"),
+    'vp9': ("libvpx-vp9",),
+    'vp8': ("libvpx",),
+    'mpeg4': ("mpeg4", "libxvid"),
+    'aac': ("aac", "libfdk_aac"),
+    'opus': ("libopus", "opus"),
+    'mp3': ("libmp3lame", "libshine"),
+}
+
+# Hardware encoders of a codec, preferred first
+HARDWARE_ENCODERS = {
+    'h264': ("h264_nvenc", "h264_qsv", "h264_videotoolbox", "h264_amf", "h264_vaapi", "h264_v4l2m2m"),
+    'hevc': ("hevc_nvenc", "hevc_qsv", "hevc_videotoolbox", "hevc_amf", "hevc_vaapi", "hevc_v4l2m2m"),
+    'av1': ("av1_nvenc", "av1_qsv", "av1_amf", "av1_vaapi"),
+    'vp9': ("vp9_qsv", "vp9_vaapi"),
+}
+
+HARDWARE_SUFFIXES = ("_nvenc", "_qsv", "_videotoolbox", "_amf", "_vaapi", "_v4l2m2m", "_mf", "_omx", "_vulkan")
+
+# -preset of the encoders that have one, a fast setting that keeps most of the quality
+PRESETS = {
+    'libx264': "veryfast",
+    'libx265': "fast",
+    'libkvazaar': "fast",
+    'libsvtav1': "8",
+    'h264_nvenc': "p4",
+    'hevc_nvenc': "p4",
+    'av1_nvenc': "p4",
+    'h264_qsv': "faster",
+    'hevc_qsv': "faster",
+    'av1_qsv': "faster",
+}
+
+
+def is_hardware(encoder: str) -> bool:
+    return encoder.endswith(HARDWARE_SUFFIXES)
+
+
+def select_encoder(codec: str, hardware: bool = False, table=None) -> str:
+    """The preferred encoder of `codec` the ffmpeg build has
+
+    :param codec: A codec (h264) or an encoder name (libx264), which stands for its codec
+    :param hardware: Consider hardware encoders, they are preferred when present
+    :param table: A `ffmpeg.CapabilityTable`, that of the configured ffmpeg by default
+    """
+    table = table or get_capabilities()
+    codec = table.encoders.get(codec, codec)
+    candidates = list(SOFTWARE_ENCODERS.get(codec, ()))
+    if hardware:
+        candidates = list(HARDWARE_ENCODERS.get(codec, ())) + candidates
+    if codec in table.codecs:
+        candidates.extend(table.codecs[codec]['encoders'] or [codec])
+    for encoder in candidates:
+        if table.encoders.get(encoder) == codec and (hardware or not is_hardware(encoder)):
+            return encoder
+    raise ValueError("ffmpeg has no encoder for %s" % codec)
+
+
+def plan_threads(jobs: int = 1, cores: int = None) -> int:
+    """Threads for each of `jobs` concurrent processes so that together they use `cores` once"""
+    cores = cores or os.cpu_count() or 1
+    return max(1, cores // max(1, jobs))
+
+
+class EncoderPlan:
+    """An encoder and its tuning, see `plan_encoder`"""
+
+    __slots__ = ("encoder", "stream", "preset", "threads", "filter_threads")
+
+    def __init__(self, encoder: str, stream: str = None, preset: str = None, threads: int = None,
+                 filter_threads: int = None):
+        self.encoder = encoder
+        self.stream = stream
+        self.preset = preset
+        self.threads = threads  # None for hardware encoders, which barely use the CPU
+        self.filter_threads = filter_threads
+
+    @property
+    def hardware(self) -> bool:
+        return is_hardware(self.encoder)
+
+    def codec(self) -> core.Codec:
+        return core.Codec(self.encoder, self.stream, preset=self.preset, threads=self.threads)
+
+    def apply(self, command):
+        """A copy of a `generator.Command` or `core.Command` with the encoder added and its filter threads set"""
+        if isinstance(command, core.Command):
+            command = copy.copy(command)
+            command.codecs = command.codecs + [self.codec()]
+            command.filter_threads = self.filter_threads
+            return command
+        from .codecs import Codec
+
+        command = command.clone(filter_threads=self.filter_threads)
+        return command.add_codec(Codec(codec=self.encoder, stream=self.stream, preset=self.preset,
+                                       threads=self.threads))
+
+    def __repr__(self):
+        return "<EncoderPlan %s preset=%s threads=%s filter_threads=%s>" % (
+            self.encoder, self.preset, self.threads, self.filter_threads)
+
+
+def plan_encoder(codec: str, stream: str = "v", jobs: int = 1, cores: int = None, hardware: bool = False,
+                 preset: str = None, table=None) -> EncoderPlan:
+    """Encoder of `codec` and its threads when `jobs` ffmpeg processes share the host's cores
+
+    :param codec: A codec (h264) or an encoder name (libx264)
+    :param stream: Stream specifier of the codec, "v" or "a"
+    :param jobs: ffmpeg processes running at the same time, e.g. `Scheduler.concurrency`
+    :param cores: Cores of the host, `os.cpu_count()` by default
+    :param hardware: Consider hardware encoders, see `select_encoder`
+    :param preset: Overrides `PRESETS`, used only with an encoder that has presets
+    :param table: A `ffmpeg.CapabilityTable`, that of the configured ffmpeg by default
+    """
+    encoder = select_encoder(codec, hardware, table)
+    threads = plan_threads(jobs, cores)
+    if encoder in PRESETS:
+        preset = preset or PRESETS[encoder]
+    else:
+        preset = None
+    if is_hardware(encoder):
+        return EncoderPlan(encoder, stream, preset, None, threads)
+    return EncoderPlan(encoder, stream, preset, threads, threads)
@@ -1,22 +1,302 @@
+import hashlib
+import json
 import os
 import re
 import subprocess
+import tempfile
+import threading
 from logging import getLogger
 
-from django.conf import settings
+from . import settings
 
 logger = getLogger("ffmpeg.utils")
 
-FFMPEG_PATH = getattr(settings, "FFMPEG_PATH", "/usr/bin/ffmpeg")
 
-if not os.path.exists(FFMPEG_PATH):
-    raise ValueError("FFmpeg not found in system, path: %s" % FFMPEG_PATH)
+def __getattr__(name):
+    # FFMPEG_PATH, FFMPEG_CACHE_DIR and FFMPEG_CAPABILITIES_TIMEOUT are resolved on first use, see `settings`
+    if name in ("FFMPEG_PATH", "FFMPEG_CACHE_DIR", "FFMPEG_CAPABILITIES_TIMEOUT"):
+        return settings.get(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _parse_formats(output: str) -> list:
+    formats = []
+    listing = False
+    for line in output.splitlines():
+        # Flags are in fixed columns (" DE name" or " DEd name" on newer builds), entries follow the "--" line
+        if not listing:
+            listing = line.strip().startswith("--")
+            continue
+        parts = line[4:].split(None, 1)
+        if not parts:
+            continue
+        for format in parts[0].split(','):
+            formats.append({
+                'format': format,
+                'Demuxing Supported': line[1:2] == 'D',
+                'Muxing Supported': line[2:3] == 'E',
+                'display': parts[1] if len(parts) > 1 else ""
+            })
+    return formats
+
+
+CODEC_TYPES = {'V': 'video', 'A': 'audio', 'S': 'subtitle', 'D': 'data', 'T': 'attachment'}
+
+
+def _parse_codecs(output: str) -> list:
+    pattern = r"\s(D|\.)(E|\.)(V|A|S|D|T|\.)(I|\.)(L|\.)(S|\.)\s([a-zA-Z0-9_,]+)\s+(.+)\n"
+    codecs = []
+    for f in re.findall(pattern, output):
+        # Implementations are listed inline, e.g. "H.264 (decoders: h264 h264_cuvid) (encoders: libx264)"
+        decoders = re.search(r"\(decoders: ([^)]*)\)", f[7])
+        encoders = re.search(r"\(encoders: ([^)]*)\)", f[7])
+        display = re.sub(r"\s*\((?:de|en)coders: [^)]*\)", "", f[7])
+        for codec in f[6].split(','):
+            codecs.append({
+                'name': codec,
+                'type': CODEC_TYPES.get(f[2]),
+                'Decoding supported': f[0] == 'D',
+                'Encoding supported': f[1] == 'E',
+                'Video codec': f[2] == 'V',
+                'Audio codec': f[2] == 'A',
+                'Subtitle codec': f[2] == 'S',
+                'Intra frame-only codec': f[3] == 'I',
+                'Lossy compression': f[4] == 'L',
+                'Lossless compression': f[5] == 'S',
+                'decoders': decoders.group(1).split() if decoders else ([codec] if f[0] == 'D' else []),
+                'encoders': encoders.group(1).split() if encoders else ([codec] if f[1] == 'E' else []),
+                'display': display
+            })
+    return codecs
+
+
+def _parse_bitstream_filters(output: str) -> list:
+    return re.findall(r"^([a-zA-Z0-9_]+)$", output, re.MULTILINE)
+
+
+def _parse_version(output: str) -> str:
+    found = re.search(r"version\s+(\S+)", output)
+    return found.group(1) if found else ""
+
+
+class CapabilityTable:
+    """Indexed capabilities of an ffmpeg build.
+
+    Built in a single pass over the parsed `-codecs`, `-formats` and `-bsfs` output. Every lookup is a dict or
+    set membership check:
+
+        table.can_encode("libx264")
+        table.video["h264"]['Lossless compression']
+    """
+
+    def __init__(self, codecs: list, formats: list, bitstream_filters: list):
+        self.codecs = {}
+        self.by_type = {name: {} for name in CODEC_TYPES.values()}
+        self.encoders = {}  # Encoder or codec name -> codec name
+        self.decoders = {}  # Decoder or codec name -> codec name
+        self.lossless = set()
+        self.lossy = set()
+        self.intra_only = set()
+        for codec in codecs:
+            name = codec['name']
+            self.codecs[name] = codec
+            if codec['type']:
+                self.by_type[codec['type']][name] = codec
+            if codec['Encoding supported']:
+                self.encoders[name] = name
+                self.encoders.update((encoder, name) for encoder in codec['encoders'])
+            if codec['Decoding supported']:
+                self.decoders[name] = name
+                self.decoders.update((decoder, name) for decoder in codec['decoders'])
+            if codec['Lossless compression']:
+                self.lossless.add(name)
+            if codec['Lossy compression']:
+                self.lossy.add(name)
+            if codec['Intra frame-only codec']:
+                self.intra_only.add(name)
+
+        self.formats = {}
+        self.muxers = set()
+        self.demuxers = set()
+        for format in formats:
+            self.formats.setdefault(format['format'], []).append(format)
+            if format['Muxing Supported']:
+                self.muxers.add(format['format'])
+            if format['Demuxing Supported']:
+                self.demuxers.add(format['format'])
+
+        self.bitstream_filters = dict.fromkeys(bitstream_filters)
+
+    @property
+    def video(self) -> dict:
+        return self.by_type['video']
+
+    @property
+    def audio(self) -> dict:
+        return self.by_type['audio']
+
+    @property
+    def subtitle(self) -> dict:
+        return self.by_type['subtitle']
+
+    def has_codec(self, name: str) -> bool:
+        return name in self.codecs
+
+    def can_encode(self, name: str) -> bool:
+        """True if `name` is a codec or an encoder this build can encode with"""
+        return name in self.encoders
+
+    def can_decode(self, name: str) -> bool:
+        """True if `name` is a codec or a decoder this build can decode with"""
+        return name in self.decoders
+
+    def is_lossless(self, name: str) -> bool:
+        return self.encoders.get(name, self.decoders.get(name, name)) in self.lossless
+
+    def can_mux(self, format: str) -> bool:
+        return format in self.muxers
+
+    def can_demux(self, format: str) -> bool:
+        return format in self.demuxers
+
+    def has_bitstream_filter(self, name: str) -> bool:
+        return name in self.bitstream_filters
+
+
+class CapabilityRegistry:
+    """Discovers what an ffmpeg binary supports, on first use only.
+
+    Results are kept in memory and in a JSON file under `cache_dir`. The file name is derived from the binary's
+    real path, mtime and size, so replacing or upgrading ffmpeg invalidates it; the version reported by the binary
+    is stored in the entry, which is discarded without one. A warm process therefore neither starts ffmpeg nor
+    parses its output again.
+    """
+
+    # Bump when the layout of the cached data changes.
+    cache_format = 2
+
+    def __init__(self, path: str = settings.DEFAULT, cache_dir: str = settings.DEFAULT,
+                 timeout: float = settings.DEFAULT):
+        self._path = path
+        self._cache_dir = cache_dir
+        self._timeout = timeout
+        self._data = None
+        self._table = None
+        self._lock = threading.Lock()
+
+    @property
+    def path(self) -> str:
+        return settings.resolve(self._path, "FFMPEG_PATH")
+
+    @property
+    def cache_dir(self) -> str:
+        return settings.resolve(self._cache_dir, "FFMPEG_CACHE_DIR")
+
+    @property
+    def timeout(self) -> float:
+        return settings.resolve(self._timeout, "FFMPEG_CAPABILITIES_TIMEOUT")
+
+    @property
+    def version(self) -> str:
+        return self.load()['version']
+
+    @property
+    def codecs(self) -> list:
+        return self.load()['codecs']
+
+    @property
+    def formats(self) -> list:
+        return self.load()['formats']
+
+    @property
+    def bitstream_filters(self) -> list:
+        return self.load()['bitstream_filters']
+
+    @property
+    def table(self) -> CapabilityTable:
+        if self._table is None:
+            data = self.load()
+            self._table = CapabilityTable(data['codecs'], data['formats'], data['bitstream_filters'])
+        return self._table
+
+    def load(self) -> dict:
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    key = self._key()
+                    self._data = self._read_cache(key) or self._discover(key)
+        return self._data
+
+    def clear(self):
+        """Forget the in-memory results, the next access reloads them."""
+        with self._lock:
+            self._data = None
+            self._table = None
+
+    def _key(self) -> str:
+        stat = os.stat(self.path)
+        return "%s:%d:%d:%d" % (os.path.realpath(self.path), stat.st_mtime_ns, stat.st_size, self.cache_format)
+
+    def _cache_file(self, key: str) -> str:
+        return os.path.join(self.cache_dir, "capabilities-" + hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def _read_cache(self, key: str):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._cache_file(key), "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('key') != key or not data.get('version'):
+            return None
+        return data
+
+    def _write_cache(self, key: str, data: dict):
+        if not self.cache_dir:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self._cache_file(key))
+        except OSError:
+            logger.warning("Could not write capability cache to %s", self.cache_dir, exc_info=True)
+
+    def _run(self, *args) -> str:
+        ps = subprocess.run([self.path] + list(args) + ["-v", "error"], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, timeout=self.timeout, check=True)
+        return ps.stdout.decode("utf-8")
+
+    def _discover(self, key: str) -> dict:
+        data = {
+            'key': key,
+            'version': _parse_version(self._run("-version")),
+            'codecs': _parse_codecs(self._run("-codecs")),
+            'formats': _parse_formats(self._run("-formats")),
+            'bitstream_filters': _parse_bitstream_filters(self._run("-bsfs")),
+        }
+        self._write_cache(key, data)
+        return data
+
+
+capabilities = CapabilityRegistry()
+
+
+def get_capabilities() -> CapabilityTable:
+    """Indexed capabilities of the configured ffmpeg, see `CapabilityTable`"""
+    try:
+        return capabilities.table
+    except Exception:
+        logger.exception("Could not get capabilities.")
+        raise
 
 
 def get_formats():
     """Get available File Formats
 
-    Basically runs `ffmpeg -formats` and parse the results
+    Basically runs `ffmpeg -formats` once and parse the results, see `CapabilityRegistry`
     :return [{
         'format': str,
         'Demuxing Supported': bool,
@@ -26,23 +306,7 @@ def get_formats():
     """
 
     try:
-        # Ask ffmpeg to formats
-        ps = subprocess.run([FFMPEG_PATH, "-formats", "-v", "error"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                            timeout=1, check=True)
-        output = ps.stdout.decode("utf-8")
-        pattern = "\s(D|\s)(E|\s)\s([a-zA-Z0-9_,]+)\s+(.+)\n"
-        findings = re.findall(pattern, output)
-        formats = []
-        # Parse the results
-        for f in findings:
-            for format in f[3].split(','):
-                formats.append({
-                    'format': format,
-                    'Demuxing Supported': f[0] == 'D',
-                    'Muxing Supported': f[1] == 'E',
-                    'display': f[4]
-                })
-        return formats
+        return [f for entries in capabilities.table.formats.values() for f in entries]
     except Exception:
         logger.exception("Could not get formats.")
         raise
@@ -50,9 +314,10 @@ def get_formats():
 
 def get_codecs(only_video=False, only_audio=False, only_subtitle=False):
     """Gets available codecs
-    Basically runs `ffmpeg -codecs` and parse the results
+    Basically runs `ffmpeg -codecs` once and parse the results, see `CapabilityRegistry`
     :return [{
-        'codec': str,
+        'name': str,
+        'type': 'video' | 'audio' | 'subtitle' | 'data' | 'attachment',
         'Decoding supported': bool,
         'Encoding supported': bool,
         'Video codec': bool,
@@ -61,64 +326,30 @@ def get_codecs(only_video=False, only_audio=False, only_subtitle=False):
         'Intra frame-only codec': bool,
         'Lossy compression': bool,
         'Lossless compression': bool,
+        'decoders': [str],
+        'encoders': [str],
         'display': str
     }]
     """
 
-    VIDEO_CODECS = []
-    AUDIO_CODECS = []
-    SUBTITLE_CODECS = []
-    CODECS = []
-
     try:
-        ps = subprocess.run([FFMPEG_PATH, "-codecs", "-v", "error"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                            timeout=1, check=True)
-        output = ps.stdout.decode("utf-8")
-        pattern = "\s(D|\.)(E|\.)(V|A|S|\.)(I|\.)(L|\.)(S|\.)\s([a-zA-Z0-9_,]+)\s+(.+)\n"
-        findings = re.findall(pattern, output)
-
-        for f in findings:
-            for codec in f[6].split(','):
-                c = {
-                    'name': codec,
-                    'Decoding supported': f[0] == 'D',
-                    'Encoding supported': f[1] == 'E',
-                    'Video codec': f[2] == 'V',
-                    'Audio codec': f[2] == 'A',
-                    'Subtitle codec': f[2] == 'S',
-                    'Intra frame-only codec': f[3] == 'I',
-                    'Lossy compression': f[4] == 'L',
-                    'Lossless compression': f[5] == 'S',
-                    'display': f[6]
-                }
-                if only_video and f[2] == 'V':
-                    VIDEO_CODECS.append(c)
-                elif only_audio and f[2] == 'A':
-                    AUDIO_CODECS.append(c)
-                elif only_subtitle and f[2] == 'S':
-                    SUBTITLE_CODECS.append(c)
-                else:
-                    CODECS.append(c)
+        table = capabilities.table
     except Exception:
         logger.exception("Could not get codecs.")
         raise
 
     if only_video:
-        return VIDEO_CODECS
+        return list(table.video.values())
     if only_audio:
-        return AUDIO_CODECS
+        return list(table.audio.values())
     if only_subtitle:
-        return SUBTITLE_CODECS
-    return CODECS
+        return list(table.subtitle.values())
+    return list(table.codecs.values())
 
 
 def get_bitstream_filters():
     try:
-        ps = subprocess.run([FFMPEG_PATH, "-bsfs", "-v", "error"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                            timeout=1, check=True)
-        output = ps.stdout.decode("utf-8")
-        pattern = "[a-zA-Z0-9_]\n"
-        return re.findall(pattern, output)
+        return list(capabilities.table.bitstream_filters)
     except Exception:
         logger.exception("Could not get bitstream filters.")
         raise
@@ -1,26 +1,433 @@
+import hashlib
+import itertools
 import json
 import os
+import sqlite3
 import subprocess
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from logging import getLogger
 
-from django.conf import settings
+from . import settings
 
 logger = getLogger('ffmpeg.utils.ffprobe')
 
-FFPROBE_PATH = getattr(settings, "FFPROBE_PATH", "/usr/bin/ffprobe")
 
-if not os.path.exists(FFPROBE_PATH):
-    raise FileNotFoundError("FFprobe can not found in system. %s" % FFPROBE_PATH)
+def __getattr__(name):
+    # FFPROBE_PATH and the entries and seconds the default probe cache keeps results for, see `settings`
+    if name in ("FFPROBE_PATH", "FFPROBE_CACHE_SIZE", "FFPROBE_CACHE_MAX_AGE"):
+        return settings.get(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
-def get_file_attributes(path):
+def _binary_key(path: str) -> str:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return path
+    return "%s:%d:%d" % (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def probe_key(path: str, ffprobe: str = settings.DEFAULT) -> str:
+    """Cache key of a file probed by `ffprobe`, changes whenever the file or ffprobe is replaced or modified
+
+    :param ffprobe: Path of the ffprobe binary, FFPROBE_PATH by default
+    """
+    stat = os.stat(path)
+    return "%s:%d:%d:%d:%d|%s" % (os.path.realpath(path), stat.st_size, stat.st_mtime_ns, stat.st_dev, stat.st_ino,
+                                  _binary_key(settings.resolve(ffprobe, "FFPROBE_PATH")))
+
+
+class ProbeCache:
+    """Stores raw ffprobe output by `probe_key`"""
+
+    def get(self, key: str):
+        raise NotImplementedError()
+
+    def set(self, key: str, value: str):
+        raise NotImplementedError()
+
+    def clear(self):
+        raise NotImplementedError()
+
+
+class MemoryProbeCache(ProbeCache):
+    """LRU cache in memory, optionally in front of a persistent `backend`
+
+    :param max_entries: Least recently used entries are evicted above this size
+    :param max_age: Seconds an entry is served for
+    :param backend: Another `ProbeCache` consulted on misses and written through on updates
+    """
+
+    def __init__(self, max_entries: int = settings.DEFAULT, max_age: float = settings.DEFAULT,
+                 backend: ProbeCache = None):
+        self._max_entries = max_entries
+        self._max_age = max_age
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_entries(self) -> int:
+        return settings.resolve(self._max_entries, "FFPROBE_CACHE_SIZE")
+
+    @property
+    def max_age(self) -> float:
+        return settings.resolve(self._max_age, "FFPROBE_CACHE_MAX_AGE")
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self.max_age is None or time.time() - entry[0] < self.max_age:
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                del self._entries[key]
+        if self.backend is None:
+            return None
+        value = self.backend.get(key)
+        if value is not None:
+            self._store(key, value)
+        return value
+
+    def set(self, key: str, value: str):
+        self._store(key, value)
+        if self.backend is not None:
+            self.backend.set(key, value)
+
+    def _store(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.backend is not None:
+            self.backend.clear()
+
+
+class SQLiteProbeCache(ProbeCache):
+    """Persistent cache in a SQLite file, shared by processes on the same host
+
+    :param max_entries: Least recently used entries are evicted above this size
+    :param max_age: Seconds an entry is served for
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000, max_age: float = None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS probes "
+                                 "(key TEXT PRIMARY KEY, value TEXT, created REAL, used REAL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS probes_used ON probes (used)")
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute("SELECT value, created FROM probes WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.max_age is not None and now - row[1] >= self.max_age:
+                self._connection.execute("DELETE FROM probes WHERE key = ?", (key,))
+                return None
+            self._connection.execute("UPDATE probes SET used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO probes (key, value, created, used) VALUES (?, ?, ?, ?)",
+                                     (key, value, now, now))
+            if self.max_age is not None:
+                self._connection.execute("DELETE FROM probes WHERE created < ?", (now - self.max_age,))
+            self._connection.execute("DELETE FROM probes WHERE key IN (SELECT key FROM probes ORDER BY used DESC "
+                                     "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM probes")
+
+
+class DjangoProbeCache(ProbeCache):
+    """Stores probes in one of the project's Django caches, which handles eviction by itself"""
+
+    def __init__(self, alias: str = "default", max_age: float = settings.DEFAULT, prefix: str = "ffprobe:"):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.max_age = settings.resolve(max_age, "FFPROBE_CACHE_MAX_AGE")
+        self.prefix = prefix
+
+    def _key(self, key: str) -> str:
+        # Keys must be short and free of spaces for memcached
+        return self.prefix + hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        return self.cache.get(self._key(key))
+
+    def set(self, key: str, value: str):
+        self.cache.set(self._key(key), value, self.max_age)
+
+    def clear(self):
+        # Shared Django caches can not be cleared by prefix, entries expire after `max_age`
+        pass
+
+
+# Replace to change the caching of `get_file_attributes`, e.g. with
+# MemoryProbeCache(backend=SQLiteProbeCache("/var/cache/ffprobe.sqlite"))
+probe_cache = MemoryProbeCache()
+
+
+# Path ffprobe reads a stream from
+PIPE_INPUT = "pipe:0"
+
+
+def _is_stream(path) -> bool:
+    return not isinstance(path, (str, bytes, os.PathLike))
+
+
+def _probe_stream(args: list, source, timeout: float = None) -> str:
+    """Runs ffprobe on data fed to its stdin, it stops reading once it has seen enough"""
+    from . import runner
+
+    return runner.run(args, stdin=source, capture_stdout=True, timeout=timeout).stdout.decode("utf-8")
+
+
+def _get_file_attributes(path, cache: ProbeCache = None, timeout: float = None):
+    if _is_stream(path):
+        args = [settings.get("FFPROBE_PATH"), "-v", "error", "-show_format", "-show_streams",
+                "-print_format", "json", "-i", PIPE_INPUT]
+        return json.loads(_probe_stream(args, path, timeout))
     if not os.path.exists(path):
         raise FileNotFoundError("File not found in %s" % path)
 
+    if cache is None:
+        cache = probe_cache
+    key = probe_key(path) if cache else None
+    if cache:
+        output = cache.get(key)
+        if output is not None:
+            return json.loads(output)
+
+    args = [settings.get("FFPROBE_PATH"), "-v", "error", "-show_format", "-show_streams", "-print_format", "json",
+            "-i", path]
+    ps = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, timeout=timeout)
+    output = ps.stdout.decode("utf-8")
+    attributes = json.loads(output)
+
+    if cache:
+        cache.set(key, output)
+    return attributes
+
+
+def get_file_attributes(path, cache: ProbeCache = None, timeout: float = None):
+    """Runs `ffprobe -show_format -show_streams` on the file
+
+    Results are cached by path, size, mtime and inode of the file and of ffprobe in `probe_cache`, or in `cache`
+    if given. Pass `cache=False` to always run ffprobe.
+    :param path: File path, or a binary file-like object (or iterable of bytes) that is streamed to ffprobe and
+        never cached. Formats that keep their index at the end, like non-fragmented mp4, can not be probed this way.
+    """
     try:
-        args = [FFPROBE_PATH, "-v", "error", "-show_format", "-show_streams", "-print_format", "json", "-i", path]
-        ps = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        return json.loads(ps.stdout.decode("utf-8"))
+        return _get_file_attributes(path, cache, timeout)
+    except FileNotFoundError:
+        raise
     except Exception as err:
         logger.exception("File attributes not get. Path: %s\n%s" % (path, err))
         raise err
+
+
+class ProbeResult:
+    """Outcome of probing a single file with `probe_many`, either `attributes` or `error` is set"""
+
+    __slots__ = ("path", "attributes", "error")
+
+    def __init__(self, path, attributes: dict = None, error: Exception = None):
+        self.path = path
+        self.attributes = attributes
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def __repr__(self):
+        return "<ProbeResult %s %s>" % (self.path, "ok" if self.ok else repr(self.error))
+
+
+def probe_many(paths, max_workers: int = None, cache: ProbeCache = None, timeout: float = None):
+    """Probes many files concurrently, like `get_file_attributes`
+
+    Yields a `ProbeResult` per path as soon as it is ready, so results come in completion order. A failing file
+    does not stop the others, its exception is in `ProbeResult.error`. `paths` may be any iterable, it is consumed
+    lazily and only a few probes per worker are queued at any time.
+
+        for result in probe_many(walk(library), max_workers=16):
+            if result.ok:
+                index(result.path, result.attributes)
+
+    :param max_workers: Concurrent ffprobe processes, defaults to 4 per CPU up to 32
+    :param timeout: Seconds a single probe may take
+    """
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) * 4)
+    paths = iter(paths)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ffprobe") as executor:
+        def fill():
+            for path in itertools.islice(paths, max_workers * 2 - len(pending)):
+                pending[executor.submit(_get_file_attributes, path, cache, timeout)] = path
+
+        fill()
+        try:
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    try:
+                        result = ProbeResult(path, attributes=future.result())
+                    except Exception as err:
+                        result = ProbeResult(path, error=err)
+                    yield result
+                fill()
+        finally:
+            # The consumer stopped early
+            for future in pending:
+                future.cancel()
+
+
+def _fraction(value: str) -> float:
+    numerator, _, denominator = value.partition("/")
+    return float(numerator) / float(denominator) if denominator else float(numerator)
+
+
+# Entries `probe` can ask for, with the type they are converted to
+FORMAT_FIELDS = {'duration': float, 'start_time': float, 'size': int, 'bit_rate': int, 'format_name': str,
+                 'nb_streams': int}
+STREAM_FIELDS = {'index': int, 'codec_type': str, 'codec_name': str, 'profile': str, 'width': int, 'height': int,
+                 'pix_fmt': str, 'r_frame_rate': _fraction, 'avg_frame_rate': _fraction, 'bit_rate': int,
+                 'duration': float, 'nb_frames': int, 'sample_rate': int, 'channels': int}
+
+
+def _convert(fields: dict, values: dict, name: str):
+    value = values.get(name)
+    if value is None or value == "N/A":
+        return None
+    try:
+        return fields[name](value)
+    except (ValueError, ZeroDivisionError):
+        return None
+
+
+class StreamInfo:
+    __slots__ = tuple(STREAM_FIELDS)
+
+    def __init__(self, values: dict):
+        for name in self.__slots__:
+            setattr(self, name, _convert(STREAM_FIELDS, values, name))
+
+    def __repr__(self):
+        return "<StreamInfo %s>" % " ".join("%s=%s" % (n, getattr(self, n)) for n in self.__slots__
+                                            if getattr(self, n) is not None)
+
+
+class ProbeInfo:
+    """Result of `probe`, fields that were not asked for (or ffprobe did not report) are None"""
+
+    __slots__ = ("path",) + tuple(FORMAT_FIELDS) + ("streams", "keyframes")
+
+    def __init__(self, path: str, values: dict):
+        self.path = path
+        format = values.get('format', {})
+        for name in FORMAT_FIELDS:
+            setattr(self, name, _convert(FORMAT_FIELDS, format, name))
+        self.streams = [StreamInfo(stream) for stream in values.get('streams', [])]
+        packets = values.get('packets')
+        self.keyframes = None if packets is None else [
+            float(packet['pts_time']) for packet in packets
+            if 'K' in packet.get('flags', "") and packet.get('pts_time', "N/A") != "N/A"]
+
+    @property
+    def stream(self) -> StreamInfo:
+        """The first stream, usually the only one when `select_streams` was given"""
+        return self.streams[0] if self.streams else None
+
+    def __repr__(self):
+        return "<ProbeInfo %s duration=%s streams=%s>" % (self.path, self.duration, self.streams)
+
+
+def probe_args(path: str, format_fields=("duration",), stream_fields=(), select_streams: str = None,
+               keyframes: bool = False, read_intervals: str = None) -> list:
+    """The ffprobe invocation `probe` runs, see there for the parameters"""
+    for name in format_fields:
+        if name not in FORMAT_FIELDS:
+            raise ValueError("Unknown format field: %s" % name)
+    for name in stream_fields:
+        if name not in STREAM_FIELDS:
+            raise ValueError("Unknown stream field: %s" % name)
+
+    entries = []
+    if format_fields:
+        entries.append("format=" + ",".join(format_fields))
+    if stream_fields:
+        entries.append("stream=" + ",".join(stream_fields))
+    if keyframes:
+        entries.append("packet=pts_time,flags")
+        select_streams = select_streams or "v:0"
+    if not entries:
+        raise ValueError("Nothing to probe")
+
+    args = [settings.get("FFPROBE_PATH"), "-v", "error", "-print_format", "json",
+            "-show_entries", ":".join(entries)]
+    if select_streams:
+        args.extend(["-select_streams", select_streams])
+    if read_intervals:
+        args.extend(["-read_intervals", read_intervals])
+    args.extend(["-i", path])
+    return args
+
+
+def probe(path, format_fields=("duration",), stream_fields=(), select_streams: str = None, keyframes: bool = False,
+          read_intervals: str = None, cache: ProbeCache = None, timeout: float = None) -> ProbeInfo:
+    """Asks ffprobe only for the given entries, which lets it stop reading early
+
+        info = probe(path, stream_fields=("codec_name", "width", "height"), select_streams="v:0",
+                     read_intervals="%+#1")
+        info.duration, info.stream.width
+
+    :param path: File path or a stream, see `get_file_attributes`
+    :param format_fields: Names from `FORMAT_FIELDS`
+    :param stream_fields: Names from `STREAM_FIELDS`
+    :param select_streams: Stream specifier such as "v:0" or "a", limits the streams and keyframes reported
+    :param keyframes: Collect the timestamps of key packets into `ProbeInfo.keyframes` (of "v:0" by default)
+    :param read_intervals: Limits the part of the file read, e.g. "%+#1" for the first packet only
+    :param cache: See `get_file_attributes`
+    """
+    if _is_stream(path):
+        args = probe_args(PIPE_INPUT, format_fields, stream_fields, select_streams, keyframes, read_intervals)
+        return ProbeInfo(PIPE_INPUT, json.loads(_probe_stream(args, path, timeout)))
+    if not os.path.exists(path):
+        raise FileNotFoundError("File not found in %s" % path)
+
+    args = probe_args(path, format_fields, stream_fields, select_streams, keyframes, read_intervals)
+    if cache is None:
+        cache = probe_cache
+    key = probe_key(path) + "|" + " ".join(args[1:-1]) if cache else None
+    output = cache.get(key) if cache else None
+    if output is None:
+        try:
+            ps = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True, timeout=timeout)
+        except Exception as err:
+            logger.exception("File not probed. Path: %s\n%s" % (path, err))
+            raise
+        output = ps.stdout.decode("utf-8")
+        if cache:
+            cache.set(key, output)
+    return ProbeInfo(path, json.loads(output))
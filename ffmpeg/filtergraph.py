@@ -0,0 +1,223 @@
+"""Filtergraphs for `-filter_complex` and `-filter`
+
+https://ffmpeg.org/ffmpeg-filters.html#Filtergraph-syntax-1
+
+    graph = FilterGraph()
+    graph.chain(FilterNode("crop", 1280, 720, 0, 0), FilterNode("scale", 640, 360), inputs=["0:v"], outputs=["out"])
+    graph.optimize().generate()
+    ['-filter_complex', '[0:v]crop=...']
+"""
+import re
+
+# Characters escaped inside an option value and then inside the filtergraph description
+_VALUE_SPECIAL = re.compile(r"([\\':])")
+_GRAPH_SPECIAL = re.compile(r"([\\'\[\],;])")
+_NUMBER = re.compile(r"^\d+$")
+# A scale to 0 keeps the input's width or height
+_SIZE = re.compile(r"^[1-9]\d*$")
+
+
+def _escape(value) -> str:
+    return _GRAPH_SPECIAL.sub(r"\\\1", _VALUE_SPECIAL.sub(r"\\\1", str(value)))
+
+
+class FilterNode:
+    """A single filter, e.g. FilterNode("scale", 1280, 720, flags="lanczos") is scale=1280:720:flags=lanczos"""
+
+    __slots__ = ("name", "args")
+
+    def __init__(self, name: str, *args, **kwargs):
+        self.name = name
+        # (None, value) for positional and (key, value) for named options, in order
+        self.args = [(None, str(value)) for value in args] + [(key, str(value)) for key, value in kwargs.items()]
+
+    @classmethod
+    def parse(cls, expression: str):
+        """Builds a node from a simple, unescaped filter expression such as scale=iw*2:ih:flags=lanczos"""
+        name, _, options = expression.partition("=")
+        node = cls(name.strip())
+        for option in options.split(":") if options else []:
+            key, sep, value = option.partition("=")
+            node.args.append((key, value) if sep else (None, option))
+        return node
+
+    def option(self, position: int, *names):
+        """Value of an option given at `position` or by one of `names`, None if not set"""
+        for key, value in self.args:
+            if key in names:
+                return value
+        positional = [value for key, value in self.args if key is None]
+        return positional[position] if position is not None and position < len(positional) else None
+
+    def copy(self):
+        node = FilterNode(self.name)
+        node.args = list(self.args)
+        return node
+
+    def __eq__(self, other):
+        return isinstance(other, FilterNode) and self.name == other.name and self.args == other.args
+
+    def __repr__(self):
+        return "<FilterNode %s>" % self
+
+    def __str__(self):
+        if not self.args:
+            return self.name
+        return self.name + "=" + ":".join(_escape(value) if key is None else key + "=" + _escape(value)
+                                          for key, value in self.args)
+
+
+class FilterChain:
+    """Filters applied one after another, between labelled input and output pads"""
+
+    def __init__(self, *nodes, inputs=(), outputs=()):
+        self.nodes = list(nodes)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def append(self, node: FilterNode):
+        self.nodes.append(node)
+        return self
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __repr__(self):
+        return "<FilterChain %s>" % self
+
+    def __str__(self):
+        return "".join("[%s]" % pad for pad in self.inputs) + ",".join(str(node) for node in self.nodes) + \
+            "".join("[%s]" % pad for pad in self.outputs)
+
+
+# Optimization passes, each takes a list of nodes and returns the rewritten list
+
+def _is_noop(node: FilterNode) -> bool:
+    if node.name in ("null", "anull", "copy", "acopy"):
+        return True
+    if node.name == "scale":
+        extra = [key for key, _ in node.args if key not in (None, "w", "width", "h", "height")]
+        return not extra and node.option(0, "w", "width") == "iw" and node.option(1, "h", "height") == "ih"
+    if node.name == "crop":
+        x, y = node.option(2, "x"), node.option(3, "y")
+        return (node.option(0, "w", "out_w") in ("iw", "in_w") and node.option(1, "h", "out_h") in ("ih", "in_h")
+                and x in (None, "0") and y in (None, "0"))
+    if node.name == "setpts":
+        return node.option(0, "expr") == "PTS"
+    return False
+
+
+def drop_noops(nodes: list) -> list:
+    """Removes filters that pass frames through unchanged, e.g. scale=iw:ih"""
+    return [node for node in nodes if not _is_noop(node)]
+
+
+def _plain_scale(node: FilterNode) -> bool:
+    """Whether `node` is a scale that only resizes, without range, colour matrix or interlacing options"""
+    return node.name == "scale" and all(key in (None, "w", "width", "h", "height", "flags") for key, _ in node.args)
+
+
+def _absolute_size(node: FilterNode) -> bool:
+    # Only plain pixel sizes leave the result independent of the input size
+    if not _plain_scale(node):
+        return False
+    width, height = node.option(0, "w", "width"), node.option(1, "h", "height")
+    return bool(width and height and _SIZE.match(width) and _SIZE.match(height))
+
+
+def merge_scales(nodes: list) -> list:
+    """Drops a scale directly followed by a scale to an absolute size, which alone gives the same frame size
+
+    A scale that also converts, e.g. with out_range or out_color_matrix, is kept.
+    """
+    merged = []
+    for node in nodes:
+        if merged and _plain_scale(merged[-1]) and _absolute_size(node):
+            merged.pop()
+        merged.append(node)
+    return merged
+
+
+# Filters that only drop or retime frames, they can run before any per-pixel filter
+TEMPORAL_FILTERS = ("fps", "framestep", "trim", "select", "setpts")
+EXPENSIVE_FILTERS = ("scale", "zscale", "hqdn3d", "nlmeans", "unsharp", "deband", "eq", "colorspace", "format")
+# Not drawtext, which may print the timestamps setpts changes
+PIXEL_FILTERS = EXPENSIVE_FILTERS + ("crop", "pad", "hflip", "vflip", "transpose")
+
+
+def _crop_before_scale(crop: FilterNode, scale: FilterNode):
+    """Crop in input coordinates equivalent to `crop` after `scale`, None if it can not be derived"""
+    values = [crop.option(0, "w", "out_w"), crop.option(1, "h", "out_h"), crop.option(2, "x"), crop.option(3, "y")]
+    extra = [key for key, _ in crop.args if key not in (None, "w", "out_w", "h", "out_h", "x", "y")]
+    if extra or not _absolute_size(scale) or not all(value and _NUMBER.match(value) for value in values):
+        return None
+    width, height = scale.option(0, "w", "width"), scale.option(1, "h", "height")
+    w, h, x, y = values
+    return FilterNode("crop", "iw*%s/%s" % (w, width), "ih*%s/%s" % (h, height),
+                      "iw*%s/%s" % (x, width), "ih*%s/%s" % (y, height))
+
+
+def push_down_cheap(nodes: list) -> list:
+    """Moves frame dropping filters, and crops that can be translated, in front of expensive filters
+
+    A crop after a scale to an absolute size becomes a crop of the same area in input coordinates followed by a
+    scale to the cropped size, so only the kept pixels get scaled. The result is geometrically the same but may
+    differ in the last bit of resampling.
+    """
+    nodes = list(nodes)
+    moved = True
+    while moved:
+        moved = False
+        for i in range(1, len(nodes)):
+            previous, node = nodes[i - 1], nodes[i]
+            if node.name in TEMPORAL_FILTERS and previous.name in PIXEL_FILTERS:
+                nodes[i - 1], nodes[i] = node, previous
+                moved = True
+            elif node.name == "crop" and previous.name == "scale":
+                crop = _crop_before_scale(node, previous)
+                if crop is not None:
+                    scale = FilterNode("scale", node.option(0, "w", "out_w"), node.option(1, "h", "out_h"))
+                    scale.args.extend(arg for arg in previous.args if arg[0] == "flags")
+                    nodes[i - 1], nodes[i] = crop, scale
+                    moved = True
+    return nodes
+
+
+DEFAULT_PASSES = (drop_noops, merge_scales, push_down_cheap)
+
+
+class FilterGraph:
+    """Filter chains joined by labelled pads, serialized for `-filter_complex`"""
+
+    def __init__(self, *chains):
+        self.chains = list(chains)
+
+    def chain(self, *nodes, inputs=(), outputs=()) -> FilterChain:
+        """Adds and returns a new chain"""
+        chain = FilterChain(*nodes, inputs=inputs, outputs=outputs)
+        self.chains.append(chain)
+        return chain
+
+    def optimize(self, passes=DEFAULT_PASSES):
+        """Rewrites every chain with the given passes, chains left empty become `null` (or `anull`)"""
+        for chain in self.chains:
+            nodes = [node.copy() for node in chain.nodes]
+            for optimization in passes:
+                nodes = optimization(nodes)
+            if not nodes and chain.nodes and (chain.inputs or chain.outputs):
+                nodes = [FilterNode("anull" if chain.nodes[0].name.startswith("a") else "null")]
+            chain.nodes = nodes
+        return self
+
+    def __bool__(self):
+        return any(chain.nodes for chain in self.chains)
+
+    def __repr__(self):
+        return "<FilterGraph %s>" % self
+
+    def __str__(self):
+        return ";".join(str(chain) for chain in self.chains if chain.nodes)
+
+    def generate(self, as_str: bool = True):
+        args = ["-filter_complex", str(self)]
+        return " ".join(args) if as_str else args
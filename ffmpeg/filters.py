@@ -1,6 +1,8 @@
 from django import forms
 
-from .utils import BaseFilter, StreamSpecifier, EnumChoiceField, ChoiceEnum
+from . import core
+from .forms import BaseFilter, EnumChoiceField
+from .utils import ChoiceEnum, StreamSpecifier
 
 
 class FFmpegFilter(ChoiceEnum):
@@ -27,10 +29,12 @@ class BitstreamChannelFilter(BaseFilter):
 
     filters = forms.CharField(max_length=255)
 
-    def generate(self, as_str: bool = True):
+    def core(self) -> core.BitstreamChannelFilter:
         self.validate()
-        args = ["-bsf:" + self.cleaned_data['stream'], self.cleaned_data['filters']]
-        return " ".join(args) if as_str else args
+        return core.BitstreamChannelFilter(self.cleaned_data['stream'], self.cleaned_data['filters'])
+
+    def generate(self, as_str: bool = True):
+        return self.core().generate(as_str)
 
 
 class FOAR(ChoiceEnum):
@@ -87,23 +91,15 @@ class ScaleFilter(BaseFilter):
 
         return super(ScaleFilter, self).clean()
 
-    def generate(self, as_str: bool = True):
+    def core(self) -> core.ScaleFilter:
         self.validate()
-        width = "iw" if self.cleaned_data['uiw'] else str(self.cleaned_data['width'])
-        height = "ih" if self.cleaned_data['uih'] else str(self.cleaned_data['height'])
-
-        scale_width = self.cleaned_data['scale_width']
-        scale_height = self.cleaned_data['scale_height']
+        data = dict(self.cleaned_data)
+        del data['stream']
+        return core.ScaleFilter(**data)
 
-        width = width + "*" + str(scale_width) if scale_width else width
-        height = height + "*" + str(scale_height) if scale_height else height
+    def expression(self) -> str:
+        """The filter itself, e.g. scale=1920:1080, for use in a filtergraph"""
+        return self.core().expression()
 
-        height = "-1" if self.cleaned_data['kar'] else height
-
-        scale = "scale=" + width + ":" + height
-
-        if self.cleaned_data['foar'] != FOAR.Disable:
-            scale = scale + ":force_original_aspect_ratio=" + str(self.cleaned_data['foar'])
-
-        args = ["-filter:" + self.cleaned_data['stream'], scale]
-        return " ".join(args) if as_str else args
+    def generate(self, as_str: bool = True):
+        return self.core().generate(as_str)
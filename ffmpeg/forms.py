@@ -0,0 +1,31 @@
+"""Django form bases of the commands, codecs and filters"""
+import inspect
+
+from django import forms
+
+from .utils import ChoiceEnum, StreamSpecifier
+
+
+class EnumChoiceField(forms.ChoiceField):
+    def __init__(self, *args, **kwargs):
+        # Unpack Enum
+        choices = kwargs.get('choices', None)
+        if choices and inspect.isclass(choices) and issubclass(choices, ChoiceEnum):
+            kwargs['choices'] = choices.choices()
+        super(EnumChoiceField, self).__init__(*args, **kwargs)
+
+
+class BaseCommand(forms.Form):
+    def validate(self):
+        if not self.is_valid():
+            raise ValueError(
+                "%s is not valid.\nData: %s\nErrors: %s" % (self.__class__.__name__, self.data, self.errors))
+        return self
+
+    def generate(self, as_str: bool = True):
+        """This should generates a string as command run on shell"""
+        raise NotImplemented()
+
+
+class BaseFilter(BaseCommand):
+    stream = EnumChoiceField(choices=StreamSpecifier, required=False)
@@ -0,0 +1,118 @@
+"""Decoded frames as NumPy arrays, read from a rawvideo pipe
+
+    command = Command(input="input.mp4", output="unused", ss_position="00:01:00", duration="00:00:10")
+    for batch in frames(command, size=(224, 224), batch_size=32):
+        scores = model(batch)  # uint8 array of shape (32, 224, 224, 3), the last batch may be shorter
+
+Frames are read with `readinto` straight into a preallocated array that is reused for every frame (or batch), so
+copy what you keep past the next iteration. NumPy is only needed when this module is used.
+"""
+import copy
+import subprocess
+import threading
+
+from . import core, runner
+from .filtergraph import FilterNode
+
+# Bytes per pixel of rgb24
+CHANNELS = 3
+
+
+def frames_args(command, size: tuple = None) -> list:
+    """Argument list decoding the first video stream of `command`'s input to rgb24 rawvideo on stdout
+
+    :param command: A `generator.Command` or `core.Command`, its output, `format` and `vn` are replaced
+    :param size: (width, height) to scale the frames to, the command's own filters run before
+
+    Frames keep the coded orientation, the display rotation of the input is not applied.
+    """
+    if isinstance(command, core.Command):
+        command = copy.copy(command)
+        command.filters = list(command.filters)
+    else:
+        command = command.core()
+    command.output, command.format, command.vn = "pipe:1", "rawvideo", False
+    # Autorotation would swap the width and height ffprobe reports for a stream rotated by 90 degrees
+    command.input_args = ["-noautorotate"] + command.input_args
+    if size is not None:
+        command.filters.append(FilterNode("scale", int(size[0]), int(size[1])))
+    # An unlabelled -filter_complex output is mapped by itself
+    streams = [] if command.filter_complex else ["-map", "0:v:0"]
+    command.output_args = command.output_args + streams + ["-pix_fmt", "rgb24"]
+    return command.generate(as_str=False)
+
+
+def _frame_size(command) -> tuple:
+    from .ffprobe import probe
+
+    if not isinstance(command, core.Command):
+        command = command.core()
+    if command.filters or command.filter_complex:
+        raise ValueError("Filters may change the frame size, pass `size`.")
+    stream = probe(command.input, format_fields=(), stream_fields=("width", "height"), select_streams="v:0").stream
+    if stream is None or not stream.width or not stream.height:
+        raise ValueError("%s has no video stream." % command.input)
+    return stream.width, stream.height
+
+
+def _readinto(stream, view: memoryview) -> int:
+    """Fills `view` from `stream` unless it ends first, returns the bytes read"""
+    filled = 0
+    while filled < len(view):
+        read = stream.readinto(view[filled:])
+        if not read:
+            break
+        filled += read
+    return filled
+
+
+def frames(command, size: tuple = None, batch_size: int = 1, timeout: float = None):
+    """Yields the decoded frames of `command`'s input as uint8 arrays of shape (height, width, 3)
+
+    :param command: A `generator.Command` or `core.Command`, its positions, duration and filters select the frames
+    :param size: (width, height) of the frames, the input's size when omitted
+    :param batch_size: With more than 1, yields arrays of shape (batch_size, height, width, 3)
+    :param timeout: Seconds the whole decode may take before `runner.CommandTimeout` is raised
+    """
+    import numpy
+
+    width, height = size or _frame_size(command)
+    args = frames_args(command, size)
+    buffer = numpy.empty((batch_size, height, width, CHANNELS), dtype=numpy.uint8)
+    view = memoryview(buffer).cast("B")
+    frame_bytes = width * height * CHANNELS
+
+    stderr = runner._StderrCollector()
+    process = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    reader = threading.Thread(target=runner._drain, args=(process.stderr, stderr.feed), daemon=True)
+    reader.start()
+    timed_out = threading.Event()
+
+    def expire():
+        timed_out.set()
+        runner._terminate(process)
+
+    timer = threading.Timer(timeout, expire) if timeout is not None else None
+    if timer:
+        timer.start()
+    try:
+        while True:
+            filled = _readinto(process.stdout, view)
+            count = filled // frame_bytes
+            if count:
+                yield buffer[0] if batch_size == 1 else buffer[:count]
+            if filled < len(view):
+                break
+        process.wait()
+    finally:
+        # Also reached when the consumer stops early
+        if timer:
+            timer.cancel()
+        runner._terminate(process)
+        reader.join()
+        process.stdout.close()
+        process.stderr.close()
+    if timed_out.is_set():
+        raise runner.CommandTimeout(args, timeout, stderr.text)
+    if process.returncode != 0:
+        raise stderr.error(args, process.returncode)
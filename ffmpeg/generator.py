@@ -1,27 +1,41 @@
 from django import forms
 from django.utils.translation import ugettext_lazy as _
 
-from .ffmpeg import FFMPEG_PATH
-from .utils import BaseCommand, BaseFilter, EnumChoiceField
+from . import core, runner
+from .core import _Quoted
+from .forms import BaseCommand, BaseFilter, EnumChoiceField
 from .codecs import Codec
+from .filters import ScaleFilter
+from .filtergraph import FilterGraph, FilterNode
 from .utils import LogLevel
 
 
 class Command(BaseCommand):
     def __init__(self, **kwargs):
-        self.args = []
         self.codecs = []
         self.filters = []
+        self.keyframe_index = None
+        self.filter_complex = None
         super(Command, self).__init__(data=kwargs)
 
     # Main Options
-    # -i
+    # -i : A path, or "pipe:0" to read from stdin (see `run(stdin=...)`)
     input = forms.CharField(label=_("Input File Path"), required=True)
+    # A path, or "pipe:1" to write to stdout (see `run(stdout=...)`), which needs `format`
     output = forms.CharField(label=_("Output File Path"), required=True)
 
+    # -f
+    # Force the input or output file format. Needed for pipes, whose format can not be guessed from an extension.
+    input_format = forms.CharField(required=False, label=_("Input Format"))
+    format = forms.CharField(required=False, label=_("Output Format"))
+
     # -loglevel
     loglevel = EnumChoiceField(choices=LogLevel, required=False, label=_("Log Level"))
 
+    # -filter_threads
+    # Threads of the filtergraphs, ffmpeg uses one per core by default.
+    filter_threads = forms.IntegerField(min_value=1, required=False, label=_("Filter Threads"))
+
     # -y : Overwrite output files without asking.
     overwrite = forms.NullBooleanField(required=False, label=_("Overwrite"))
 
@@ -84,155 +98,242 @@ class Command(BaseCommand):
     # -filter
     filters = []
 
-    def _add_filters(self):
-        for flt in self.filters:
-            self.args.append(flt.generate())
-
-    def _add_codecs(self, before=False):
-        for codec in self.codecs:
-            if before == codec.cleaned_data['before_input']:
-                self.args.append(codec.generate())
-
-    def _add_aspect(self):
-        self.args.append("-aspect")
-        self.args.append(str(self.cleaned_data['aspect']))
-
-    @staticmethod
-    def _normalize(val: str):
-        val = val.replace('"', '\\"')
-        val = val.replace("'", "\\'")
-        return val
-
-    def _add_input_file(self):
-        self.args.append("-i")
-        self.args.append('"' + self._normalize(str(self.cleaned_data['input'])) + '"')
-
-    def _add_log_level(self):
-        self.args.append("-loglevel")
-        self.args.append(str(self.cleaned_data['loglevel']))
-
-    def _add_overwrite_or_not_existing_files(self):
-        ow = self.cleaned_data['overwrite']
-        if ow is None:
-            return
-        else:
-            self.args.append('-y') if ow else self.args.append('-n')
-
-    def _add_output_file(self):
-        self.args.append('"' + self._normalize(str(self.cleaned_data['output'])) + '"')
-
-    def _add_duration(self):
-        self.args.append("-t")
-        self.args.append(str(self.cleaned_data['duration']))
-
-    def _add_file_size_limit(self):
-        self.args.append("-fs")
-        self.args.append(str(self.cleaned_data['file_size_limit']))
-
-    def _add_ss_position(self):
-        self.args.append("-ss")
-        self.args.append(str(self.cleaned_data['ss_position']))
-
-    def _add_to_position(self):
-        self.args.append("-to")
-        self.args.append(str(self.cleaned_data['to_position']))
-
-    def _add_sseof_position(self):
-        self.args.append("-sseof")
-        self.args.append(str(self.cleaned_data['sseof_position']))
-
-    def _add_stream_loop(self):
-        self.args.append("-stream_loop")
-        self.args.append(str(self.stream_loop))
-
-    def _add_itsoffset(self):
-        self.args.append("-itsoffset")
-        self.args.append(str(self.cleaned_data['itsoffset']))
-
-    def _add_timestamp(self, stamp):
-        self.args.append("-timestamp")
-        self.args.append(str(stamp))
-
-    def _add_vn(self):
-        self.args.append("-vn")
-
-    def add_filter(self, flt: BaseFilter):
-        """This will validate the filter and add to filters attribute"""
-        flt.validate()
+    def add_filter(self, flt: BaseFilter or FilterNode):
+        """This will validate the filter and add to filters attribute, a `FilterNode` is added to the video chain"""
+        if not isinstance(flt, FilterNode):
+            flt.validate()
         self.filters.append(flt)
         return self
 
+    def set_filter_complex(self, graph: FilterGraph):
+        """Uses `graph` as `-filter_complex`, unlabelled outputs of the graph go to the output file"""
+        self.filter_complex = graph
+        return self
+
     def add_codec(self, codec: Codec):
         """This will validate the codec and add to codecs attribute"""
         codec.validate()
         self.codecs.append(codec)
         return self
 
+    def clone(self, **kwargs):
+        """Copy of the command with the given options replaced, codecs and filters are shared"""
+        command = self.__class__(**dict(self.data, **kwargs))
+        command.codecs = list(self.codecs)
+        command.filters = list(self.filters)
+        command.filter_complex = self.filter_complex
+        return command
+
+    def use_keyframe_index(self, index=None):
+        """Seeks `ss_position` accurately without decoding from the start of the input
+
+        `-ss` is put before the input at the nearest preceding keyframe and the remaining offset after it.
+        :param index: A `keyframes.KeyframeIndex`, built (or loaded from the cache) for the input if omitted
+        """
+        if index is None:
+            from .keyframes import get_keyframe_index
+            self.validate()
+            index = get_keyframe_index(self.cleaned_data['input'])
+        self.keyframe_index = index
+        return self
+
+    def core(self) -> core.Command:
+        """Validates the form and returns the command as a `core.Command`"""
+        self.validate()
+        return core.Command(codecs=[codec.core() for codec in self.codecs],
+                            filters=[flt if isinstance(flt, FilterNode) else flt.core() for flt in self.filters],
+                            filter_complex=self.filter_complex, keyframe_index=self.keyframe_index,
+                            **self.cleaned_data)
+
     def generate(self, as_str: bool = True) -> str or []:
         """
         Generates FFmpeg command
         :param as_str: Return command as string else it will came as List
-        :return: String or List
+        :return: String or List, the list is an argument vector that can be executed without a shell
         """
-        self.args = []
-        self.args.append(FFMPEG_PATH)
-        self.validate()
+        return self.core().generate(as_str)
 
-        # Before Input Tag
-        if self.cleaned_data['loglevel']:
-            self._add_log_level()
+    def expected_duration(self) -> float:
+        """Seconds of media the command will write, based on the duration ffprobe reports for the input"""
+        return self.core().expected_duration()
 
-        if self.cleaned_data['add_duration_before_input']:
-            self._add_duration()
+    def run(self, **kwargs) -> runner.Result:
+        """Runs the command and waits for it, see `runner.run` for the options"""
+        return self.core().run(**kwargs)
 
-        if self.cleaned_data['itsoffset']:
-            self._add_itsoffset()
+    async def run_async(self, **kwargs) -> runner.Result:
+        """Runs the command from an event loop, see `runner.run_async` for the options"""
+        return await self.core().run_async(**kwargs)
 
-        if self.cleaned_data['stream_loop']:
-            self._add_stream_loop()
 
-        self._add_codecs(before=True)
+class Output(BaseCommand):
+    """One output of a `MultiOutputCommand`, with its own codecs, scaling and bitrates"""
 
-        # Add Input File
-        self._add_input_file()
+    def __init__(self, **kwargs):
+        self.codecs = []
+        self.filters = []
+        super(Output, self).__init__(data=kwargs)
 
-        # After Input Tag
-        self._add_overwrite_or_not_existing_files()
+    output = forms.CharField(label=_("Output File Path"), required=True)
 
-        if self.cleaned_data['duration']:
-            self._add_duration()
+    # -b:v, -b:a e.g. "5M", "128k"
+    video_bitrate = forms.RegexField(regex=r"^\d+(\.\d+)?[kKmM]?$", required=False, label=_("Video Bitrate"))
+    audio_bitrate = forms.RegexField(regex=r"^\d+(\.\d+)?[kKmM]?$", required=False, label=_("Audio Bitrate"))
 
-        if self.cleaned_data['file_size_limit']:
-            self._add_file_size_limit()
+    # -maxrate, -bufsize: Peak video bitrate and the rate control buffer
+    max_video_bitrate = forms.RegexField(regex=r"^\d+(\.\d+)?[kKmM]?$", required=False, label=_("Max Video Bitrate"))
+    buffer_size = forms.RegexField(regex=r"^\d+(\.\d+)?[kKmM]?$", required=False, label=_("Rate Control Buffer"))
 
-        if self.cleaned_data['to_position']:
-            self._add_to_position()
+    # -vn, -an : Disable video or audio recording.
+    vn = forms.BooleanField(required=False, label=_("Disable Video Recording"))
+    an = forms.BooleanField(required=False, label=_("Disable Audio Recording"))
 
-        if self.cleaned_data['ss_position']:
-            self._add_ss_position()
+    def clean(self):
+        if self.cleaned_data.get('vn') and self.cleaned_data.get('an'):
+            raise forms.ValidationError("Output has neither video nor audio.")
+        return super(Output, self).clean()
 
-        if self.cleaned_data['sseof_position']:
-            self._add_sseof_position()
+    def add_filter(self, flt: BaseFilter):
+        """This will validate the filter and add to filters attribute"""
+        flt.validate()
+        if isinstance(flt, ScaleFilter) and self.scale is not None:
+            raise ValueError("Output already has a scale filter.")
+        self.filters.append(flt)
+        return self
 
-        if self.cleaned_data['timestamp_now']:
-            self._add_timestamp("now")
-        elif self.cleaned_data['timestamp']:
-            self._add_timestamp(self.cleaned_data['timestamp'])
+    def add_codec(self, codec: Codec):
+        """This will validate the codec and add to codecs attribute"""
+        codec.validate()
+        self.codecs.append(codec)
+        return self
+
+    @property
+    def scale(self) -> ScaleFilter:
+        for flt in self.filters:
+            if isinstance(flt, ScaleFilter):
+                return flt
+        return None
+
+    def generate(self, as_str: bool = True, video_label: str = None):
+        """Options of this output, after the shared input options
 
+        :param video_label: Filtergraph pad carrying this output's video, otherwise the input's video is mapped
+        """
+        self.validate()
+        args = []
         if self.cleaned_data['vn']:
-            self._add_vn()
+            args.append("-vn")
+        else:
+            args.extend(["-map", "[%s]" % video_label if video_label else "0:v?"])
+        if self.cleaned_data['an']:
+            args.append("-an")
+        else:
+            args.extend(["-map", "0:a?"])
+        for codec in self.codecs:
+            args.extend(codec.generate(as_str=False))
+        for flt in self.filters:
+            if not isinstance(flt, ScaleFilter):
+                args.extend(flt.generate(as_str=False))
+        if self.cleaned_data['video_bitrate']:
+            args.extend(["-b:v", self.cleaned_data['video_bitrate']])
+        if self.cleaned_data['max_video_bitrate']:
+            args.extend(["-maxrate", self.cleaned_data['max_video_bitrate']])
+        if self.cleaned_data['buffer_size']:
+            args.extend(["-bufsize", self.cleaned_data['buffer_size']])
+        if self.cleaned_data['audio_bitrate']:
+            args.extend(["-b:a", self.cleaned_data['audio_bitrate']])
+        args.append(_Quoted(self.cleaned_data['output']))
+        return " ".join(args) if as_str else args
+
+
+class MultiOutputCommand(Command):
+    """Decodes the input once and writes several outputs, e.g. an encoding ladder
+
+        cmd = MultiOutputCommand(input="input.mp4", overwrite=True)
+        for height, bitrate in ((1080, "5M"), (720, "3M"), (480, "1M")):
+            output = Output(output="%dp.mp4" % height, video_bitrate=bitrate)
+            output.add_codec(Codec(codec="libx264", stream=StreamSpecifier.Video))
+            output.add_filter(ScaleFilter(height=height, width=-2))
+            cmd.add_output(output)
+
+    The scaled outputs share the decoded video through a `split` in `-filter_complex`. The command's own
+    output options (duration, positions, ...) and bitstream filters apply to every output. Filters and a
+    filtergraph of the command itself are not supported, filters belong to the outputs.
+    """
 
-        if self.cleaned_data['aspect']:
-            self._add_aspect()
+    def __init__(self, **kwargs):
+        self.outputs = []
+        super(MultiOutputCommand, self).__init__(**kwargs)
 
-        # Add Codecs
-        self._add_codecs()
+    output = None
 
-        # Add Filters
-        self._add_filters()
+    def add_output(self, output: Output):
+        output.validate()
+        self.outputs.append(output)
+        return self
 
-        # Add Output File
-        self._add_output_file()
+    def clone(self, **kwargs):
+        """Copy of the command with the given options replaced, codecs, filters and outputs are shared"""
+        command = super(MultiOutputCommand, self).clone(**kwargs)
+        command.outputs = list(self.outputs)
+        return command
+
+    def add_filter(self, flt: BaseFilter or FilterNode):
+        self._check_filter(flt)
+        return super(MultiOutputCommand, self).add_filter(flt)
+
+    def set_filter_complex(self, graph: FilterGraph):
+        raise ValueError("%s builds its own -filter_complex, add filters to the outputs." % self.__class__.__name__)
+
+    def _check_filter(self, flt):
+        # A stream filtered by -filter can not come out of the split graph too, ffmpeg rejects that
+        if isinstance(flt, (FilterNode, ScaleFilter)):
+            raise ValueError("%s can not filter every output, add %s to the outputs." % (
+                self.__class__.__name__, flt.__class__.__name__))
+
+    def _filter_complex(self):
+        """The split and scale graph and the video pad label of each output"""
+        scaled = [i for i, output in enumerate(self.outputs)
+                  if output.scale is not None and not output.cleaned_data['vn']]
+        labels = [None] * len(self.outputs)
+        if not scaled:
+            return None, labels
+        graph = FilterGraph()
+        if len(scaled) > 1:
+            graph.chain(FilterNode("split", len(scaled)), inputs=["0:v"], outputs=["s%d" % i for i in scaled])
+        for i in scaled:
+            labels[i] = "v%d" % i
+            graph.chain(FilterNode.parse(self.outputs[i].scale.expression()),
+                        inputs=["s%d" % i if len(scaled) > 1 else "0:v"], outputs=[labels[i]])
+        return graph.optimize(), labels
 
-        # Generate Command
-        return " ".join(self.args) if as_str else self.args
+    def generate(self, as_str: bool = True) -> str or []:
+        command = self.core()
+        if not self.outputs:
+            raise ValueError("%s has no outputs." % self.__class__.__name__)
+        if command.filter_complex:
+            raise ValueError("%s builds its own -filter_complex, add filters to the outputs." %
+                             self.__class__.__name__)
+        for flt in self.filters:
+            self._check_filter(flt)
+
+        command.args = [command.path]
+        command._add_input()
+        graph, labels = self._filter_complex()
+        if graph:
+            command.args.extend(["-filter_complex", _Quoted(str(graph))])
+        for output, label in zip(self.outputs, labels):
+            command._add_output_options()
+            command._add_codecs()
+            command._add_filters()
+            command.args.extend(output.generate(as_str=False, video_label=label))
+
+        return command._render(as_str)
+
+    def run(self, **kwargs) -> runner.Result:
+        """Runs the command and waits for it, see `runner.run` for the options"""
+        return runner.run(self.generate(as_str=False), **self.core()._run_options(kwargs))
+
+    async def run_async(self, **kwargs) -> runner.Result:
+        """Runs the command from an event loop, see `runner.run_async` for the options"""
+        return await runner.run_async(self.generate(as_str=False), **self.core()._run_options(kwargs))
@@ -0,0 +1,134 @@
+import bisect
+import hashlib
+import mmap
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from logging import getLogger
+
+from . import runner, settings
+from .ffprobe import probe_key
+from .utils import evict_lru
+
+logger = getLogger("ffmpeg.keyframes")
+
+# Loaded indexes kept in memory, the data itself is memory mapped.
+KEYFRAME_INDEX_CACHE_SIZE = 128
+
+
+class KeyframeIndex:
+    """Sorted presentation timestamps (as seconds) of the keyframes of one video stream
+
+    Stored as a flat array of doubles, on disk it is the raw array so `load` can memory map it and lookups touch
+    only the pages bisect visits.
+    """
+
+    def __init__(self, timestamps):
+        self.timestamps = timestamps
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, item):
+        return self.timestamps[item]
+
+    def __iter__(self):
+        return iter(self.timestamps)
+
+    def __repr__(self):
+        return "<KeyframeIndex %d keyframes>" % len(self)
+
+    def before(self, seconds: float) -> float:
+        """Timestamp of the last keyframe at or before `seconds`, 0 when there is none"""
+        i = bisect.bisect_right(self.timestamps, seconds + 1e-6)
+        return self.timestamps[i - 1] if i else 0.0
+
+    def after(self, seconds: float):
+        """Timestamp of the first keyframe at or after `seconds`, None when there is none"""
+        i = bisect.bisect_left(self.timestamps, seconds - 1e-6)
+        return self.timestamps[i] if i < len(self.timestamps) else None
+
+    @classmethod
+    def build(cls, path: str, stream: str = "v:0"):
+        """Reads the key packet timestamps with ffprobe, without decoding"""
+        args = [settings.get("FFPROBE_PATH"), "-v", "error", "-select_streams", stream,
+                "-show_entries", "packet=pts_time,flags", "-print_format", "csv=p=0", "-i", path]
+        timestamps = array("d")
+        stderr = runner._StderrCollector()
+        with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as ps:
+            # Read alongside stdout, ffprobe would block on a full stderr pipe of a damaged input
+            reader = threading.Thread(target=runner._drain, args=(ps.stderr, stderr.feed), daemon=True)
+            reader.start()
+            try:
+                for line in ps.stdout:
+                    pts_time, _, flags = line.partition(b",")
+                    if b"K" in flags and pts_time != b"N/A":
+                        timestamps.append(float(pts_time))
+            except BaseException:
+                runner._terminate(ps)
+                raise
+            finally:
+                reader.join()
+            if ps.wait() != 0:
+                raise subprocess.CalledProcessError(ps.returncode, args, stderr=stderr.text)
+        # Packets come in decoding order
+        return cls(array("d", sorted(timestamps)))
+
+    def save(self, path: str):
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            array("d", self.timestamps).tofile(f)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(array("d"))
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(memoryview(mapped).cast("d"))
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_keyframe_index(path: str, stream: str = "v:0", cache_dir: str = settings.DEFAULT) -> KeyframeIndex:
+    """Keyframe index of a file, built once and cached by path, size, mtime and inode
+
+    Indexes are kept in memory for the most recently used files and as memory mappable files under
+    `cache_dir`/keyframes, of which the least recently used are removed above FFMPEG_KEYFRAME_CACHE_SIZE bytes.
+    """
+    key = hashlib.sha1((probe_key(path) + "|" + stream).encode("utf-8")).hexdigest()
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+
+    cache_dir = settings.resolve(cache_dir, "FFMPEG_CACHE_DIR")
+    cache_file = os.path.join(cache_dir, "keyframes", key + ".f64") if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        index = KeyframeIndex.load(cache_file)
+        # The access time orders the files for eviction
+        os.utime(cache_file, (time.time(), os.stat(cache_file).st_mtime))
+    else:
+        index = KeyframeIndex.build(path, stream)
+        if cache_file:
+            try:
+                index.save(cache_file)
+                evict_lru(os.path.dirname(cache_file), settings.get("FFMPEG_KEYFRAME_CACHE_SIZE"))
+            except OSError:
+                logger.warning("Could not write keyframe index to %s", cache_file, exc_info=True)
+
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > KEYFRAME_INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
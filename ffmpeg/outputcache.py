@@ -0,0 +1,202 @@
+"""Outputs of finished commands kept on disk, so running the same command on the same input again costs a link
+
+    cache = OutputCache()
+    result = cache.run(Command(input="input.mp4", output="output.mp4", overwrite=True))
+
+An entry is found by the `fingerprint` of the input, the argument list with the input and output paths left out
+and the version of ffmpeg, so a copy of an input under another name hits as well. The fingerprint hashes the size
+and a few sampled blocks instead of reading the whole input, an edit that keeps the size and misses every block
+goes unnoticed.
+
+Outputs are hard links of the entries where the file system allows it, otherwise copies. Entries are never
+written through: an existing output that is a link is removed before ffmpeg writes it. The least recently used
+entries are removed once the entries take more than `max_size` bytes.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from logging import getLogger
+
+from . import core, settings
+from .utils import cache_entries, evict_lru
+
+logger = getLogger("ffmpeg.outputcache")
+
+# Blocks of the input hashed by `fingerprint`, and their size
+FINGERPRINT_BLOCKS = 16
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def fingerprint(path: str, blocks: int = FINGERPRINT_BLOCKS, block_size: int = FINGERPRINT_BLOCK_SIZE) -> str:
+    """Size and hash of `blocks` evenly spaced blocks of a file, which includes its first and last block
+
+    Files up to `blocks * block_size` bytes are hashed whole.
+    """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode("ascii"))
+    with open(path, "rb") as f:
+        if size <= blocks * block_size:
+            digest.update(f.read())
+        else:
+            step = (size - block_size) / float(blocks - 1)
+            for i in range(blocks):
+                f.seek(int(i * step))
+                digest.update(f.read(block_size))
+    return "%d:%s" % (size, digest.hexdigest())
+
+
+def _version(path: str) -> str:
+    from .ffmpeg import CapabilityRegistry, capabilities
+
+    if path == capabilities.path:
+        return capabilities.version
+    with _registries_lock:
+        registry = _registries.setdefault(path, CapabilityRegistry(path=path))
+    return registry.version
+
+
+def _extension(path: str) -> str:
+    return os.path.splitext(path)[1].lower()
+
+
+class OutputCache:
+    """Outputs by input fingerprint, arguments and ffmpeg version in `directory`
+
+    :param directory: Where entries are kept, FFMPEG_CACHE_DIR/outputs by default. None disables the cache.
+    :param max_size: Bytes the entries may take, FFMPEG_OUTPUT_CACHE_SIZE by default
+    :param link: Hard link outputs to entries, copy them when False
+    """
+
+    def __init__(self, directory: str = settings.DEFAULT, max_size: int = settings.DEFAULT, link: bool = True):
+        self._directory = directory
+        self._max_size = max_size
+        self.link = link
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def directory(self) -> str:
+        if self._directory is settings.DEFAULT:
+            cache_dir = settings.get("FFMPEG_CACHE_DIR")
+            return os.path.join(cache_dir, "outputs") if cache_dir else None
+        return self._directory
+
+    @property
+    def max_size(self) -> int:
+        return settings.resolve(self._max_size, "FFMPEG_OUTPUT_CACHE_SIZE")
+
+    @staticmethod
+    def cacheable(command: core.Command) -> bool:
+        """Whether the command reads a regular file and writes a single file"""
+        return (command.input not in core.PIPE_INPUTS and command.output not in core.PIPE_OUTPUTS
+                and "%" not in command.output and os.path.isfile(command.input))
+
+    def key(self, command: core.Command) -> str:
+        args = command.generate(as_str=False)
+        canonical = []
+        for i, arg in enumerate(args[1:-1], 1):
+            if arg in ("-y", "-n"):
+                continue  # Whether an existing output is overwritten does not change it
+            canonical.append("<input>" if arg == command.input and args[i - 1] == "-i" else arg)
+        canonical.append("<output>" + _extension(command.output))
+        data = [fingerprint(command.input), canonical, _version(command.path)]
+        return hashlib.sha256(json.dumps(data).encode("utf-8")).hexdigest()
+
+    def _entry(self, key: str, output: str) -> str:
+        return os.path.join(self.directory, key + _extension(output))
+
+    def _place(self, source: str, destination: str):
+        """Links or copies `source` to `destination` through a temporary file, replacing what was there"""
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(destination)), suffix=".tmp")
+        os.close(fd)
+        try:
+            if self.link:
+                os.unlink(tmp)
+                try:
+                    os.link(source, tmp)
+                except OSError:
+                    # Another file system, or one without hard links
+                    shutil.copyfile(source, tmp)
+            else:
+                shutil.copyfile(source, tmp)
+            os.replace(tmp, destination)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def get(self, command, overwrite: bool = None) -> str:
+        """Puts the cached output of `command` at its output path and returns it, None on a miss
+
+        :param command: A `generator.Command` or `core.Command`
+        :param overwrite: Replace an existing output, `command.overwrite` by default
+        """
+        command = command if isinstance(command, core.Command) else command.core()
+        if not self.directory or not self.cacheable(command):
+            return None
+        entry = self._entry(self.key(command), command.output)
+        if not os.path.exists(entry):
+            return None
+        if os.path.exists(command.output) and not (command.overwrite if overwrite is None else overwrite):
+            raise FileExistsError("%s already exists." % command.output)
+        self._place(entry, command.output)
+        # The access time orders entries for eviction, the modification time belongs to the output as well
+        now = time.time()
+        os.utime(entry, (now, os.stat(entry).st_mtime))
+        return command.output
+
+    def put(self, command) -> str:
+        """Keeps the output `command` wrote and returns the entry's path, None when the command is not cacheable"""
+        command = command if isinstance(command, core.Command) else command.core()
+        if not self.directory or not self.cacheable(command) or not os.path.isfile(command.output):
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        entry = self._entry(self.key(command), command.output)
+        self._place(command.output, entry)
+        self.evict()
+        return entry
+
+    def size(self) -> int:
+        """Bytes the entries take, including those shared with outputs through hard links"""
+        return sum(size for _, size, _ in cache_entries(self.directory))
+
+    def evict(self, max_size: int = None):
+        """Removes the least recently used entries until the rest take at most `max_size` bytes"""
+        evict_lru(self.directory, self.max_size if max_size is None else max_size)
+
+    def clear(self):
+        self.evict(0)
+
+    def run(self, command, **kwargs) -> "runner.Result":
+        """Takes the output from the cache or runs the command and keeps its output, see `runner.run` for the options
+
+        A hit returns a `runner.Result` without stderr or usage.
+        """
+        from . import runner
+
+        command = command if isinstance(command, core.Command) else command.core()
+        if not self.directory or not self.cacheable(command):
+            return command.run(**kwargs)
+        started = time.monotonic()
+        if self.get(command):
+            self.hits += 1
+            logger.debug("%s taken from the output cache", command.output)
+            return runner.Result(command.generate(as_str=False), 0, b"", "", time.monotonic() - started)
+        self.misses += 1
+        if command.overwrite and os.path.isfile(command.output) and os.stat(command.output).st_nlink > 1:
+            # ffmpeg truncates the file it overwrites, which would change the entry it is linked to
+            os.unlink(command.output)
+        result = command.run(**kwargs)
+        if result.returncode == 0:
+            try:
+                self.put(command)
+            except OSError:
+                logger.warning("Could not keep %s in the output cache", command.output, exc_info=True)
+        return result
@@ -0,0 +1,112 @@
+import time
+
+# Keys of the `-progress` stream that are kept as numbers
+_INTEGERS = ("frame", "total_size", "out_time_us", "out_time_ms", "dup_frames", "drop_frames")
+_FLOATS = ("fps",)
+
+
+class Progress:
+    """A single report of the `-progress` stream
+
+    :param out_time: Seconds of media written so far
+    :param bitrate: Current output bitrate as kbit/s
+    :param speed: Media seconds encoded per wall second (1.0 is real time)
+    :param total_size: Bytes written so far
+    :param eta: Estimated wall seconds until the end, None when the duration is unknown
+    :param end: True for the last report of the run
+    """
+
+    __slots__ = ("frame", "fps", "bitrate", "speed", "total_size", "out_time", "duration", "elapsed", "eta", "end")
+
+    def __init__(self, frame=None, fps=None, bitrate=None, speed=None, total_size=None, out_time=None,
+                 duration=None, elapsed=None, eta=None, end=False):
+        self.frame = frame
+        self.fps = fps
+        self.bitrate = bitrate
+        self.speed = speed
+        self.total_size = total_size
+        self.out_time = out_time
+        self.duration = duration
+        self.elapsed = elapsed
+        self.eta = eta
+        self.end = end
+
+    @property
+    def percent(self):
+        if not self.duration or self.out_time is None:
+            return None
+        return min(100.0, 100.0 * self.out_time / self.duration)
+
+    def __repr__(self):
+        return "<Progress out_time=%s frame=%s speed=%s eta=%s end=%s>" % (
+            self.out_time, self.frame, self.speed, self.eta, self.end)
+
+
+def _number(value: str, cast):
+    try:
+        return cast(value.strip().rstrip("x").replace("kbits/s", ""))
+    except ValueError:
+        return None  # "N/A"
+
+
+class ProgressParser:
+    """Incremental parser for the key=value blocks FFmpeg writes with `-progress`
+
+    Feed it lines as they arrive; every block ends with a `progress=continue|end` line which produces a `Progress`.
+
+    :param duration: Expected output duration as seconds, enables `Progress.eta` and `Progress.percent`
+    :param on_progress: Called with every `Progress`
+    """
+
+    def __init__(self, duration: float = None, on_progress=None):
+        self.duration = duration
+        self.on_progress = on_progress
+        self.last = None
+        self.started = time.monotonic()
+        self.last_advance = self.started
+        self._values = {}
+
+    @property
+    def stalled_for(self) -> float:
+        """Seconds since the output time last moved forward"""
+        return time.monotonic() - self.last_advance
+
+    def feed(self, line: str):
+        key, sep, value = line.partition("=")
+        if not sep:
+            return None
+        key = key.strip()
+        if key != "progress":
+            self._values[key] = value.strip()
+            return None
+        values, self._values = self._values, {}
+        return self._emit(values, value.strip() == "end")
+
+    def _emit(self, values: dict, end: bool) -> Progress:
+        now = time.monotonic()
+        numbers = {key: _number(values[key], int) for key in _INTEGERS if key in values}
+        numbers.update((key, _number(values[key], float)) for key in _FLOATS if key in values)
+        # Older builds only write out_time_ms, which despite its name is in microseconds as well
+        out_time_us = numbers.get("out_time_us", numbers.get("out_time_ms"))
+        out_time = out_time_us / 1000000 if out_time_us is not None else None
+        speed = _number(values["speed"], float) if "speed" in values else None
+
+        if out_time is not None and (self.last is None or self.last.out_time is None or out_time > self.last.out_time):
+            self.last_advance = now
+
+        elapsed = now - self.started
+        eta = None
+        if end:
+            eta = 0.0
+        elif self.duration and out_time is not None:
+            rate = speed or (out_time / elapsed if elapsed > 0 else None)
+            if rate:
+                eta = max(0.0, (self.duration - out_time) / rate)
+
+        self.last = Progress(frame=numbers.get("frame"), fps=numbers.get("fps"),
+                             bitrate=_number(values["bitrate"], float) if "bitrate" in values else None,
+                             speed=speed, total_size=numbers.get("total_size"), out_time=out_time,
+                             duration=self.duration, elapsed=elapsed, eta=eta, end=end)
+        if self.on_progress:
+            self.on_progress(self.last)
+        return self.last
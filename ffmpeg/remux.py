@@ -0,0 +1,200 @@
+"""Stream copies for streams that already match what a command would encode them to
+
+    cmd = Command(input="input.mp4", output="output.mp4")
+    cmd.add_codec(Codec(codec="libx264", stream=StreamSpecifier.Video))
+    cmd.add_codec(Codec(codec="aac", stream=StreamSpecifier.Audio))
+    cmd.add_filter(ScaleFilter(width=1280, height=-2))
+
+    plan = plan_copy(cmd, pix_fmt="yuv420p", max_video_bitrate="5M")
+    plan.command.run()  # -c:v copy when the input is already 720p h264 yuv420p under 5 Mbit/s
+
+A stream is copied when the input's first stream of that kind has the codec of the requested encoder, every
+filter of the stream leaves it unchanged (e.g. a scale to its own size) and it is within the given pixel format and
+bitrate limits. Copies are about a hundred times faster than encodes, but they cut at keyframes only, so a video
+stream is not copied when the command seeks or trims.
+"""
+import copy
+import re
+
+from . import core
+from .ffmpeg import get_capabilities
+from .filtergraph import FilterNode, _is_noop
+
+_BITRATE = re.compile(r"^(\d+(?:\.\d+)?)([kKmM]?)$")
+_INTEGER = re.compile(r"^-?\d+$")
+
+
+def _bitrate(value) -> int:
+    """Bits per second of 5000000, "5M" or "128k" """
+    if value is None or isinstance(value, int):
+        return value
+    match = _BITRATE.match(str(value).strip())
+    if not match:
+        raise ValueError("Not a bitrate: %r" % value)
+    number, unit = match.groups()
+    return int(float(number) * {'': 1, 'k': 1000, 'm': 1000000}[unit.lower()])
+
+
+def _number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _dimension(value: str, width: int, height: int):
+    if value in ("iw", "in_w"):
+        return width
+    if value in ("ih", "in_h"):
+        return height
+    if value is not None and _INTEGER.match(value):
+        return int(value)
+    return None
+
+
+def _keeps_size(node: FilterNode, width: int, height: int) -> bool:
+    """Whether the scale `node` outputs frames of `width`x`height` for an input of that size"""
+    extra = [key for key, _ in node.args if key not in (None, "w", "width", "h", "height", "flags",
+                                                        "force_original_aspect_ratio")]
+    if extra:
+        return False
+    w = _dimension(node.option(0, "w", "width"), width, height)
+    h = _dimension(node.option(1, "h", "height"), width, height)
+    if w is None or h is None:
+        return False
+    # -1 keeps the aspect ratio, -2 also rounds to an even size
+    if w < 0 and h < 0:
+        return True
+    if w < 0:
+        return h == height and (w == -1 or width % 2 == 0)
+    if h < 0:
+        return w == width and (h == -1 or height % 2 == 0)
+    return w == width and h == height
+
+
+def _unchanged(node: FilterNode, stream: dict) -> bool:
+    if _is_noop(node):
+        return True
+    return node.name == "scale" and _keeps_size(node, _number(stream.get('width')), _number(stream.get('height')))
+
+
+def _source_streams(attributes: dict) -> dict:
+    """First video and audio stream of `get_file_attributes` output, cover art does not count as video"""
+    streams = {}
+    for stream in attributes.get('streams', []):
+        kind = stream.get('codec_type')
+        if kind == "video" and stream.get('disposition', {}).get('attached_pic'):
+            continue
+        if kind in ("video", "audio"):
+            streams.setdefault(kind[0], stream)
+    return streams
+
+
+def _stream_bitrate(stream: dict, attributes: dict) -> int:
+    # Matroska and others report no per stream bitrate, the overall bitrate is an upper bound for every stream
+    return _number(stream.get('bit_rate')) or _number(attributes.get('format', {}).get('bit_rate'))
+
+
+class CopyPlan:
+    """`command` with conforming streams copied, `reasons` says why the others are encoded"""
+
+    __slots__ = ("command", "copied", "reasons")
+
+    def __init__(self, command: core.Command, copied: list, reasons: dict):
+        self.command = command
+        self.copied = copied  # Stream specifiers, "v" and "a"
+        self.reasons = reasons  # Stream specifier -> why it is encoded
+
+    @property
+    def remux(self) -> bool:
+        """Nothing is encoded"""
+        return bool(self.copied) and not self.reasons
+
+    def __repr__(self):
+        return "<CopyPlan copied=%s reasons=%s>" % (self.copied, self.reasons)
+
+
+def _mismatch(stream_type: str, codec: core.Codec, command: core.Command, source: dict, attributes: dict,
+              limits: dict, table) -> str:
+    """Why the `source` stream can not be copied instead of encoded with `codec`, None if it can"""
+    if source is None:
+        return "the input has no such stream"
+    target = table.encoders.get(codec.codec, codec.codec)
+    if source.get('codec_name') != target:
+        return "%s is not %s" % (source.get('codec_name'), target)
+    bitrate = _stream_bitrate(source, attributes)
+    limit = limits.get('max_bitrate')
+    if limit is not None and (bitrate is None or bitrate > limit):
+        return "bitrate %s is over %s" % (bitrate, limit)
+    if stream_type == "v":
+        if command.filter_complex:
+            return "a filter_complex is used"
+        if command.ss_position or command.to_position or command.sseof_position or command.duration:
+            return "copies can only cut at keyframes"
+        if command.aspect:
+            return "the aspect ratio is changed"
+        pix_fmt = limits.get('pix_fmt')
+        if pix_fmt and source.get('pix_fmt') != pix_fmt:
+            return "pixel format %s is not %s" % (source.get('pix_fmt'), pix_fmt)
+        for flt in filter(_is_video_filter, command.filters):
+            node = FilterNode.parse(flt.expression()) if isinstance(flt, core.ScaleFilter) else flt
+            if not _unchanged(node, source):
+                return "%s changes the frames" % node
+    else:
+        for name in ("sample_rate", "channels"):
+            wanted = limits.get(name)
+            if wanted and _number(source.get(name)) != wanted:
+                return "%s %s is not %s" % (name.replace("_", " "), source.get(name), wanted)
+    return None
+
+
+def _is_video_filter(flt) -> bool:
+    return isinstance(flt, FilterNode) or (isinstance(flt, core.ScaleFilter) and flt.stream == "v")
+
+
+def plan_copy(command, attributes: dict = None, pix_fmt: str = None, max_video_bitrate=None,
+              max_audio_bitrate=None, sample_rate: int = None, channels: int = None, table=None) -> CopyPlan:
+    """Rewrites the encoders of `command` to stream copies where the input already conforms
+
+    Only codecs with a "v" or "a" stream specifier are considered, the video filters are dropped with the video
+    encoder. The command itself is not changed.
+    :param command: A `generator.Command` or `core.Command`
+    :param attributes: `get_file_attributes` of the input, probed when omitted
+    :param pix_fmt: Pixel format the video must have, e.g. yuv420p for players that decode nothing else
+    :param max_video_bitrate: Highest video bitrate as bits per second or like "5M"
+    :param max_audio_bitrate: Highest audio bitrate, like "128k"
+    :param sample_rate: Audio sample rate the output must have
+    :param channels: Audio channels the output must have
+    :param table: A `ffmpeg.CapabilityTable` to resolve encoders to codecs, that of the configured ffmpeg by default
+    """
+    if isinstance(command, core.Command):
+        command = copy.copy(command)
+    else:
+        command = command.core()
+    if attributes is None:
+        from .ffprobe import get_file_attributes
+
+        attributes = get_file_attributes(command.input)
+    table = table or get_capabilities()
+    sources = _source_streams(attributes)
+    limits = {
+        'v': {'pix_fmt': pix_fmt, 'max_bitrate': _bitrate(max_video_bitrate)},
+        'a': {'max_bitrate': _bitrate(max_audio_bitrate), 'sample_rate': sample_rate, 'channels': channels},
+    }
+
+    codecs, copied, reasons = [], [], {}
+    for codec in command.codecs:
+        if codec.copy or codec.before_input or codec.stream not in limits:
+            codecs.append(codec)
+            continue
+        reason = _mismatch(codec.stream, codec, command, sources.get(codec.stream), attributes,
+                           limits[codec.stream], table)
+        if reason:
+            reasons[codec.stream] = reason
+            codecs.append(codec)
+        else:
+            copied.append(codec.stream)
+            codecs.append(core.Codec(copy=True, stream=codec.stream))
+    command.codecs = codecs
+    command.filters = [flt for flt in command.filters if "v" not in copied or not _is_video_filter(flt)]
+    return CopyPlan(command, copied, reasons)
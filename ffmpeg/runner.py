@@ -0,0 +1,717 @@
+import asyncio
+import inspect
+import io
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from logging import getLogger
+
+from .progress import ProgressParser
+
+logger = getLogger("ffmpeg.runner")
+
+# Seconds a process gets to exit after SIGTERM before it is killed.
+TERMINATE_GRACE_PERIOD = 5
+
+# Size of a single read from the process pipes, and of a chunk written to stdin unless `buffer_size` is given.
+READ_SIZE = 64 * 1024
+
+# Seconds between the /proc samples of `run_async`, which can not wait for the process itself
+USAGE_SAMPLE_INTERVAL = 0.5
+
+# Last stderr lines kept in `Result.stderr` and `CommandError.stderr`, a verbose loglevel writes millions of them
+STDERR_LINES = 200
+
+# Lines looking like errors kept besides the last ones, the first of them usually name the cause
+STDERR_ERROR_LINES = 50
+
+# Bytes of a stderr line kept, the rest of a longer line is dropped
+STDERR_LINE_LENGTH = 4096
+
+# Lines worth keeping from anywhere in stderr
+ERROR_LINE = re.compile(r"error|invalid|fail|could not|cannot|unable|not found|no such|unknown|unsupported|"
+                        r"not supported|does not support|no space|quota|denied|received signal", re.IGNORECASE)
+
+
+class CommandError(Exception):
+    """FFmpeg exited with a non-zero status"""
+
+    # `ResourceUsage` of the failed process, when it was measured
+    usage = None
+
+    # Whether running the command again may succeed, see `classify_error`
+    retryable = True
+
+    def __init__(self, command: list, returncode: int, stderr: str, message: str = None, errors=()):
+        self.command = command
+        self.returncode = returncode
+        self.stderr = stderr  # The lines that look like errors and the last lines, see `STDERR_LINES`
+        self.errors = list(errors)  # The lines that look like errors
+        super(CommandError, self).__init__(message or "Command exited with status %s: %s\n%s" % (
+            returncode, " ".join(command), stderr))
+
+
+class InvalidInput(CommandError):
+    """The input is missing, truncated or not media FFmpeg can read"""
+
+    retryable = False
+
+
+class UnsupportedCodec(CommandError):
+    """The build has no such encoder or decoder, or the output format can not hold the stream"""
+
+    retryable = False
+
+
+class DiskFull(CommandError):
+    """The output could not be written for lack of space"""
+
+
+class CommandKilled(CommandError):
+    """FFmpeg was ended by a signal it did not get from this module, e.g. by the OOM killer or a shutdown"""
+
+
+# Exception of a failed command by the stderr lines that identify it, the first match wins
+ERROR_CLASSES = (
+    (DiskFull, re.compile(r"No space left on device|Disk quota exceeded")),
+    (UnsupportedCodec, re.compile(r"Unknown (?:en|de)coder|(?:En|De)coder not found|does not support any stream|"
+                                  r"codec not currently supported in container|Could not find tag for codec")),
+    (InvalidInput, re.compile(r"Error opening input|Invalid data found when processing input|moov atom not found|"
+                              r"Could not find codec parameters")),
+)
+
+
+def classify_error(returncode: int, lines) -> type:
+    """`CommandError` subclass for a process that exited with `returncode` and wrote `lines` to stderr"""
+    lines = list(lines)
+    if returncode is not None and returncode < 0:
+        return CommandKilled
+    for cls, pattern in ERROR_CLASSES:
+        if any(pattern.search(line) for line in lines):
+            return cls
+    # ffmpeg exits with 255 once a signal interrupted it
+    if returncode == 255 and any("received signal" in line for line in lines):
+        return CommandKilled
+    return CommandError
+
+
+class CommandTimeout(CommandError):
+    """FFmpeg did not finish in time and was terminated"""
+
+    def __init__(self, command: list, timeout: float, stderr: str):
+        self.timeout = timeout
+        super(CommandTimeout, self).__init__(command, None, stderr, "Command timed out after %s seconds: %s" % (
+            timeout, " ".join(command)))
+
+
+class CommandStalled(CommandTimeout):
+    """FFmpeg stopped making progress and was terminated"""
+
+    def __init__(self, command: list, timeout: float, stderr: str):
+        super(CommandStalled, self).__init__(command, timeout, stderr)
+        Exception.__init__(self, "Command made no progress for %s seconds: %s" % (timeout, " ".join(command)))
+
+
+class CommandCancelled(CommandError):
+    """The run was cancelled and FFmpeg was terminated"""
+
+    def __init__(self, command: list, stderr: str):
+        super(CommandCancelled, self).__init__(command, None, stderr, "Command cancelled: %s" % " ".join(command))
+
+
+class ResourceUsage:
+    """What a process cost, the I/O counters are None where /proc/<pid>/io is not available
+
+    `read_bytes` and `write_bytes` reached the storage layer, `read_chars` and `write_chars` count every read and
+    write call including pipes and the page cache. `sampled` usage is the last of periodic samples taken while the
+    process ran, which misses its final moments.
+    """
+
+    __slots__ = ("user_time", "system_time", "max_rss", "wall_time", "read_bytes", "write_bytes", "read_chars",
+                 "write_chars", "sampled")
+
+    def __init__(self, user_time: float = 0.0, system_time: float = 0.0, max_rss: int = 0, wall_time: float = 0.0,
+                 read_bytes: int = None, write_bytes: int = None, read_chars: int = None, write_chars: int = None,
+                 sampled: bool = False):
+        self.user_time = user_time  # CPU seconds
+        self.system_time = system_time
+        self.max_rss = max_rss  # Peak resident set as bytes
+        self.wall_time = wall_time
+        self.read_bytes = read_bytes
+        self.write_bytes = write_bytes
+        self.read_chars = read_chars
+        self.write_chars = write_chars
+        self.sampled = sampled
+
+    @property
+    def cpu_time(self) -> float:
+        return self.user_time + self.system_time
+
+    def __repr__(self):
+        return "<ResourceUsage cpu=%.3f wall=%.3f max_rss=%d read=%s write=%s>" % (
+            self.cpu_time, self.wall_time, self.max_rss, self.read_bytes, self.write_bytes)
+
+
+class Result:
+    __slots__ = ("args", "returncode", "stdout", "stderr", "duration", "usage")
+
+    def __init__(self, args: list, returncode: int, stdout: bytes, stderr: str, duration: float,
+                 usage: ResourceUsage = None):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.duration = duration  # Wall time as seconds
+        self.usage = usage
+
+    def __repr__(self):
+        return "<Result returncode=%s duration=%.3f>" % (self.returncode, self.duration)
+
+
+def _read_proc_io(pid: int, usage: ResourceUsage):
+    try:
+        with open("/proc/%d/io" % pid) as f:
+            counters = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return
+    usage.read_bytes = int(counters.get('read_bytes', 0))
+    usage.write_bytes = int(counters.get('write_bytes', 0))
+    usage.read_chars = int(counters.get('rchar', 0))
+    usage.write_chars = int(counters.get('wchar', 0))
+
+
+def _max_rss(rusage) -> int:
+    # ru_maxrss is in kilobytes, except on macOS
+    return rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+
+
+class _Reaper:
+    """Waits for the process in a thread and takes its resource usage while doing so
+
+    The exited process is left a zombie with `waitid(WNOWAIT)` so /proc/<pid>/io can still be read, then
+    `wait4` reaps it and returns its rusage.
+    """
+
+    def __init__(self, process: subprocess.Popen, started: float):
+        self.process = process
+        self.started = started
+        self.returncode = None
+        self.usage = None
+        self.done = threading.Event()
+        self._thread = threading.Thread(target=self._wait, daemon=True)
+        self._thread.start()
+
+    def _wait(self):
+        pid = self.process.pid
+        try:
+            if not hasattr(os, "wait4"):
+                self.returncode = self.process.wait()
+                return
+            usage = ResourceUsage()
+            if hasattr(os, "waitid"):
+                os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+                _read_proc_io(pid, usage)
+            _, status, rusage = os.wait4(pid, 0)
+            usage.wall_time = time.monotonic() - self.started
+            usage.user_time, usage.system_time = rusage.ru_utime, rusage.ru_stime
+            usage.max_rss = _max_rss(rusage)
+            self.returncode = os.waitstatus_to_exitcode(status)
+            self.usage = usage
+        except ChildProcessError:
+            # Reaped by `Popen` first, while it was being terminated
+            self.returncode = self.process.returncode
+        finally:
+            self.done.set()
+
+    def join(self):
+        self._thread.join()
+        if self.process.returncode is None or self.usage is not None:
+            self.process.returncode = self.returncode
+
+
+def _sample_proc(pid: int, usage: ResourceUsage):
+    """Updates `usage` from /proc while the process runs"""
+    with open("/proc/%d/stat" % pid) as f:
+        # The command name may contain spaces, the fields after it do not
+        fields = f.read().rsplit(")", 1)[1].split()
+    ticks = os.sysconf("SC_CLK_TCK")
+    usage.user_time, usage.system_time = int(fields[11]) / ticks, int(fields[12]) / ticks
+    with open("/proc/%d/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                usage.max_rss = int(line.split()[1]) * 1024
+                break
+    _read_proc_io(pid, usage)
+
+
+def _try_sample_proc(pid: int, usage: ResourceUsage) -> bool:
+    try:
+        _sample_proc(pid, usage)
+        usage.sampled = True
+        return True
+    except (OSError, IndexError, ValueError):
+        # Exited, or no /proc
+        return False
+
+
+async def _sample_usage(pid: int, usage: ResourceUsage, interval: float = USAGE_SAMPLE_INTERVAL):
+    while _try_sample_proc(pid, usage):
+        await asyncio.sleep(interval)
+
+
+def _report_usage(on_usage, args: list, usage: ResourceUsage):
+    if on_usage is None or usage is None:
+        return
+    try:
+        on_usage(args, usage)
+    except Exception:
+        logger.exception("on_usage failed for %s", " ".join(args))
+
+
+class LineSplitter:
+    """Splits a byte stream into lines, FFmpeg ends its status lines with a bare carriage return
+
+    :param max_length: Bytes kept of a line, the rest of a longer line is dropped
+    """
+
+    _separator = re.compile(b"\r\n|\r|\n")
+
+    def __init__(self, max_length: int = None):
+        self.max_length = max_length
+        self._pending = b""
+        self._skipping = False
+
+    def feed(self, data: bytes) -> list:
+        lines = self._separator.split(self._pending + data)
+        self._pending = lines.pop()
+        if self.max_length is not None:
+            if self._skipping and lines:
+                # The first line ends the one whose start was already emitted
+                lines.pop(0)
+                self._skipping = False
+            lines = [line[:self.max_length] for line in lines]
+            if len(self._pending) > self.max_length:
+                if not self._skipping:
+                    lines.append(self._pending[:self.max_length])
+                self._pending = b""
+                self._skipping = True
+        return [line.decode("utf-8", "replace") for line in lines]
+
+    def flush(self) -> list:
+        pending, self._pending = self._pending, b""
+        if self._skipping:
+            self._skipping = False
+            return []
+        return [pending.decode("utf-8", "replace")] if pending else []
+
+
+class _StderrCollector:
+    """Keeps the last `STDERR_LINES` lines of stderr and the first `STDERR_ERROR_LINES` that look like errors"""
+
+    def __init__(self, on_stderr=None, max_lines: int = STDERR_LINES, max_errors: int = STDERR_ERROR_LINES):
+        self.on_stderr = on_stderr
+        self.max_errors = max_errors
+        self.count = 0
+        self._tail = deque(maxlen=max_lines)  # (number, line)
+        self._errors = []  # (number, line)
+        self._splitter = LineSplitter(STDERR_LINE_LENGTH)
+
+    def feed(self, data: bytes):
+        self._emit(self._splitter.feed(data) if data else self._splitter.flush())
+
+    def _emit(self, lines: list):
+        for line in lines:
+            if not line:
+                continue
+            self.count += 1
+            self._tail.append((self.count, line))
+            if len(self._errors) < self.max_errors and ERROR_LINE.search(line):
+                self._errors.append((self.count, line))
+            if self.on_stderr:
+                self.on_stderr(line)
+
+    @property
+    def errors(self) -> list:
+        return [line for _, line in self._errors]
+
+    @property
+    def text(self) -> str:
+        first = self._tail[0][0] if self._tail else self.count + 1
+        earlier = [(number, line) for number, line in self._errors if number < first]
+        lines = []
+        for i, (number, line) in enumerate(earlier):
+            # Marks where lines were dropped
+            if number > (earlier[i - 1][0] if i else 0) + 1:
+                lines.append("...")
+            lines.append(line)
+        if first > (earlier[-1][0] if earlier else 0) + 1:
+            lines.append("...")
+        lines.extend(line for _, line in self._tail)
+        return "\n".join(lines)
+
+    def error(self, args: list, returncode: int) -> CommandError:
+        """The `CommandError` subclass of a failure, see `classify_error`"""
+        cls = classify_error(returncode, self.errors + [line for _, line in self._tail])
+        return cls(args, returncode, self.text, errors=self.errors)
+
+
+class _ProgressReader:
+    """Reads the `-progress` stream from an extra pipe, the process keeps stdout and stderr for itself"""
+
+    def __init__(self, args: list, duration: float = None, on_progress=None):
+        self.parser = ProgressParser(duration, on_progress)
+        self._splitter = LineSplitter()
+        self.read_fd, self.write_fd = os.pipe()
+        self.args = [args[0], "-progress", "pipe:%d" % self.write_fd, "-nostats"] + list(args[1:])
+
+    def spawned(self):
+        # Only the child writes to the pipe, EOF arrives when it exits
+        os.close(self.write_fd)
+        self.write_fd = None
+
+    def open(self, buffering: int = -1):
+        stream = os.fdopen(self.read_fd, "rb", buffering)
+        self.read_fd = None
+        return stream
+
+    def feed(self, data: bytes):
+        for line in self._splitter.feed(data) if data else self._splitter.flush():
+            self.parser.feed(line)
+
+    def stalled(self, stall_timeout: float) -> bool:
+        return stall_timeout is not None and self.parser.stalled_for > stall_timeout
+
+    def close(self):
+        # Descriptors handed over to a stream are closed by it
+        for fd in (self.read_fd, self.write_fd):
+            if fd is not None:
+                os.close(fd)
+        self.read_fd = self.write_fd = None
+
+
+def _drain(stream, callback, size: int = READ_SIZE, errors: list = None):
+    """Reads `stream` into `callback` until EOF, an error of the callback ends up in `errors` when given"""
+    try:
+        while True:
+            data = stream.read1(size)
+            callback(data)
+            if not data:
+                break
+    except Exception as e:
+        if errors is None:
+            raise
+        errors.append(e)
+
+
+def _chunks(source, size: int):
+    """Chunks of a file-like object (read in `size` bytes), of bytes or of an iterable of bytes"""
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    if hasattr(source, "read"):
+        return iter(lambda: source.read(size), b"")
+    return source
+
+
+def _feed(source, stream, size: int, errors: list):
+    try:
+        for chunk in _chunks(source, size):
+            if chunk:
+                stream.write(chunk)
+    except BrokenPipeError:
+        # The process stopped reading, e.g. ffprobe once it has seen enough or ffmpeg failing
+        pass
+    except Exception as e:
+        errors.append(e)
+    finally:
+        try:
+            stream.close()
+        except BrokenPipeError:
+            pass
+
+
+def _writer(sink):
+    # Drain callbacks get b"" at the end of the stream
+    return lambda data: data and sink.write(data)
+
+
+def _terminate(process: subprocess.Popen, grace: float = TERMINATE_GRACE_PERIOD):
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(grace)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def run(args: list, timeout: float = None, on_stderr=None, cancel: threading.Event = None, check: bool = True,
+        capture_stdout: bool = False, on_progress=None, duration: float = None, stall_timeout: float = None,
+        stdin=None, stdout=None, buffer_size: int = READ_SIZE, on_usage=None) -> Result:
+    """Runs FFmpeg without a shell and waits for it
+
+    :param args: Argument list, see `Command.generate(as_str=False)`
+    :param timeout: Seconds before the process is terminated and `CommandTimeout` raised
+    :param on_stderr: Called with every stderr line as it arrives
+    :param cancel: Setting this event terminates the process and raises `CommandCancelled`
+    :param check: Raise `CommandError` on a non-zero exit status
+    :param capture_stdout: Keep stdout in `Result.stdout`, otherwise it is discarded
+    :param on_progress: Called with a `progress.Progress` for every report of `-progress`, which is added to the
+        command and written to a separate pipe
+    :param duration: Expected output duration as seconds, used for `Progress.eta`
+    :param stall_timeout: Seconds without progress before the process is terminated and `CommandStalled` raised
+    :param stdin: Data for `pipe:0`, a binary file-like object, bytes or an iterable of bytes
+    :param stdout: Binary file-like object `pipe:1` is written to, instead of capturing or discarding it. When its
+        `write` (or another callback) raises, the process is terminated and the exception raised.
+    :param buffer_size: Bytes read from or written to the process at once, stdin and stdout hold at most this much
+        besides the OS pipe buffers
+    :param on_usage: Called with the argument list and the `ResourceUsage` of the process once it exited, also when
+        it failed or was terminated. The usage is in `Result.usage` and `CommandError.usage` as well.
+    """
+    if capture_stdout and stdout is not None:
+        raise ValueError("stdout can either be captured or written to a stream")
+    started = time.monotonic()
+    stderr = _StderrCollector(on_stderr)
+    captured = []
+    progress = _ProgressReader(args, duration, on_progress) if on_progress or stall_timeout else None
+    if progress:
+        args = progress.args
+    try:
+        process = subprocess.Popen(args, stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+                                   stderr=subprocess.PIPE,
+                                   stdout=subprocess.PIPE if capture_stdout or stdout is not None
+                                   else subprocess.DEVNULL,
+                                   pass_fds=(progress.write_fd,) if progress else ())
+    except BaseException:
+        if progress:
+            progress.close()
+        raise
+    reaper = _Reaper(process, started)
+    streams = [(process.stderr, stderr.feed)]
+    if capture_stdout:
+        streams.append((process.stdout, captured.append))
+    elif stdout is not None:
+        streams.append((process.stdout, _writer(stdout)))
+    if progress:
+        progress.spawned()
+        streams.append((progress.open(), progress.feed))
+    # A callback or sink that fails stops its reader, the process is terminated before it blocks on the pipe
+    drain_errors = []
+    readers = [threading.Thread(target=_drain, args=stream + (buffer_size, drain_errors), daemon=True)
+               for stream in streams]
+    feed_errors = []
+    if stdin is not None:
+        readers.append(threading.Thread(target=_feed, args=(stdin, process.stdin, buffer_size, feed_errors),
+                                        daemon=True))
+    for reader in readers:
+        reader.start()
+
+    try:
+        deadline = started + timeout if timeout is not None else None
+        while not reaper.done.is_set():
+            if cancel is not None and cancel.is_set():
+                _terminate(process)
+                raise CommandCancelled(args, stderr.text)
+            if deadline is not None and time.monotonic() >= deadline:
+                _terminate(process)
+                raise CommandTimeout(args, timeout, stderr.text)
+            if progress and progress.stalled(stall_timeout):
+                _terminate(process)
+                raise CommandStalled(args, stall_timeout, stderr.text)
+            if drain_errors:
+                _terminate(process)
+                break
+            reaper.done.wait(0.1 if deadline is None else max(0, min(0.1, deadline - time.monotonic())))
+    except BaseException as e:
+        _terminate(process)
+        reaper.join()
+        if isinstance(e, CommandError):
+            e.usage = reaper.usage
+        raise
+    finally:
+        reaper.join()
+        _report_usage(on_usage, args, reaper.usage)
+        for reader in readers:
+            reader.join()
+        for stream, _ in streams:
+            stream.close()
+
+    if drain_errors:
+        raise drain_errors[0]
+    if feed_errors:
+        raise feed_errors[0]
+    result = Result(args, process.returncode, b"".join(captured), stderr.text, time.monotonic() - started,
+                    reaper.usage)
+    if check and result.returncode != 0:
+        error = stderr.error(args, result.returncode)
+        error.usage = result.usage
+        raise error
+    return result
+
+
+async def _drain_async(stream: asyncio.StreamReader, callback, size: int = READ_SIZE):
+    while True:
+        data = await stream.read(size)
+        written = callback(data)
+        if inspect.isawaitable(written):
+            await written
+        if not data:
+            break
+
+
+async def _drain_stderr_async(process, stderr: _StderrCollector, size: int, usage: ResourceUsage = None):
+    await _drain_async(process.stderr, stderr.feed, size)
+    # stderr closes as the process exits, the last chance for a sample before it is reaped
+    if usage is not None:
+        _try_sample_proc(process.pid, usage)
+
+
+async def _feed_async(source, stream: asyncio.StreamWriter, size: int):
+    """Writes an async iterable of bytes, or anything `_chunks` accepts, waiting while the pipe is full"""
+    loop = asyncio.get_event_loop()
+    stream.transport.set_write_buffer_limits(high=size)
+    try:
+        if hasattr(source, "__aiter__"):
+            async for chunk in source:
+                stream.write(chunk)
+                await stream.drain()
+        elif hasattr(source, "read"):
+            while True:
+                chunk = source.read(size) if inspect.iscoroutinefunction(source.read) \
+                    else loop.run_in_executor(None, source.read, size)
+                chunk = await chunk
+                if not chunk:
+                    break
+                stream.write(chunk)
+                await stream.drain()
+        else:
+            for chunk in _chunks(source, size):
+                stream.write(chunk)
+                await stream.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # The process stopped reading
+        pass
+    finally:
+        stream.close()
+
+
+async def _terminate_async(process, grace: float = TERMINATE_GRACE_PERIOD):
+    if process.returncode is not None:
+        return
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), grace)
+    except ProcessLookupError:
+        pass
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def _open_pipe(stream) -> asyncio.StreamReader:
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), stream)
+    return reader
+
+
+async def _watch_stalls(progress: _ProgressReader, stall_timeout: float, stderr: _StderrCollector):
+    while not progress.stalled(stall_timeout):
+        await asyncio.sleep(min(1.0, stall_timeout / 4))
+    raise CommandStalled(progress.args, stall_timeout, stderr.text)
+
+
+async def _supervise(waiters: list, watchdog=None):
+    """Awaits every waiter, unless the watchdog raises first"""
+    work = asyncio.ensure_future(asyncio.gather(*waiters))
+    if watchdog is None:
+        return await work
+    watch = asyncio.ensure_future(watchdog)
+    try:
+        done, _ = await asyncio.wait([work, watch], return_when=asyncio.FIRST_COMPLETED)
+        if watch in done:
+            watch.result()
+        return work.result()
+    finally:
+        for task in (work, watch):
+            task.cancel()
+        await asyncio.gather(work, watch, return_exceptions=True)
+
+
+async def run_async(args: list, timeout: float = None, on_stderr=None, check: bool = True,
+                    capture_stdout: bool = False, on_progress=None, duration: float = None,
+                    stall_timeout: float = None, stdin=None, stdout=None, buffer_size: int = READ_SIZE,
+                    on_usage=None) -> Result:
+    """Runs FFmpeg from an event loop, see `run` for the parameters
+
+    `stdin` may also be an async iterable of bytes or an object with a coroutine `read(size)`, a plain file-like
+    object is read in the default executor. `stdout.write` may be a coroutine.
+    Cancelling the awaiting task terminates the process before `asyncio.CancelledError` propagates.
+    The event loop reaps the process itself, so the resource usage is sampled from /proc every
+    `USAGE_SAMPLE_INTERVAL` seconds. It is None without /proc, or when the process was reaped before any sample.
+    """
+    if capture_stdout and stdout is not None:
+        raise ValueError("stdout can either be captured or written to a stream")
+    started = time.monotonic()
+    stderr = _StderrCollector(on_stderr)
+    captured = []
+    progress = _ProgressReader(args, duration, on_progress) if on_progress or stall_timeout else None
+    if progress:
+        args = progress.args
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *args, stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE, stderr=subprocess.PIPE,
+            stdout=subprocess.PIPE if capture_stdout or stdout is not None else subprocess.DEVNULL,
+            pass_fds=(progress.write_fd,) if progress else (), limit=buffer_size)
+    except BaseException:
+        if progress:
+            progress.close()
+        raise
+    usage = ResourceUsage() if os.path.exists("/proc/%d/stat" % process.pid) else None
+    waiters = [_drain_stderr_async(process, stderr, buffer_size, usage), process.wait()]
+    if capture_stdout:
+        waiters.append(_drain_async(process.stdout, captured.append, buffer_size))
+    elif stdout is not None:
+        waiters.append(_drain_async(process.stdout, _writer(stdout), buffer_size))
+    if stdin is not None:
+        waiters.append(_feed_async(stdin, process.stdin, buffer_size))
+    watchdog = None
+    if progress:
+        progress.spawned()
+        waiters.append(_drain_async(await _open_pipe(progress.open(0)), progress.feed, buffer_size))
+        if stall_timeout:
+            watchdog = _watch_stalls(progress, stall_timeout, stderr)
+    sampler = asyncio.ensure_future(_sample_usage(process.pid, usage)) if usage else None
+
+    error = None
+    try:
+        await asyncio.wait_for(_supervise(waiters, watchdog), timeout)
+    except asyncio.TimeoutError:
+        await _terminate_async(process)
+        error = CommandTimeout(args, timeout, stderr.text)
+        raise error
+    except BaseException as e:
+        await _terminate_async(process)
+        error = e
+        raise
+    finally:
+        if sampler:
+            sampler.cancel()
+            usage.wall_time = time.monotonic() - started
+        if usage is not None and not usage.sampled:
+            # All zeros would pass for a process that cost nothing
+            usage = None
+        if isinstance(error, CommandError):
+            error.usage = usage
+        _report_usage(on_usage, args, usage)
+
+    result = Result(args, process.returncode, b"".join(captured), stderr.text, time.monotonic() - started, usage)
+    if check and result.returncode != 0:
+        error = stderr.error(args, result.returncode)
+        error.usage = usage
+        raise error
+    return result
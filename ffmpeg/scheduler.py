@@ -0,0 +1,315 @@
+import heapq
+import itertools
+import os
+import queue
+import threading
+from logging import getLogger
+
+from . import runner
+
+logger = getLogger("ffmpeg.scheduler")
+
+# Threads a transcode is assumed to keep busy when the command does not set -threads.
+DEFAULT_JOB_THREADS = 4
+
+
+def estimate_threads(args: list) -> int:
+    """Estimates how many cores a single ffmpeg process will use
+
+    An explicit `-threads N` wins, stream copies without filters are single threaded and anything else is
+    assumed to use `DEFAULT_JOB_THREADS`.
+    """
+    threads = None
+    encodes = False
+    for i, arg in enumerate(args[:-1]):
+        value = args[i + 1]
+        if arg == "-threads" or arg.startswith("-threads:"):
+            threads = max(threads or 0, int(value) or os.cpu_count() or 1)
+        elif (arg == "-c" or arg.startswith("-c:")) and value != "copy":
+            encodes = True
+        elif arg.startswith("-filter") or arg in ("-vf", "-af"):
+            encodes = True
+    if threads:
+        return threads
+    codecs = [arg for arg in args if arg == "-c" or arg.startswith("-c:")]
+    return DEFAULT_JOB_THREADS if encodes or not codecs else 1
+
+
+def default_concurrency(threads_per_job: int = DEFAULT_JOB_THREADS, cores: int = None) -> int:
+    """Number of jobs that fit `cores`, the host's cores by default"""
+    return max(1, (cores or os.cpu_count() or 1) // max(1, threads_per_job))
+
+
+class Job:
+    """A command submitted to the `Scheduler`, use `wait()` for its `runner.Result`"""
+
+    def __init__(self, args: list, priority: int = 0, tenant=None, retries: int = 0, threads: int = None,
+                 duration: float = None):
+        self.args = args
+        self.duration = duration
+        self.priority = priority
+        self.tenant = tenant
+        self.retries = retries
+        self.threads = threads or estimate_threads(args)
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self.progress = None  # Last `progress.Progress` of the running attempt
+        self._cancel = threading.Event()
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Job tenant=%s priority=%s attempts=%s done=%s>" % (
+            self.tenant, self.priority, self.attempts, self.done())
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    @property
+    def usage(self) -> runner.ResourceUsage:
+        """`runner.ResourceUsage` of the last attempt, also when it failed"""
+        if self.result is not None:
+            return self.result.usage
+        return getattr(self.error, "usage", None)
+
+    def cancel(self):
+        """Drops the job if it is still queued, or terminates its process if it is running"""
+        self._cancel.set()
+
+    def wait(self, timeout: float = None) -> runner.Result:
+        """Blocks until the job finished and returns its result, or raises its last error"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Job did not finish in %s seconds" % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def add_done_callback(self, callback):
+        """Calls `callback` with the job once it finished, at once if it already has"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _on_progress(self, progress):
+        self.progress = progress
+
+    def _finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.exception("Done callback of %r failed", self)
+
+
+class Scheduler:
+    """Runs commands on a bounded pool of worker threads
+
+    - At most `concurrency` processes run at once, `default_concurrency` of the budget unless given, and the
+      `-threads` estimate of the running jobs never exceeds `cpu_budget` (unless a single job is larger than the
+      whole budget, which then runs alone).
+    - Higher `priority` runs first. Tenants with queued jobs of the same priority are served in turns, so one
+      tenant's burst can not starve the others.
+    - Failed jobs are retried `retries` times, after `retry_delay * attempt` seconds. Errors that would recur,
+      like `runner.InvalidInput`, are not retried.
+    - `submit` blocks (or raises `queue.Full`) while `max_pending` jobs are waiting.
+    - With `track_progress` every running job keeps its latest report, with speed and ETA, in `Job.progress`.
+
+        with Scheduler() as scheduler:
+            jobs = [scheduler.submit(cmd, tenant=customer_id) for cmd in commands]
+            results = [job.wait() for job in jobs]
+    """
+
+    def __init__(self, concurrency: int = None, cpu_budget: int = None, max_pending: int = 1000,
+                 retries: int = 0, retry_delay: float = 1, track_progress: bool = False, run_options: dict = None):
+        self.cpu_budget = cpu_budget or os.cpu_count() or 1
+        self.concurrency = concurrency or default_concurrency(cores=self.cpu_budget)
+        self.max_pending = max_pending
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.track_progress = track_progress
+        self.run_options = run_options or {}
+
+        self._queues = {}  # Tenant -> heap of (-priority, sequence, job)
+        self._served = {}  # Tenant with queued jobs -> sequence number of its last dispatch
+        self._sequence = itertools.count()
+        self._pending = 0
+        self._running_threads = 0
+        self._running = 0
+        self._active = set()
+        self._shutdown = False
+        self._condition = threading.Condition()
+        self._workers = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown(wait=exc_type is None)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def start(self):
+        with self._condition:
+            if self._workers:
+                return self
+            self._shutdown = False
+            for i in range(self.concurrency):
+                worker = threading.Thread(target=self._work, name="ffmpeg-scheduler-%d" % i, daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        return self
+
+    def shutdown(self, wait: bool = True):
+        """Stops the workers
+
+        :param wait: Run every queued job first, otherwise queued jobs are cancelled and running ones terminated
+        """
+        with self._condition:
+            if wait:
+                self._condition.wait_for(lambda: not self._pending and not self._running)
+            else:
+                for heap in self._queues.values():
+                    for _, _, job in heap:
+                        job.cancel()
+                        job._finish(error=runner.CommandCancelled(job.args, ""))
+                        self._pending -= 1
+                self._queues.clear()
+                for job in self._active:
+                    job.cancel()
+            self._shutdown = True
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def submit(self, command, priority: int = 0, tenant=None, retries: int = None, threads: int = None,
+               duration: float = None, block: bool = True, timeout: float = None) -> Job:
+        """Queues a `Command` (or an argument list)
+
+        :param priority: Higher runs first
+        :param tenant: Jobs of different tenants with the same priority are dispatched in turns
+        :param retries: Overrides the scheduler's retry count for this job
+        :param threads: Overrides `estimate_threads` for this job
+        :param duration: Expected output duration as seconds, enables the ETA of `Job.progress`
+        :param block: Wait for room in the queue instead of raising `queue.Full` immediately
+        :param timeout: Seconds to wait for room before raising `queue.Full`
+        """
+        args = command.generate(as_str=False) if hasattr(command, "generate") else list(command)
+        job = Job(args, priority=priority, tenant=tenant, retries=self.retries if retries is None else retries,
+                  threads=threads, duration=duration)
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Scheduler is shut down")
+            if not self._condition.wait_for(lambda: self._pending < self.max_pending,
+                                            timeout=timeout if block else 0):
+                raise queue.Full("%d jobs are pending" % self._pending)
+            self._enqueue(job)
+        return job
+
+    def _enqueue(self, job: Job):
+        heapq.heappush(self._queues.setdefault(job.tenant, []), (-job.priority, next(self._sequence), job))
+        self._pending += 1
+        self._condition.notify_all()
+
+    def _retry(self, job: Job):
+        # The job keeps counting as pending while it waits for the retry delay
+        with self._condition:
+            self._pending -= 1
+            if self._shutdown or job.cancelled:
+                job._finish(error=runner.CommandCancelled(job.args, ""))
+                self._condition.notify_all()
+            else:
+                self._enqueue(job)
+
+    def _next(self):
+        """Picks the queued job to run next, or None if there is none or it does not fit the CPU budget"""
+        best = None
+        for tenant, heap in self._queues.items():
+            key = (heap[0][0], self._served.get(tenant, -1))
+            if best is None or key < best[0]:
+                best = (key, tenant)
+        if best is None:
+            return None
+        tenant = best[1]
+        job = self._queues[tenant][0][2]
+        if self._running and self._running_threads + min(job.threads, self.cpu_budget) > self.cpu_budget:
+            return None
+        heapq.heappop(self._queues[tenant])
+        if self._queues[tenant]:
+            self._served[tenant] = next(self._sequence)
+        else:
+            # A tenant that comes back later takes its turn like a new one
+            del self._queues[tenant]
+            self._served.pop(tenant, None)
+        self._pending -= 1
+        return job
+
+    def _work(self):
+        while True:
+            with self._condition:
+                job = None
+                while job is None:
+                    if self._shutdown:
+                        return
+                    job = self._next()
+                    if job is None:
+                        self._condition.wait()
+                self._running += 1
+                self._running_threads += min(job.threads, self.cpu_budget)
+                self._active.add(job)
+                # Room in the queue for blocked submitters
+                self._condition.notify_all()
+            try:
+                self._run(job)
+            finally:
+                with self._condition:
+                    self._running -= 1
+                    self._running_threads -= min(job.threads, self.cpu_budget)
+                    self._active.discard(job)
+                    self._condition.notify_all()
+
+    def _run(self, job: Job):
+        if job.cancelled:
+            job._finish(error=runner.CommandCancelled(job.args, ""))
+            return
+        job.attempts += 1
+        try:
+            options = dict(self.run_options)
+            if self.track_progress:
+                options.update(on_progress=job._on_progress, duration=job.duration)
+            result = runner.run(job.args, cancel=job._cancel, **options)
+        except runner.CommandCancelled as err:
+            job._finish(error=err)
+        except Exception as err:
+            if job.attempts <= job.retries and not self._shutdown and getattr(err, "retryable", True):
+                logger.warning("Job failed, retrying (attempt %d of %d): %s", job.attempts, job.retries + 1, err)
+                with self._condition:
+                    self._pending += 1
+                timer = threading.Timer(self.retry_delay * job.attempts, self._retry, args=(job,))
+                timer.daemon = True
+                timer.start()
+                return
+            logger.exception("Job failed after %d attempts: %s", job.attempts, " ".join(job.args))
+            job._finish(error=err)
+        else:
+            job._finish(result=result)
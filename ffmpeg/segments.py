@@ -0,0 +1,266 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from logging import getLogger
+
+from . import runner, settings
+from .ffprobe import probe
+from .keyframes import KeyframeIndex, get_keyframe_index
+from .scheduler import Scheduler
+from .utils import seconds_to_time, time_to_seconds
+
+logger = getLogger("ffmpeg.segments")
+
+# Segments shorter than this (as seconds) are merged into their neighbour.
+MIN_SEGMENT_DURATION = 2.0
+
+# File in the workdir of a resumable transcode that records the plan and the finished segments
+MANIFEST = "manifest.json"
+
+
+class DurationMismatch(Exception):
+    """The joined output is not as long as the source range"""
+
+    def __init__(self, expected: float, actual: float):
+        self.expected = expected
+        self.actual = actual
+        super(DurationMismatch, self).__init__("Expected %.3f seconds of output, got %.3f" % (expected, actual))
+
+
+class Segment:
+    __slots__ = ("index", "start", "end", "path")
+
+    def __init__(self, index: int, start: float, end: float, path: str = None):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.path = path
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def __repr__(self):
+        return "<Segment %d %.3f-%.3f>" % (self.index, self.start, self.end)
+
+
+def plan_segments(keyframes: KeyframeIndex, start: float, end: float, count: int,
+                  min_duration: float = MIN_SEGMENT_DURATION) -> list:
+    """Splits [start, end) into up to `count` segments whose inner boundaries fall on keyframes
+
+    Every segment but the first starts on a keyframe, so it can be cut with a fast and exact input seek.
+    """
+    boundaries = [start]
+    for i in range(1, count):
+        target = start + (end - start) * i / count
+        keyframe = keyframes.before(target)
+        if keyframe - boundaries[-1] >= min_duration and end - keyframe >= min_duration:
+            boundaries.append(keyframe)
+    boundaries.append(end)
+    return [Segment(i, boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+
+
+def segment_command(command, segment: Segment):
+    """The part of `command` that encodes only `segment` into `segment.path`"""
+    return command.clone(input=command.data['input'], output=segment.path, overwrite=True,
+                         ss_position=seconds_to_time(segment.start), add_ss_position_before_input=True,
+                         duration=seconds_to_time(segment.duration), add_duration_before_input=False,
+                         to_position=None)
+
+
+def _escape(path: str) -> str:
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+def concat_args(paths: list, list_file: str, output: str, overwrite: bool = None) -> list:
+    """Writes the concat demuxer's list and returns the command joining `paths` without re-encoding"""
+    with open(list_file, "w") as f:
+        for path in paths:
+            f.write("file %s\n" % _escape(os.path.abspath(path)))
+    args = [settings.get("FFMPEG_PATH"), "-v", "error"]
+    if overwrite is not None:
+        args.append("-y" if overwrite else "-n")
+    return args + ["-f", "concat", "-safe", "0", "-i", list_file, "-map", "0", "-c", "copy", output]
+
+
+class Manifest:
+    """Plan and finished segments of a resumable `SegmentedTranscode`, rewritten whole after every change
+
+    A manifest belongs to one input file (by path, size and modification time) and one argument list, it is
+    started over when either changed.
+    """
+
+    def __init__(self, path: str, source: str, args: list):
+        self.path = path
+        stat = os.stat(source)
+        self.key = {'input': os.path.realpath(source), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                    'args': args}
+        self.segments = []  # (start, end) of every segment
+        self.done = {}  # Index -> size of the segment file
+        self._lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Reads the manifest, False when there is none or it belongs to another input or command"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('key') != self.key:
+            logger.info("%s belongs to another transcode, starting over", self.path)
+            return False
+        self.segments = [tuple(bounds) for bounds in data['segments']]
+        self.done = {int(index): size for index, size in data['done'].items()}
+        return True
+
+    def save(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        data = {'key': self.key, 'segments': self.segments, 'done': self.done}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def finished(self, segment: Segment) -> bool:
+        """Whether `segment` was recorded and its file is still there, with the size recorded"""
+        size = self.done.get(segment.index)
+        return size is not None and os.path.isfile(segment.path) and os.path.getsize(segment.path) == size
+
+    def record(self, segment: Segment):
+        # Segments finish in parallel, the callbacks of the scheduler's workers call this concurrently
+        with self._lock:
+            self.done[segment.index] = os.path.getsize(segment.path)
+            self._write()
+
+
+class SegmentedTranscode:
+    """Encodes a long input as keyframe aligned segments in parallel processes and joins them losslessly
+
+        SegmentedTranscode(cmd, segments=16).run()
+
+    Every segment is encoded with the command's codecs and filters. The segments are joined with the concat
+    demuxer and the result must be as long as the source range (within `tolerance` seconds). Audio is cut at
+    the same boundaries, codecs with priming samples (e.g. AAC) can leave a few milliseconds of silence there.
+
+    With `resume`, finished segments are recorded in a `Manifest` in `workdir`. Running the same transcode again
+    after a crash encodes only the segments that are missing, the segments and the manifest are removed once the
+    output is joined.
+
+    :param command: A `generator.Command`, its `ss_position`, `duration` and `to_position` limit the range
+    :param segments: Number of segments, defaults to the CPU count; fewer are used when keyframes are sparse
+    :param workdir: Directory for the segment files, a temporary one is created (and removed) if omitted
+    :param scheduler: Runs the segment encodes, a new `Scheduler` by default
+    :param resume: Keep track of the finished segments in `workdir`, which is required then
+    """
+
+    def __init__(self, command, segments: int = None, workdir: str = None, keyframes: KeyframeIndex = None,
+                 tolerance: float = 0.5, scheduler: Scheduler = None, resume: bool = False):
+        command.validate()
+        if resume and not workdir:
+            raise ValueError("A resumable transcode needs a workdir that outlives the process.")
+        self.command = command
+        self.count = segments or os.cpu_count() or 1
+        self.workdir = workdir
+        self.keyframes = keyframes
+        self.tolerance = tolerance
+        self.scheduler = scheduler
+        self.resume = resume
+        self.segments = []
+
+    def _range(self) -> tuple:
+        data = self.command.cleaned_data
+        start = time_to_seconds(data['ss_position']) if data['ss_position'] else 0.0
+        return start, start + self.command.expected_duration()
+
+    def plan(self, workdir: str, manifest: Manifest = None) -> list:
+        """Segments of the transcode, those of `manifest` when it has them"""
+        if manifest is not None and manifest.segments:
+            self.segments = [Segment(i, start, end) for i, (start, end) in enumerate(manifest.segments)]
+        else:
+            keyframes = self.keyframes or get_keyframe_index(self.command.cleaned_data['input'])
+            start, end = self._range()
+            self.segments = plan_segments(keyframes, start, end, self.count)
+        extension = os.path.splitext(self.command.cleaned_data['output'])[1]
+        for segment in self.segments:
+            segment.path = os.path.join(workdir, "segment-%05d%s" % (segment.index, extension))
+        return self.segments
+
+    @staticmethod
+    def _recorder(manifest: Manifest, segment: Segment):
+        def record(job):
+            if job.error is None and not job.cancelled:
+                manifest.record(segment)
+        return record
+
+    def _encode(self, segments: list, manifest: Manifest = None):
+        scheduler = self.scheduler or Scheduler()
+        owned = self.scheduler is None
+        scheduler.start()
+        try:
+            jobs = []
+            for segment in segments:
+                job = scheduler.submit(segment_command(self.command, segment), priority=-segment.index)
+                if manifest is not None:
+                    job.add_done_callback(self._recorder(manifest, segment))
+                jobs.append(job)
+            try:
+                for job in jobs:
+                    job.wait()
+            except BaseException:
+                for job in jobs:
+                    job.cancel()
+                raise
+        finally:
+            if owned:
+                scheduler.shutdown(wait=False)
+
+    def _join(self, segments: list, workdir: str) -> runner.Result:
+        output = self.command.cleaned_data['output']
+        args = concat_args([s.path for s in segments], os.path.join(workdir, "segments.txt"), output,
+                           self.command.cleaned_data['overwrite'])
+        result = runner.run(args)
+        expected = sum(segment.duration for segment in segments)
+        actual = probe(output, cache=False).duration or 0.0
+        if abs(actual - expected) > self.tolerance:
+            raise DurationMismatch(expected, actual)
+        return result
+
+    def _manifest(self, workdir: str) -> Manifest:
+        os.makedirs(workdir, exist_ok=True)
+        manifest = Manifest(os.path.join(workdir, MANIFEST), self.command.cleaned_data['input'],
+                            self.command.generate(as_str=False))
+        if not manifest.load():
+            manifest.segments = [(segment.start, segment.end) for segment in self.plan(workdir)]
+            manifest.save()
+        return manifest
+
+    def run(self) -> runner.Result:
+        """Encodes and joins the segments, returns the result of the joining command"""
+        workdir = self.workdir or tempfile.mkdtemp(prefix="ffmpeg-segments-")
+        try:
+            manifest = self._manifest(workdir) if self.resume else None
+            segments = self.plan(workdir, manifest)
+            missing = [segment for segment in segments if manifest is None or not manifest.finished(segment)]
+            logger.info("Encoding %s in %d segments, %d of them now", self.command.cleaned_data['input'],
+                        len(segments), len(missing))
+            self._encode(missing, manifest)
+            result = self._join(segments, workdir)
+            if manifest is not None:
+                # Done, nothing is left to resume
+                files = [segment.path for segment in segments] + [manifest.path, os.path.join(workdir, "segments.txt")]
+                for path in files:
+                    os.unlink(path)
+            return result
+        finally:
+            if self.workdir is None:
+                shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,122 @@
+"""Settings of the package, resolved when first used
+
+A setting is taken from the first of:
+    1. `configure(FFMPEG_PATH=...)`
+    2. The environment variable of the same name, e.g. FFMPEG_PATH=/opt/ffmpeg/bin/ffmpeg
+    3. Django settings, only when Django is imported (or DJANGO_SETTINGS_MODULE is set) and configured
+    4. For FFMPEG_PATH and FFPROBE_PATH, the program found on PATH by `shutil.which`
+    5. The default
+
+Importing the package neither imports Django nor looks for the binaries, a missing binary fails when it is run.
+"""
+import os
+import shutil
+import sys
+import threading
+
+# Stands for "not given" where None is a meaningful value, e.g. cache_dir=None disables the disk cache
+DEFAULT = type("Default", (), {"__repr__": lambda self: "DEFAULT", "__bool__": lambda self: False})()
+
+
+def _cache_dir():
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                        "ffmpeg-generator")
+
+
+DEFAULTS = {
+    'FFMPEG_PATH': lambda: shutil.which("ffmpeg") or "/usr/bin/ffmpeg",
+    'FFPROBE_PATH': lambda: shutil.which("ffprobe") or "/usr/bin/ffprobe",
+    # Directory for the on-disk capability, keyframe and output caches, None keeps results only in memory
+    'FFMPEG_CACHE_DIR': _cache_dir,
+    # Seconds to wait for `ffmpeg -codecs` and friends while discovering capabilities
+    'FFMPEG_CAPABILITIES_TIMEOUT': lambda: 10,
+    # Bytes of transcoded outputs kept under FFMPEG_CACHE_DIR/outputs by `outputcache`
+    'FFMPEG_OUTPUT_CACHE_SIZE': lambda: 10 * 1024 ** 3,
+    # Bytes of keyframe indexes kept under FFMPEG_CACHE_DIR/keyframes, about 8 per keyframe
+    'FFMPEG_KEYFRAME_CACHE_SIZE': lambda: 256 * 1024 ** 2,
+    'FFPROBE_CACHE_SIZE': lambda: 1024,
+    'FFPROBE_CACHE_MAX_AGE': lambda: 3600,
+    'FFMPEG_ASPECT_RATIOS': lambda: None,
+    'FFMPEG_VIDEO_SIZES': lambda: None,
+    'FFMPEG_VIDEO_RATES': lambda: None,
+}
+
+# Parsers of environment variables, others are taken as strings, an empty value means None
+_ENVIRONMENT_TYPES = {
+    'FFMPEG_CAPABILITIES_TIMEOUT': float,
+    'FFMPEG_OUTPUT_CACHE_SIZE': int,
+    'FFMPEG_KEYFRAME_CACHE_SIZE': int,
+    'FFPROBE_CACHE_SIZE': int,
+    'FFPROBE_CACHE_MAX_AGE': float,
+}
+
+_configured = {}
+_resolved = {}
+_lock = threading.Lock()
+
+
+def configure(**options):
+    """Sets settings explicitly, they take precedence over the environment and Django"""
+    unknown = set(options) - set(DEFAULTS)
+    if unknown:
+        raise KeyError("Unknown settings: %s" % ", ".join(sorted(unknown)))
+    with _lock:
+        _configured.update(options)
+        _resolved.clear()
+
+
+def reset():
+    """Forgets `configure`d and resolved values, the environment and Django are read again on next use"""
+    with _lock:
+        _configured.clear()
+        _resolved.clear()
+
+
+def _from_django(name: str):
+    # Django is only consulted when the process uses it, importing it here would cost more than everything else
+    if "django" not in sys.modules and not os.environ.get("DJANGO_SETTINGS_MODULE"):
+        return DEFAULT
+    try:
+        from django.conf import settings
+        from django.core.exceptions import ImproperlyConfigured
+    except ImportError:
+        return DEFAULT
+    if not settings.configured and not os.environ.get("DJANGO_SETTINGS_MODULE"):
+        return DEFAULT
+    try:
+        return getattr(settings, name, DEFAULT)
+    except (ImproperlyConfigured, ImportError):
+        # DJANGO_SETTINGS_MODULE names a missing or broken module, this process does not run Django
+        return DEFAULT
+
+
+def _resolve(name: str):
+    if name in _configured:
+        return _configured[name]
+    if name in os.environ:
+        value = os.environ[name]
+        if not value:
+            return None
+        return _ENVIRONMENT_TYPES.get(name, str)(value)
+    value = _from_django(name)
+    if value is not DEFAULT:
+        return value
+    return DEFAULTS[name]()
+
+
+def get(name: str):
+    """Value of the setting `name`, resolved once and then cached until `configure` or `reset`"""
+    try:
+        return _resolved[name]
+    except KeyError:
+        pass
+    if name not in DEFAULTS:
+        raise KeyError("Unknown setting: %s" % name)
+    with _lock:
+        value = _resolved[name] = _resolve(name)
+    return value
+
+
+def resolve(value, name: str):
+    """`value` unless it is `DEFAULT`, then the setting `name`"""
+    return get(name) if value is DEFAULT else value
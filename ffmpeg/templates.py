@@ -0,0 +1,114 @@
+"""Pre-rendered commands for jobs that differ only in their input and output paths
+
+    template = templates.get(overwrite=True, codecs=[Codec("libx264", "v"), Codec("aac", "a")])
+    for source, target in jobs:
+        runner.run(template.render(source, target))
+
+`get` keeps a template for each option set in a bounded LRU, so the options are validated and the command is
+rendered once per shape instead of once per job.
+"""
+import threading
+from collections import OrderedDict
+
+from . import core
+from .filtergraph import FilterGraph, FilterNode
+
+# Option sets whose templates are kept by the default cache.
+TEMPLATE_CACHE_SIZE = 256
+
+# Stand in for the paths while the template is rendered
+_INPUT = "\0input\0"
+_OUTPUT = "\0output\0"
+
+
+class CommandTemplate:
+    """Argument vector of a command with the input and output paths left open"""
+
+    __slots__ = ("args", "input_index", "output_index")
+
+    def __init__(self, command):
+        """
+        :param command: A `core.Command` or a `generator.Command`, its own input and output are ignored
+        """
+        if not isinstance(command, core.Command):
+            command = command.core()
+        if command.keyframe_index is not None:
+            raise ValueError("Keyframe seeks depend on the input, a command using them can not be a template.")
+        input, output = command.input, command.output
+        command.input, command.output = _INPUT, _OUTPUT
+        try:
+            command.generate(as_str=False)
+            self.args = command.args
+        finally:
+            command.input, command.output = input, output
+        self.input_index = self.args.index(_INPUT)
+        self.output_index = self.args.index(_OUTPUT)
+
+    def render(self, input: str, output: str, as_str: bool = False) -> list or str:
+        """The command for `input` and `output`, an argument vector unless `as_str`"""
+        args = list(self.args)
+        args[self.input_index] = core._Quoted(input)
+        args[self.output_index] = core._Quoted(output)
+        if as_str:
+            return " ".join(core.Command._quote(arg) for arg in args)
+        return [str(arg) for arg in args]
+
+
+def _freeze(value):
+    """Hashable equivalent of an option value"""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, FilterNode):
+        return ("FilterNode", value.name, tuple(value.args))
+    if isinstance(value, FilterGraph):
+        return ("FilterGraph", str(value))
+    if isinstance(value, (core.Codec, core.ScaleFilter, core.BitstreamChannelFilter)):
+        return (value.__class__.__name__,) + tuple(getattr(value, name) for name in value.__slots__)
+    hash(value)
+    return value
+
+
+class TemplateCache:
+    """Compiled templates by option set, the least recently used are dropped above `max_entries`"""
+
+    def __init__(self, max_entries: int = TEMPLATE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._templates = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, **options) -> CommandTemplate:
+        """Template of `core.Command` with `options`, compiled on first use"""
+        key = _freeze(options)
+        with self._lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                return template
+        template = CommandTemplate(core.Command(_INPUT, _OUTPUT, **options))
+        with self._lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_entries:
+                self._templates.popitem(last=False)
+        return template
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+    def __len__(self):
+        return len(self._templates)
+
+
+template_cache = TemplateCache()
+
+
+def get(**options) -> CommandTemplate:
+    """Template for the options of `core.Command` from the default cache"""
+    return template_cache.get(**options)
+
+
+def render(input: str, output: str, **options) -> list:
+    """Argument vector of `core.Command(input, output, **options)`, rendered from a cached template"""
+    return template_cache.get(**options).render(input, output)
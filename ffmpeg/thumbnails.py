@@ -0,0 +1,238 @@
+"""Thumbnails and sprite sheets from a single FFmpeg process
+
+    command = Command(input="input.mp4", output="thumbs/%03d.jpg", overwrite=True)
+    paths = thumbnails(command, count=10, scale=ScaleFilter(width=320, height=-2))
+
+    sheet = sprite_sheet(Command(input="input.mp4", output="sprites/%03d.jpg", overwrite=True),
+                         interval=10, columns=5, rows=5, size=(160, 90), vtt="sprites.vtt")
+
+Thumbnails spaced far apart are taken with one input-side seek each (`-ss` before `-i`, which jumps to a keyframe
+instead of decoding everything in between), otherwise the input is decoded once and `fps` keeps the frames needed.
+`keyframes_only` adds `-skip_frame nokey`, so only keyframes are decoded at all, at the cost of exact times.
+"""
+import copy
+import math
+import os
+
+from . import core
+from .filtergraph import FilterNode
+from .utils import seconds_to_time, time_to_seconds
+
+# Thumbnails at least this many seconds apart are seeked to one by one, decoding between them costs more
+SEEK_SPACING = 30.0
+
+# Inputs opened by a seeking command at most, every one holds its own demuxer and decoder
+MAX_SEEK_INPUTS = 32
+
+
+def _command(command) -> core.Command:
+    if isinstance(command, core.Command):
+        command = copy.copy(command)
+        command.filters = list(command.filters)
+        return command
+    return command.core()
+
+
+def _scale(scale):
+    """A `core.ScaleFilter` from a `ScaleFilter` form, a `core.ScaleFilter` or (width, height)"""
+    if scale is None or isinstance(scale, core.ScaleFilter):
+        return scale
+    if isinstance(scale, (tuple, list)):
+        return core.ScaleFilter(width=scale[0], height=scale[1])
+    return scale.core()
+
+
+def _span(command: core.Command, duration: float = None) -> tuple:
+    """Start and length as seconds of the part of the input `command` selects"""
+    start = time_to_seconds(command.ss_position) if command.ss_position else 0.0
+    if duration is None:
+        duration = command.expected_duration()
+    if duration <= 0:
+        raise ValueError("%s has nothing to take thumbnails from." % command.input)
+    return start, duration
+
+
+def _pattern(output: str, count: int) -> list:
+    """Paths the image2 muxer writes `count` images to"""
+    if count > 1 and "%" not in output:
+        raise ValueError("%s must be a pattern like thumb-%%03d.jpg to hold %d images." % (output, count))
+    return [output % (i + 1) if "%" in output else output for i in range(count)]
+
+
+def thumbnail_times(start: float, duration: float, count: int) -> list:
+    """Seconds of `count` evenly spaced thumbnails, each in the middle of its share of the duration"""
+    spacing = duration / count
+    return [start + spacing * (i + 0.5) for i in range(count)]
+
+
+def _seeking_args(command: core.Command, times: list, outputs: list, keyframes_only: bool) -> list:
+    command.duration = command.to_position = command.sseof_position = None
+    command.add_ss_position_before_input = True
+    if keyframes_only:
+        command.input_args = command.input_args + ["-skip_frame", "nokey"]
+    command.args = [command.path]
+    for seconds in times:
+        command.ss_position = core._time("ss_position", seconds_to_time(seconds))
+        command._add_input()
+        command.loglevel = None
+    command.ss_position = None
+    output_args = command.output_args
+    for i, output in enumerate(outputs):
+        command.output_args = ["-map", "%d:v:0" % i, "-frames:v", "1"] + output_args
+        command.output = output
+        command._add_output_options()
+        command._add_codecs()
+        command._add_filters()
+        command.args.extend(command.output_args)
+        command.args.append(core._Quoted(output))
+    return command._render(as_str=False)
+
+
+def thumbnails_args(command, count: int, scale=None, duration: float = None, keyframes_only: bool = False,
+                    seek: bool = None) -> list:
+    """Argument list writing `count` evenly spaced thumbnails to the output pattern of `command`
+
+    :param command: A `generator.Command` or `core.Command`, its positions and duration select the part of the input
+        and its output is an image2 pattern, e.g. thumb-%03d.jpg
+    :param count: Number of thumbnails
+    :param scale: A `ScaleFilter` or (width, height) applied after the command's own filters
+    :param duration: Seconds the command selects, probed when omitted
+    :param keyframes_only: Decode only keyframes, every thumbnail is a keyframe near its time
+    :param seek: Seek to every thumbnail instead of decoding the input once, decided by the spacing when None
+    """
+    if count < 1:
+        raise ValueError("count must be at least 1")
+    command = _command(command)
+    outputs = _pattern(command.output, count)
+    start, duration = _span(command, duration)
+    if seek is None:
+        seek = (duration / count >= SEEK_SPACING and count <= MAX_SEEK_INPUTS and not command.filter_complex
+                and command.input not in core.PIPE_INPUTS)
+    scale = _scale(scale)
+    if scale is not None:
+        command.filters.append(scale)
+
+    if seek:
+        return _seeking_args(command, thumbnail_times(start, duration, count), outputs, keyframes_only)
+
+    # fps emits a frame every `spacing` seconds from its first input frame, which is moved to the first thumbnail
+    spacing = duration / count
+    command.ss_position = core._time("ss_position", seconds_to_time(start + spacing / 2))
+    command.add_ss_position_before_input = True
+    command.duration = core._time("duration", seconds_to_time(duration - spacing / 2))
+    command.add_duration_before_input = False
+    command.to_position = None
+    command.filters.insert(0, FilterNode("fps", "1/%s" % repr(spacing)))
+    if keyframes_only:
+        command.input_args = command.input_args + ["-skip_frame", "nokey"]
+    streams = [] if command.filter_complex else ["-map", "0:v:0"]
+    command.output_args = streams + ["-frames:v", str(count)] + command.output_args
+    return command.generate(as_str=False)
+
+
+def thumbnails(command, count: int, scale=None, duration: float = None, keyframes_only: bool = False,
+               seek: bool = None, timeout: float = None) -> list:
+    """Writes `count` evenly spaced thumbnails with one FFmpeg process and returns their paths
+
+    See `thumbnails_args` for the options, `timeout` is passed to `runner.run`.
+    """
+    from . import runner
+
+    command = _command(command)
+    runner.run(thumbnails_args(command, count, scale, duration, keyframes_only, seek), timeout=timeout)
+    return [path for path in _pattern(command.output, count) if os.path.exists(path)]
+
+
+def _timestamp(seconds: float) -> str:
+    milliseconds = int(round(seconds * 1000))
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%02d:%02d:%02d.%03d" % (hours, minutes, seconds, milliseconds)
+
+
+class SpriteSheet:
+    """Images of a sprite sheet and the position of every tile in them"""
+
+    __slots__ = ("paths", "count", "interval", "columns", "rows", "width", "height", "start")
+
+    def __init__(self, paths: list, count: int, interval: float, columns: int, rows: int, width: int, height: int,
+                 start: float = 0.0):
+        self.paths = paths
+        self.count = count  # Tiles over all images
+        self.interval = interval
+        self.columns = columns
+        self.rows = rows
+        self.width = width  # Of a tile
+        self.height = height
+        self.start = start
+
+    def tile(self, index: int) -> tuple:
+        """(path, x, y) of the tile `index`"""
+        sheet, position = divmod(index, self.columns * self.rows)
+        row, column = divmod(position, self.columns)
+        return self.paths[sheet], column * self.width, row * self.height
+
+    def webvtt(self, url=os.path.basename) -> str:
+        """WebVTT with a cue per tile, as used for seek bar previews
+
+        :param url: Called with the path of an image to get the URL written for it
+        """
+        lines = ["WEBVTT", ""]
+        for i in range(self.count):
+            path, x, y = self.tile(i)
+            begin = self.start + i * self.interval
+            lines.append("%s --> %s" % (_timestamp(begin), _timestamp(begin + self.interval)))
+            lines.append("%s#xywh=%d,%d,%d,%d" % (url(path), x, y, self.width, self.height))
+            lines.append("")
+        return "\n".join(lines)
+
+
+def sprite_sheet_args(command, interval: float, columns: int, rows: int, size: tuple,
+                      duration: float = None, keyframes_only: bool = False) -> tuple:
+    """Argument list tiling a thumbnail every `interval` seconds into images, and the `SpriteSheet` it writes
+
+    :param command: A `generator.Command` or `core.Command`, its output is an image2 pattern unless the tiles fit
+        in one image
+    :param interval: Seconds between the tiles
+    :param columns: Tiles in a row of an image
+    :param rows: Rows of an image
+    :param size: (width, height) of a tile
+    :param duration: Seconds the command selects, probed when omitted
+    :param keyframes_only: Decode only keyframes, a tile shows the last keyframe before its time
+    """
+    if interval <= 0 or columns < 1 or rows < 1:
+        raise ValueError("interval, columns and rows must be positive")
+    command = _command(command)
+    start, duration = _span(command, duration)
+    count = int(math.ceil(duration / interval))
+    sheets = int(math.ceil(count / float(columns * rows)))
+    paths = _pattern(command.output, sheets)
+    width, height = int(size[0]), int(size[1])
+
+    command.filters.insert(0, FilterNode("fps", "1/%s" % repr(float(interval))))
+    command.filters.extend([core.ScaleFilter(width=width, height=height),
+                            FilterNode("tile", "%dx%d" % (columns, rows))])
+    if keyframes_only:
+        command.input_args = command.input_args + ["-skip_frame", "nokey"]
+    streams = [] if command.filter_complex else ["-map", "0:v:0"]
+    command.output_args = streams + ["-frames:v", str(sheets)] + command.output_args
+    args = command.generate(as_str=False)
+    return args, SpriteSheet(paths, count, interval, columns, rows, width, height, start)
+
+
+def sprite_sheet(command, interval: float, columns: int, rows: int, size: tuple, vtt: str = None,
+                 url=os.path.basename, duration: float = None, keyframes_only: bool = False,
+                 timeout: float = None) -> SpriteSheet:
+    """Writes the sprite sheet images with one FFmpeg process and, when `vtt` is given, their WebVTT index
+
+    See `sprite_sheet_args` for the options, `url` for `SpriteSheet.webvtt` and `timeout` for `runner.run`.
+    """
+    from . import runner
+
+    args, sheet = sprite_sheet_args(command, interval, columns, rows, size, duration, keyframes_only)
+    runner.run(args, timeout=timeout)
+    if vtt:
+        with open(vtt, "w") as f:
+            f.write(sheet.webvtt(url))
+    return sheet
@@ -1,9 +1,19 @@
+import datetime
 import inspect
+import os
 from enum import Enum
 
-from django import forms
-from django.conf import settings
-from django.utils.translation import ugettext_lazy as _
+from . import settings
+
+
+def __getattr__(name):
+    # The form base classes need Django, they are imported only when asked for
+    if name in ("EnumChoiceField", "BaseCommand", "BaseFilter"):
+        from . import forms
+        return getattr(forms, name)
+    if name in ("ASPECT_RATIOS", "VIDEO_SIZES", "VIDEO_RATES"):
+        return settings.get("FFMPEG_" + name) or globals()["DEFAULT_" + name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 class ChoiceEnum(Enum):
@@ -11,7 +21,10 @@ class ChoiceEnum(Enum):
 
     @classmethod
     def choices(cls):
-        return [(v.value, _(v.name) if cls.__translatable__ else v.name) for v in cls]
+        if cls.__translatable__:
+            from django.utils.translation import ugettext_lazy as _
+            return [(v.value, _(v.name)) for v in cls]
+        return [(v.value, v.name) for v in cls]
 
     def __str__(self):
         return str(self.value)
@@ -36,29 +49,54 @@ class StreamSpecifier(ChoiceEnum):
     Subtitle = "s"
 
 
-class EnumChoiceField(forms.ChoiceField):
-    def __init__(self, *args, **kwargs):
-        # Unpack Enum
-        choices = kwargs.get('choices', None)
-        if choices and inspect.isclass(choices) and issubclass(choices, ChoiceEnum):
-            kwargs['choices'] = choices.choices()
-        super(EnumChoiceField, self).__init__(*args, **kwargs)
-
-
-class BaseCommand(forms.Form):
-    def validate(self):
-        if not self.is_valid():
-            raise ValueError(
-                "%s is not valid.\nData: %s\nErrors: %s" % (self.__class__.__name__, self.data, self.errors))
-        return self
-
-    def generate(self, as_str: bool = True):
-        """This should generates a string as command run on shell"""
-        raise NotImplemented()
-
-
-class BaseFilter(BaseCommand):
-    stream = EnumChoiceField(choices=StreamSpecifier, required=False)
+def time_to_seconds(value: datetime.time) -> float:
+    """Converts the value of a `forms.TimeField` to seconds"""
+    return value.hour * 3600 + value.minute * 60 + value.second + value.microsecond / 1000000
+
+
+def seconds_to_time(value: float) -> str:
+    """Formats seconds for a `forms.TimeField`, e.g. 00:01:02.500000"""
+    minutes, seconds = divmod(max(0.0, value), 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return "%02d:%02d:%09.6f" % (hours, minutes, seconds)
+
+
+def format_seconds(value: float) -> str:
+    """Formats seconds as an FFmpeg duration, e.g. 12.04"""
+    return ("%.6f" % value).rstrip("0").rstrip(".")
+
+
+def cache_entries(directory: str) -> list:
+    """(access time, size, path) of the files of a cache directory, without temporary files being written"""
+    entries = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return entries
+    for name in names:
+        if name.endswith(".tmp"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_atime, stat.st_size, path))
+    return entries
+
+
+def evict_lru(directory: str, max_size: int):
+    """Removes the least recently accessed files of `directory` until the rest take at most `max_size` bytes"""
+    entries = sorted(cache_entries(directory))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
 
 
 def unrap_kwargs(**kwargs):
@@ -92,8 +130,6 @@ DEFAULT_ASPECT_RATIOS = [
     (16 / 9, "16:9")
 ]
 
-ASPECT_RATIOS = getattr(settings, "FFMPEG_ASPECT_RATIOS", DEFAULT_ASPECT_RATIOS)
-
 # https://ffmpeg.org/ffmpeg-utils.html#Video-size
 DEFAULT_VIDEO_SIZES = [('720x480', 'NTSC 720x480'), ('720x576', 'PAL 720x576'),
                        ('352x240', 'QNTSC 352x240'), ('352x288', 'QPAL 352x288'), ('640x480', 'SNTSC 640x480'),
@@ -117,11 +153,7 @@ DEFAULT_VIDEO_SIZES = [('720x480', 'NTSC 720x480'), ('720x576', 'PAL 720x576'),
                        ('2048x1080', '2KDCI 2048x1080'), ('4096x2160', '4KDCI 4096x2160'),
                        ('3840x2160', 'UHD2160 3840x2160'), ('7680x4320', 'UHD4320 7680x4320')]
 
-VIDEO_SIZES = getattr(settings, "FFMPEG_VIDEO_SIZES", DEFAULT_VIDEO_SIZES)
-
 # https://ffmpeg.org/ffmpeg-utils.html#Video-rate
 DEFAULT_VIDEO_RATES = [('ntsc', 'NTSC 30000/1001'), ('pal', 'PAL 25/1'),
                        ('qntsc', 'QNTSC 30000/1001'), ('qpal', 'QPAL 25/1'), ('sntsc', 'SNTSC 30000/1001'),
                        ('spal', 'SPAL 25/1'), ('film', 'FILM 24/1'), ('ntsc-film', 'NTSC-FILM 24000/1001')]
-
-VIDEO_RATES = getattr(settings, "FFMPEG_VIDEO_RATES", DEFAULT_VIDEO_RATES)
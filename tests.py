@@ -1,10 +1,50 @@
+import asyncio
+import io
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock, skipIf
+
 from django.test import TestCase
 
-from ffmpeg.generator import Command
+from ffmpeg.ffmpeg import CapabilityRegistry, CapabilityTable, FFMPEG_PATH, _parse_codecs, _parse_formats
+from ffmpeg.generator import Command, MultiOutputCommand, Output
+from ffmpeg import core, runner, scheduler, settings, templates
+from ffmpeg.progress import ProgressParser
+from ffmpeg.encoders import plan_encoder, select_encoder
+from ffmpeg.frames import frames
+from ffmpeg.keyframes import KeyframeIndex, get_keyframe_index
+from ffmpeg.outputcache import OutputCache, fingerprint
+from ffmpeg.remux import plan_copy
+from ffmpeg.thumbnails import sprite_sheet, thumbnails, thumbnails_args
+from ffmpeg.segments import Manifest, Segment, SegmentedTranscode, plan_segments, segment_command
+from ffmpeg.ffprobe import (MemoryProbeCache, SQLiteProbeCache, get_file_attributes, probe, probe_args, probe_key,
+                            probe_many)
 from ffmpeg.codecs import Codec
 from ffmpeg.filters import BitstreamChannelFilter, FFmpegFilter, ScaleFilter, FOAR
+from ffmpeg.filtergraph import FilterGraph, FilterNode
 from ffmpeg.utils import StreamSpecifier
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class CacheTestCase(TestCase):
+    """Keeps the capability, keyframe and output caches of the tests out of the user's cache directory"""
+
+    def setUp(self):
+        cache = tempfile.TemporaryDirectory()
+        self.addCleanup(cache.cleanup)
+        settings.configure(FFMPEG_CACHE_DIR=cache.name)
+        self.addCleanup(settings.reset)
+
 
 class FFmpegTestCase(TestCase):
     def test_codec(self):
@@ -59,3 +99,902 @@ class FFmpegTestCase(TestCase):
         cmd.add_filter(BitstreamChannelFilter(stream=StreamSpecifier.Audio, filters=[FFmpegFilter.aac_adtstoasc]))
         self.assertEqual(cmd.generate(),
                          '/usr/bin/ffmpeg -i "input.mp4" -t 00:10:00 -c:v copy -bsf:a aac_adtstoasc "output.mp4"')
+
+    def test_command_as_list(self):
+        cmd = Command(input='my "input".mp4', output="output file.mp4")
+        cmd.add_codec(Codec(copy=True, stream=StreamSpecifier.Video))
+        self.assertEqual(cmd.generate(as_str=False),
+                         ['/usr/bin/ffmpeg', '-i', 'my "input".mp4', '-c:v', 'copy', 'output file.mp4'])
+
+CODECS_OUTPUT = """Codecs:
+ D..... = Decoding supported
+ .E.... = Encoding supported
+ -------
+ DEV.LS h264                 H.264 / AVC (decoders: h264 h264_cuvid) (encoders: libx264 libx264rgb)
+ DEAIL. aac                  AAC (Advanced Audio Coding) (decoders: aac aac_fixed)
+ DEVI.S ffv1                 FFmpeg video codec #1
+ ..S... srt                  SubRip subtitle with embedded timing
+"""
+
+FORMATS_OUTPUT = """Formats:
+ D.. = Demuxing supported
+ .E. = Muxing supported
+ ---
+ D   matroska,webm   Matroska / WebM
+  E  mp4             MP4 (MPEG-4 Part 14)
+"""
+
+
+class CapabilityRegistryTestCase(CacheTestCase):
+    def test_capability_table(self):
+        table = CapabilityTable(_parse_codecs(CODECS_OUTPUT), _parse_formats(FORMATS_OUTPUT), ["aac_adtstoasc"])
+        self.assertTrue(table.can_encode("libx264"))
+        self.assertTrue(table.can_encode("h264"))
+        self.assertFalse(table.can_encode("h264_cuvid"))
+        self.assertTrue(table.can_decode("aac_fixed"))
+        self.assertTrue(table.can_encode("aac"))
+        self.assertTrue(table.is_lossless("ffv1"))
+        self.assertFalse(table.is_lossless("aac_fixed"))
+        self.assertEqual(list(table.video), ["h264", "ffv1"])
+        self.assertEqual(list(table.subtitle), ["srt"])
+        self.assertEqual(table.codecs["h264"]['display'], "H.264 / AVC")
+        self.assertTrue(table.can_demux("webm"))
+        self.assertFalse(table.can_mux("webm"))
+        self.assertTrue(table.can_mux("mp4"))
+        self.assertTrue(table.has_bitstream_filter("aac_adtstoasc"))
+
+    def test_lazy_and_cached_on_disk(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            registry = CapabilityRegistry(path=FFMPEG_PATH, cache_dir=cache_dir)
+            self.assertIsNone(registry._data)
+            self.assertTrue(any(c['name'] == 'h264' for c in registry.codecs))
+            self.assertTrue(registry.version)
+
+            # A fresh registry must be served from the disk cache without starting ffmpeg
+            warm = CapabilityRegistry(path=FFMPEG_PATH, cache_dir=cache_dir)
+            with mock.patch.object(CapabilityRegistry, '_run', side_effect=AssertionError("ffmpeg started")):
+                self.assertEqual(warm.codecs, registry.codecs)
+                self.assertEqual(warm.formats, registry.formats)
+                self.assertEqual(warm.bitstream_filters, registry.bitstream_filters)
+
+
+class MultiOutputCommandTestCase(CacheTestCase):
+    def test_generate(self):
+        cmd = MultiOutputCommand(input="input.mp4", overwrite=True)
+        for height, bitrate in ((720, "3M"), (360, "800k")):
+            output = Output(output="%dp.mp4" % height, video_bitrate=bitrate, audio_bitrate="128k")
+            output.add_codec(Codec(codec="h264", stream=StreamSpecifier.Video))
+            output.add_filter(ScaleFilter(width=-2, height=height))
+            cmd.add_output(output)
+        cmd.add_output(Output(output="audio.m4a", vn=True).add_codec(Codec(copy=True, stream=StreamSpecifier.Audio)))
+        self.assertEqual(cmd.generate(),
+                         '/usr/bin/ffmpeg -i "input.mp4" '
+                         '-filter_complex "[0:v]split=2[s0][s1];[s0]scale=-2:720[v0];[s1]scale=-2:360[v1]" '
+                         '-y -map [v0] -map 0:a? -c:v h264 -b:v 3M -b:a 128k "720p.mp4" '
+                         '-y -map [v1] -map 0:a? -c:v h264 -b:v 800k -b:a 128k "360p.mp4" '
+                         '-y -vn -map 0:a? -c:a copy "audio.m4a"')
+        with self.assertRaises(ValueError):
+            Output(output="x.mp4", video_bitrate="fast").validate()
+
+    def test_command_filters(self):
+        output = Output(output="720p.mp4").add_filter(ScaleFilter(width=-2, height=720))
+        cmd = MultiOutputCommand(input="input.mp4").add_output(output)
+        with self.assertRaises(ValueError):
+            cmd.add_filter(FilterNode("fps", 30))
+        with self.assertRaises(ValueError):
+            cmd.set_filter_complex(FilterGraph())
+        cmd.filters.append(ScaleFilter(width=1280, height=720))
+        with self.assertRaises(ValueError):
+            cmd.generate()
+        # Bitstream filters are output options and apply to every output
+        cmd = MultiOutputCommand(input="input.mp4").add_output(Output(output="a.ts")).add_output(Output(output="b.ts"))
+        cmd.add_filter(BitstreamChannelFilter(stream=StreamSpecifier.Video, filters=[FFmpegFilter.h264_mp4toannexb]))
+        self.assertEqual(cmd.generate().count("-bsf:v h264_mp4toannexb"), 2)
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=160x120:rate=10:duration=1", source])
+            cmd = MultiOutputCommand(input=source, overwrite=True)
+            for height in (120, 60):
+                output = Output(output=os.path.join(tmp, "%dp.mp4" % height))
+                cmd.add_output(output.add_filter(ScaleFilter(width=-2, height=height)))
+            cmd.add_output(Output(output=os.path.join(tmp, "copy.mkv")).add_codec(Codec(copy=True)))
+            self.assertEqual(cmd.run().returncode, 0)
+            self.assertEqual(asyncio.run(cmd.clone().run_async()).returncode, 0)
+            for name, height in (("120p.mp4", 120), ("60p.mp4", 60), ("copy.mkv", 120)):
+                self.assertEqual(get_file_attributes(os.path.join(tmp, name))['streams'][0]['height'], height)
+
+
+class EncodersTestCase(CacheTestCase):
+    def test_select(self):
+        output = CODECS_OUTPUT.replace("(encoders: libx264 libx264rgb)", "(encoders: libopenh264 h264_nvenc)")
+        table = CapabilityTable(_parse_codecs(output), [], [])
+        self.assertEqual(select_encoder("h264", table=table), "libopenh264")
+        self.assertEqual(select_encoder("h264", hardware=True, table=table), "h264_nvenc")
+        self.assertEqual(select_encoder("aac", table=table), "aac")
+        with self.assertRaises(ValueError):
+            select_encoder("ffv1", table=CapabilityTable(_parse_codecs(output.replace("DEVI.S", "D.VI.S")), [], []))
+
+    def test_plan(self):
+        table = CapabilityTable(_parse_codecs(CODECS_OUTPUT), [], [])
+        plan = plan_encoder("h264", jobs=16, cores=16, table=table)
+        self.assertEqual((plan.encoder, plan.preset, plan.threads, plan.filter_threads), ("libx264", "veryfast", 1, 1))
+        self.assertEqual(plan_encoder("aac", "a", jobs=3, cores=16, table=table).threads, 5)
+
+        cmd = plan.apply(Command(input="input.mp4", output="output.mp4"))
+        self.assertEqual(cmd.generate(), '/usr/bin/ffmpeg -filter_threads 1 -i "input.mp4" '
+                                         '-c:v libx264 -preset:v veryfast -threads:v 1 "output.mp4"')
+        self.assertEqual(scheduler.estimate_threads(cmd.generate(as_str=False)), 1)
+
+
+class RemuxTestCase(CacheTestCase):
+    ATTRIBUTES = {
+        'format': {'bit_rate': "3000000"},
+        'streams': [
+            {'codec_type': "video", 'codec_name': "mjpeg", 'disposition': {'attached_pic': 1}},
+            {'codec_type': "video", 'codec_name': "h264", 'width': 1280, 'height': 720, 'pix_fmt': "yuv420p",
+             'bit_rate': "2500000"},
+            {'codec_type': "audio", 'codec_name': "aac", 'sample_rate': "48000", 'channels': 2, 'bit_rate': "160000"},
+        ],
+    }
+
+    def command(self, *filters, **kwargs):
+        cmd = Command(input="input.mp4", output="output.mp4", **kwargs)
+        cmd.add_codec(Codec(codec="libx264", stream=StreamSpecifier.Video))
+        cmd.add_codec(Codec(codec="aac", stream=StreamSpecifier.Audio))
+        for flt in filters:
+            cmd.add_filter(flt)
+        return cmd
+
+    def plan(self, cmd, **kwargs):
+        table = CapabilityTable(_parse_codecs(CODECS_OUTPUT), [], [])
+        return plan_copy(cmd, self.ATTRIBUTES, table=table, **kwargs)
+
+    def test_remux(self):
+        cmd = self.command(ScaleFilter(width=1280, height=-2))
+        cmd.add_filter(FilterNode("setpts", "PTS"))
+        plan = self.plan(cmd, pix_fmt="yuv420p", max_video_bitrate="5M", max_audio_bitrate="192k", channels=2)
+        self.assertTrue(plan.remux)
+        self.assertEqual(plan.command.generate(), '/usr/bin/ffmpeg -i "input.mp4" -c:v copy -c:a copy "output.mp4"')
+        self.assertIn("-filter:v", cmd.generate())
+
+    def test_encode(self):
+        plan = self.plan(self.command(ScaleFilter(width=640, height=-2)), max_audio_bitrate="128k")
+        self.assertEqual(plan.copied, [])
+        self.assertEqual(plan.reasons, {'v': "scale=640:-2 changes the frames", 'a': "bitrate 160000 is over 128000"})
+
+        self.assertEqual(self.plan(self.command(), pix_fmt="yuv420p10le").reasons,
+                         {'v': "pixel format yuv420p is not yuv420p10le"})
+        self.assertEqual(self.plan(self.command(), max_video_bitrate="2M").copied, ["a"])
+        self.assertEqual(self.plan(self.command(ss_position="00:00:10")).copied, ["a"])
+        self.assertEqual(self.plan(self.command(), sample_rate=44100).reasons, {'a': "sample rate 48000 is not 44100"})
+
+
+class OutputCacheTestCase(CacheTestCase):
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=160x120:rate=10:duration=2", source])
+            copy = os.path.join(tmp, "copy.mp4")
+            with open(source, "rb") as src, open(copy, "wb") as dst:
+                dst.write(src.read())
+            self.assertEqual(fingerprint(source, blocks=4, block_size=512), fingerprint(copy, blocks=4, block_size=512))
+
+            cache = OutputCache(os.path.join(tmp, "cache"), max_size=10 ** 9)
+            first = core.Command(source, os.path.join(tmp, "a.mkv"), overwrite=True, codecs=[core.Codec(copy=True)])
+            cache.run(first)
+            # Same arguments on a copy of the input, under another output name
+            second = core.Command(copy, os.path.join(tmp, "b.mkv"), overwrite=True, codecs=[core.Codec(copy=True)])
+            with mock.patch.object(runner, "run") as run:
+                result = cache.run(second)
+            run.assert_not_called()
+            self.assertEqual((cache.hits, cache.misses, result.returncode), (1, 1, 0))
+            self.assertEqual(os.stat(second.output).st_nlink, 3)
+            with self.assertRaises(FileExistsError):
+                cache.get(core.Command(copy, second.output, codecs=[core.Codec(copy=True)]))
+
+            # Another extension is another muxer
+            cache.run(core.Command(source, os.path.join(tmp, "c.mp4"), overwrite=True, codecs=[core.Codec(copy=True)]))
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+            self.assertEqual(len(os.listdir(cache.directory)), 2)
+            cache.evict(cache.size() - 1)
+            self.assertEqual(len(os.listdir(cache.directory)), 1)
+            self.assertIsNone(cache.get(first))
+            cache.clear()
+            self.assertEqual(cache.size(), 0)
+
+
+class FilterGraphTestCase(TestCase):
+    def test_serialize(self):
+        graph = FilterGraph()
+        graph.chain(FilterNode("split"), inputs=["0:v"], outputs=["a", "b"])
+        graph.chain(FilterNode("drawtext", text="a: b, c", fontsize=12), inputs=["a"], outputs=["out"])
+        self.assertEqual(graph.generate(as_str=False),
+                         ["-filter_complex", "[0:v]split[a][b];[a]drawtext=text=a\\\\: b\\, c:fontsize=12[out]"])
+        self.assertEqual(FilterNode.parse("scale=1280:h=720:flags=lanczos").option(1, "h", "height"), "720")
+
+    def test_optimize(self):
+        graph = FilterGraph()
+        chain = graph.chain(FilterNode.parse("scale=1920:1080"), FilterNode("null"), FilterNode.parse("scale=1280:720"),
+                            FilterNode.parse("crop=640:360:320:180"), FilterNode("fps", 10), inputs=["0:v"])
+        graph.optimize()
+        self.assertEqual(str(chain),
+                         "[0:v]fps=10,crop=iw*640/1280:ih*360/720:iw*320/1280:ih*180/720,scale=640:360")
+
+        # Sizes that depend on the input are kept
+        chain = FilterGraph().chain(FilterNode.parse("scale=iw/2:ih/2"), FilterNode.parse("scale=-2:720"),
+                                    FilterNode.parse("crop=iw:ih:0:0"))
+        FilterGraph(chain).optimize()
+        self.assertEqual(str(chain), "scale=iw/2:ih/2,scale=-2:720")
+
+        chain = FilterGraph().chain(FilterNode.parse("scale=iw:ih"), inputs=["in"], outputs=["out"])
+        FilterGraph(chain).optimize()
+        self.assertEqual(str(chain), "[in]null[out]")
+
+        # A scale that converts the colour range does more than resize
+        chain = FilterGraph().chain(FilterNode.parse("scale=out_range=full"), FilterNode.parse("scale=1280:720"))
+        FilterGraph(chain).optimize()
+        self.assertEqual(str(chain), "scale=out_range=full,scale=1280:720")
+
+        # 0 keeps the input dimension, the earlier scale decides it
+        chain = FilterGraph().chain(FilterNode.parse("scale=640:360"), FilterNode.parse("scale=0:720"),
+                                    FilterNode.parse("crop=320:360:0:0"))
+        FilterGraph(chain).optimize()
+        self.assertEqual(str(chain), "scale=640:360,scale=0:720,crop=320:360:0:0")
+
+        # Timestamps drawn by drawtext are those before setpts
+        chain = FilterGraph().chain(FilterNode("drawtext", text="%{pts}"), FilterNode("setpts", "2*PTS"))
+        FilterGraph(chain).optimize()
+        self.assertEqual(str(chain), "drawtext=text=%{pts},setpts=2*PTS")
+
+    def test_command_filter_chain(self):
+        cmd = Command(input="input.mp4", output="output.mp4")
+        cmd.add_filter(ScaleFilter(width=1920, height=1080))
+        cmd.add_filter(FilterNode("fps", 30))
+        cmd.add_filter(ScaleFilter(uiw=True, uih=True))
+        self.assertEqual(cmd.generate(), '/usr/bin/ffmpeg -i "input.mp4" -filter:v fps=30,scale=1920:1080 "output.mp4"')
+
+        graph = FilterGraph()
+        graph.chain(FilterNode("crop", "iw/2", "ih"), inputs=["0:v"])
+        cmd = Command(input="input.mp4", output="output.mp4").set_filter_complex(graph)
+        self.assertEqual(cmd.generate(as_str=False),
+                         ['/usr/bin/ffmpeg', '-i', 'input.mp4', '-filter_complex', '[0:v]crop=iw/2:ih', 'output.mp4'])
+
+
+def python(code):
+    return [sys.executable, "-c", code]
+
+
+class CoreTestCase(CacheTestCase):
+    def test_command(self):
+        cmd = core.Command("input.mp4", "output.mp4", overwrite=True, duration="00:10:00", ss_position="00:00:01.5",
+                           loglevel="error", codecs=[core.Codec(copy=True, stream="v"), core.Codec("aac", "a")],
+                           filters=[core.ScaleFilter(width=1280, height=720),
+                                    core.BitstreamChannelFilter("a", [FFmpegFilter.aac_adtstoasc])])
+        form = Command(input="input.mp4", output="output.mp4", overwrite=True, duration="00:10:00",
+                       ss_position="00:00:01.5", loglevel="error")
+        form.add_codec(Codec(copy=True, stream=StreamSpecifier.Video))
+        form.add_codec(Codec(codec="aac", stream=StreamSpecifier.Audio))
+        form.add_filter(ScaleFilter(width=1280, height=720))
+        form.add_filter(BitstreamChannelFilter(stream=StreamSpecifier.Audio, filters=[FFmpegFilter.aac_adtstoasc]))
+        self.assertEqual(cmd.generate(as_str=False), form.generate(as_str=False))
+        self.assertEqual(cmd.generate(), '/usr/bin/ffmpeg -loglevel error -i "input.mp4" -y -t 00:10:00 '
+                                         '-ss 00:00:01.500000 -c:v copy -c:a aac -bsf:a aac_adtstoasc '
+                                         '-filter:v scale=1280:720 "output.mp4"')
+
+    def test_validation(self):
+        with self.assertRaises(ValueError):
+            core.Command("input.mp4", "output.mp4", duration="10 minutes")
+        with self.assertRaises(ValueError):
+            core.Command("input.mp4", "output.mp4", loglevel="loud")
+        with self.assertRaises(ValueError):
+            core.Codec()
+        with self.assertRaises(ValueError):
+            core.Codec("no-such-codec")
+        with self.assertRaises(ValueError):
+            core.ScaleFilter(width=1280)
+        with self.assertRaises(ValueError):
+            core.ScaleFilter(uiw=True, uih=True, scale_width=11)
+
+
+class TemplatesTestCase(CacheTestCase):
+    def test_render(self):
+        options = dict(overwrite=True, duration="00:00:30", codecs=[core.Codec("aac", "a")],
+                       filters=[core.ScaleFilter(width=640, height=360)])
+        template = templates.get(**options)
+        self.assertIs(templates.get(**dict(options, codecs=[core.Codec("aac", "a")])), template)
+        self.assertEqual(template.render("a b.mp4", "out.mp4"),
+                         core.Command("a b.mp4", "out.mp4", **options).generate(as_str=False))
+        self.assertEqual(templates.render("in.mp4", "out.mp4", **options),
+                         core.Command("in.mp4", "out.mp4", **options).generate(as_str=False))
+        self.assertEqual(template.render("a b.mp4", "out.mp4", as_str=True),
+                         core.Command("a b.mp4", "out.mp4", **options).generate())
+
+        form = Command(input="in.mp4", output="out.mp4", overwrite=False)
+        form.add_codec(Codec(copy=True, stream=StreamSpecifier.Video))
+        self.assertEqual(templates.CommandTemplate(form).render("x.mp4", "y.mp4"),
+                         ["/usr/bin/ffmpeg", "-i", "x.mp4", "-n", "-c:v", "copy", "y.mp4"])
+        with self.assertRaises(ValueError):
+            templates.CommandTemplate(form.use_keyframe_index(KeyframeIndex([0.0, 2.0])))
+
+    def test_cache_size(self):
+        cache = templates.TemplateCache(max_entries=2)
+        first = cache.get(file_size_limit=1)
+        cache.get(file_size_limit=2)
+        cache.get(file_size_limit=1)
+        cache.get(file_size_limit=3)
+        self.assertEqual(len(cache), 2)
+        self.assertIs(cache.get(file_size_limit=1), first)
+
+
+class SettingsTestCase(TestCase):
+    def tearDown(self):
+        settings.reset()
+
+    def test_resolution_order(self):
+        with mock.patch.dict(os.environ, {"FFMPEG_PATH": "/opt/ffmpeg/bin/ffmpeg", "FFPROBE_CACHE_SIZE": "5"}):
+            settings.reset()
+            self.assertEqual(settings.get("FFMPEG_PATH"), "/opt/ffmpeg/bin/ffmpeg")
+            self.assertEqual(settings.get("FFPROBE_CACHE_SIZE"), 5)
+            self.assertEqual(core.Command("in.mp4", "out.mp4").generate(as_str=False)[0], "/opt/ffmpeg/bin/ffmpeg")
+            settings.configure(FFMPEG_PATH="/usr/local/bin/ffmpeg")
+            self.assertEqual(settings.get("FFMPEG_PATH"), "/usr/local/bin/ffmpeg")
+        settings.reset()
+        with self.settings(FFPROBE_CACHE_MAX_AGE=60):
+            self.assertEqual(settings.get("FFPROBE_CACHE_MAX_AGE"), 60)
+        with self.assertRaises(KeyError):
+            settings.configure(FFMPEG_PTH="/usr/bin/ffmpeg")
+
+    def test_import_without_django(self):
+        code = ("import sys, time\n"
+                "start = time.perf_counter()\n"
+                "import ffmpeg.core, ffmpeg.ffprobe, ffmpeg.runner, ffmpeg.scheduler, ffmpeg.segments\n"
+                "elapsed = time.perf_counter() - start\n"
+                "ffmpeg.core.Command('in.mp4', 'out.mp4').generate()\n"
+                "print('django' in sys.modules, elapsed)")
+        env = dict(os.environ, FFMPEG_PATH="/nonexistent/ffmpeg", FFPROBE_PATH="/nonexistent/ffprobe")
+        env.pop("DJANGO_SETTINGS_MODULE", None)
+        output = subprocess.check_output(python(code), env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        django_imported, elapsed = output.split()
+        self.assertEqual(django_imported, b"False")
+        self.assertLess(float(elapsed), 0.5)
+
+    def test_django_not_configured(self):
+        code = "import django, ffmpeg.settings; print(ffmpeg.settings.get('FFMPEG_CAPABILITIES_TIMEOUT'))"
+        for module in ("missing_settings_module", ""):
+            env = dict(os.environ, DJANGO_SETTINGS_MODULE=module)
+            env.pop("FFMPEG_CAPABILITIES_TIMEOUT", None)
+            output = subprocess.check_output(python(code), env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+            self.assertEqual(output.strip(), b"10")
+
+
+class RunnerTestCase(TestCase):
+    def test_run(self):
+        lines = []
+        result = runner.run(python("import sys; sys.stderr.write('frame=1\\rframe=2\\nend'); print('out')"),
+                            on_stderr=lines.append, capture_stdout=True)
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout, b"out\n")
+        self.assertEqual(lines, ["frame=1", "frame=2", "end"])
+
+    def test_run_errors(self):
+        with self.assertRaises(runner.CommandError) as ctx:
+            runner.run(python("import sys; sys.stderr.write('boom'); sys.exit(3)"))
+        self.assertEqual(ctx.exception.returncode, 3)
+        self.assertEqual(ctx.exception.stderr, "boom")
+        self.assertEqual(runner.run(python("import sys; sys.exit(3)"), check=False).returncode, 3)
+
+        with self.assertRaises(runner.CommandTimeout):
+            runner.run(python("import time; time.sleep(10)"), timeout=0.2)
+
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+        with self.assertRaises(runner.CommandCancelled):
+            runner.run(python("import time; time.sleep(10)"), cancel=cancel)
+
+    def test_error_classes(self):
+        # Half a million lines and one over-long line, only the cause and the end are kept
+        script = ("import sys; w = sys.stderr.write; w('Error opening input files: Invalid data found\\n');"
+                  "[w('debug %d\\n' % i) for i in range(500000)]; w('x' * 100000 + '\\nlast'); sys.exit(1)")
+        with self.assertRaises(runner.InvalidInput) as ctx:
+            runner.run(python(script))
+        lines = ctx.exception.stderr.split("\n")
+        self.assertEqual(len(lines), runner.STDERR_LINES + 2)
+        self.assertEqual(lines[:2], ["Error opening input files: Invalid data found", "..."])
+        self.assertEqual((len(lines[-2]), lines[-1]), (runner.STDERR_LINE_LENGTH, "last"))
+        self.assertFalse(ctx.exception.retryable)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "out.mp4")
+            with self.assertRaises(runner.UnsupportedCodec) as ctx:
+                runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc", "-c:v", "nosuchencoder", output])
+            self.assertIn("Error opening output files: Encoder not found", ctx.exception.errors)
+            with self.assertRaises(runner.InvalidInput):
+                runner.run([FFMPEG_PATH, "-i", os.path.join(tmp, "missing.mp4"), output])
+        self.assertIs(runner.classify_error(-9, []), runner.CommandKilled)
+        self.assertIs(runner.classify_error(1, ["av_interleaved_write_frame(): No space left on device"]),
+                      runner.DiskFull)
+
+    def test_usage(self):
+        script = "data = bytearray(64 * 1024 * 1024); open(%r, 'wb').write(bytes(1024 * 1024)); sum(range(10 ** 6))"
+        with tempfile.TemporaryDirectory() as tmp:
+            reported = []
+            result = runner.run(python(script % os.path.join(tmp, "out")),
+                                on_usage=lambda args, usage: reported.append(usage))
+            self.assertEqual(reported, [result.usage])
+            usage = result.usage
+            self.assertFalse(usage.sampled)
+            self.assertGreater(usage.max_rss, 64 * 1024 * 1024)
+            self.assertGreater(usage.cpu_time, 0)
+            self.assertGreaterEqual(usage.write_chars, 1024 * 1024)
+            self.assertLessEqual(usage.wall_time, result.duration)
+
+            with self.assertRaises(runner.CommandError) as ctx:
+                runner.run(python("import sys; sys.exit(3)"))
+            self.assertIsNotNone(ctx.exception.usage)
+
+            # Samples are taken every USAGE_SAMPLE_INTERVAL, the process outlives the first
+            script += "; import time; time.sleep(%s)" % (runner.USAGE_SAMPLE_INTERVAL * 1.5)
+            result = asyncio.run(runner.run_async(python(script % os.path.join(tmp, "out"))))
+            self.assertTrue(result.usage.sampled)
+            self.assertGreaterEqual(result.usage.write_chars, 1024 * 1024)
+
+        # A process reaped before its first sample has no usage rather than zeros
+        with mock.patch.object(runner, "_sample_proc", side_effect=OSError):
+            result = asyncio.run(runner.run_async(python("pass")))
+        self.assertIsNone(result.usage)
+
+    def test_run_async(self):
+        async def main():
+            results = await asyncio.gather(*[runner.run_async(python("print(%d)" % i), capture_stdout=True)
+                                             for i in range(5)])
+            self.assertEqual([r.stdout for r in results], [b"%d\n" % i for i in range(5)])
+
+            with self.assertRaises(runner.CommandTimeout):
+                await runner.run_async(python("import time; time.sleep(10)"), timeout=0.2)
+
+            task = asyncio.ensure_future(runner.run_async(python("import time; time.sleep(10)")))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        asyncio.run(main())
+
+    def test_streams(self):
+        copy = python("import sys, shutil; shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)")
+        data = os.urandom(1024 * 1024)
+        sink = io.BytesIO()
+        runner.run(copy, stdin=io.BytesIO(data), stdout=sink, buffer_size=4096)
+        self.assertEqual(sink.getvalue(), data)
+        self.assertEqual(runner.run(copy, stdin=[b"a", b"b"], capture_stdout=True).stdout, b"ab")
+        # A process that stops reading early does not fail the run
+        runner.run(python("import sys; sys.stdin.buffer.read(10)"), stdin=io.BytesIO(data))
+
+        async def chunks():
+            for i in range(0, len(data), 65536):
+                yield data[i:i + 65536]
+
+        class AsyncSink:
+            def __init__(self):
+                self.data = []
+
+            async def write(self, chunk):
+                self.data.append(chunk)
+
+        async def main():
+            sink = AsyncSink()
+            await runner.run_async(copy, stdin=chunks(), stdout=sink, buffer_size=8192)
+            self.assertEqual(b"".join(sink.data), data)
+            result = await runner.run_async(copy, stdin=io.BytesIO(b"file"), capture_stdout=True)
+            self.assertEqual(result.stdout, b"file")
+
+        asyncio.run(main())
+
+    def test_failing_sink(self):
+        class FailingSink:
+            def write(self, chunk):
+                raise OSError("disk full")
+
+        # More than the pipe buffer, the process would block on stdout if the failure went unnoticed
+        output = python("import sys; sys.stdout.buffer.write(b'x' * 4 * 1024 * 1024)")
+        started = time.monotonic()
+        with self.assertRaisesRegex(OSError, "disk full"):
+            runner.run(output, stdout=FailingSink(), timeout=20)
+        with self.assertRaisesRegex(OSError, "disk full"):
+            asyncio.run(runner.run_async(output, stdout=FailingSink(), timeout=20))
+        self.assertLess(time.monotonic() - started, 10)
+
+
+class SchedulerTestCase(TestCase):
+    def test_estimate_threads(self):
+        self.assertEqual(scheduler.estimate_threads(["ffmpeg", "-i", "a", "-c", "copy", "b"]), 1)
+        self.assertEqual(scheduler.estimate_threads(["ffmpeg", "-i", "a", "-c:v", "libx264", "-threads", "2", "b"]), 2)
+        self.assertEqual(scheduler.estimate_threads(["ffmpeg", "-i", "a", "b"]), scheduler.DEFAULT_JOB_THREADS)
+
+    def test_priority_and_fairness(self):
+        s = scheduler.Scheduler(concurrency=1)
+        a = [s.submit(["a%d" % i], tenant="a") for i in range(3)]
+        b = [s.submit(["b%d" % i], tenant="b") for i in range(2)]
+        urgent = s.submit(["urgent"], tenant="a", priority=10)
+        order = [s._next() for _ in range(6)]
+        self.assertEqual(order, [urgent, b[0], a[0], b[1], a[1], a[2]])
+        self.assertIsNone(s._next())
+        # Tenants without queued jobs are forgotten
+        self.assertEqual((s._queues, s._served), ({}, {}))
+        self.assertEqual(scheduler.Scheduler(cpu_budget=16).concurrency, 16 // scheduler.DEFAULT_JOB_THREADS)
+
+    def test_backpressure(self):
+        s = scheduler.Scheduler(max_pending=1)
+        s.submit(["a"])
+        with self.assertRaises(queue.Full):
+            s.submit(["b"], block=False)
+
+    def test_run_with_retries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            flag = os.path.join(tmp, "flag")
+            flaky = python("import os, sys; os.path.exists(%r) or (open(%r, 'w').close(), sys.exit(1))" % (flag, flag))
+            with scheduler.Scheduler(concurrency=2, retries=1, retry_delay=0) as s:
+                jobs = [s.submit(python("pass")) for _ in range(4)] + [s.submit(flaky)]
+                failing = s.submit(python("import sys; sys.exit(2)"), retries=0)
+            self.assertTrue(all(job.wait().returncode == 0 for job in jobs))
+            self.assertEqual(jobs[-1].attempts, 2)
+            with self.assertRaises(runner.CommandError):
+                failing.wait()
+
+
+PROGRESS_OUTPUT = """frame=25
+fps=0.00
+bitrate=  64.5kbits/s
+total_size=8192
+out_time_us=1000000
+out_time=00:00:01.000000
+speed=2.00x
+progress=continue
+frame=50
+fps=50.00
+bitrate=N/A
+total_size=16384
+out_time_us=2000000
+speed=N/A
+progress=end
+"""
+
+
+class ProgressTestCase(TestCase):
+    def test_parser(self):
+        events = []
+        parser = ProgressParser(duration=10, on_progress=events.append)
+        for line in PROGRESS_OUTPUT.splitlines():
+            parser.feed(line)
+        self.assertEqual(len(events), 2)
+        first, last = events
+        self.assertEqual((first.frame, first.out_time, first.total_size, first.bitrate, first.speed),
+                         (25, 1.0, 8192, 64.5, 2.0))
+        self.assertEqual(first.eta, 4.5)
+        self.assertEqual(first.percent, 10.0)
+        self.assertEqual((last.fps, last.bitrate, last.speed, last.eta, last.end), (50.0, None, None, 0.0, True))
+
+    def test_run_with_progress(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=64x48:rate=10:duration=3", source])
+            events = []
+            cmd = Command(input=source, output=os.path.join(tmp, "output.mp4"))
+            cmd.run(on_progress=events.append)
+            self.assertTrue(events[-1].end)
+            self.assertEqual(events[-1].frame, 30)
+            self.assertEqual(events[-1].duration, 3.0)
+
+            events = []
+            asyncio.run(runner.run_async([FFMPEG_PATH, "-y", "-i", source, os.path.join(tmp, "output.mp4")],
+                                         on_progress=events.append, stall_timeout=30))
+            self.assertTrue(events[-1].end)
+
+
+class ProbeCacheTestCase(TestCase):
+    def test_memory_cache(self):
+        cache = MemoryProbeCache(max_entries=2, max_age=60)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), ("1", None, "3"))
+        with mock.patch("time.time", return_value=time.time() + 61):
+            self.assertIsNone(cache.get("a"))
+
+    def test_sqlite_backend(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            backend = SQLiteProbeCache(os.path.join(tmp, "probes.sqlite"), max_entries=2)
+            MemoryProbeCache(backend=backend).set("a", "1")
+            backend.set("b", "2")
+            backend.get("a")
+            backend.set("c", "3")
+            self.assertEqual((backend.get("a"), backend.get("b"), backend.get("c")), ("1", None, "3"))
+            self.assertEqual(MemoryProbeCache(backend=backend).get("a"), "1")
+
+    def test_get_file_attributes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=64x48:rate=10:duration=1", source])
+            cache = MemoryProbeCache()
+            attributes = get_file_attributes(source, cache=cache)
+            self.assertEqual(attributes['streams'][0]['width'], 64)
+            with mock.patch("subprocess.run", side_effect=AssertionError("ffprobe started")):
+                self.assertEqual(get_file_attributes(source, cache=cache), attributes)
+
+            # Rewriting the file changes its key
+            key = probe_key(source)
+            runner.run([FFMPEG_PATH, "-y", "-f", "lavfi", "-i", "testsrc=size=32x24:rate=10:duration=1", source])
+            self.assertNotEqual(probe_key(source), key)
+            self.assertEqual(get_file_attributes(source, cache=cache)['streams'][0]['width'], 32)
+
+            # Another ffprobe may report the file differently
+            other = os.path.join(tmp, "ffprobe")
+            with open(other, "wb"):
+                pass
+            self.assertNotEqual(probe_key(source, ffprobe=other), probe_key(source))
+            settings.configure(FFPROBE_PATH=other)
+            self.addCleanup(settings.reset)
+            self.assertEqual(probe_key(source), probe_key(source, ffprobe=other))
+
+    def test_probe_many(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i in range(3):
+                paths.append(os.path.join(tmp, "source%d.mp4" % i))
+                runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=64x48:rate=10:duration=1", paths[-1]])
+            broken = os.path.join(tmp, "broken.mp4")
+            with open(broken, "wb") as f:
+                f.write(b"not a video")
+            missing = os.path.join(tmp, "missing.mp4")
+
+            results = {r.path: r for r in probe_many(paths + [broken, missing], max_workers=2, cache=False)}
+            self.assertEqual(len(results), 5)
+            self.assertTrue(all(results[path].attributes['streams'] for path in paths))
+            self.assertIsInstance(results[missing].error, FileNotFoundError)
+            self.assertFalse(results[broken].ok)
+
+    def test_probe(self):
+        self.assertEqual(probe_args("in.mp4", stream_fields=("width", "height"), select_streams="v:0",
+                                    read_intervals="%+#1")[1:],
+                         ["-v", "error", "-print_format", "json",
+                          "-show_entries", "format=duration:stream=width,height",
+                          "-select_streams", "v:0", "-read_intervals", "%+#1", "-i", "in.mp4"])
+        with self.assertRaises(ValueError):
+            probe_args("in.mp4", stream_fields=("nope",))
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=64x48:rate=10:duration=3", "-g", "10",
+                        source])
+            info = probe(source, stream_fields=("codec_name", "width", "height", "r_frame_rate"),
+                         select_streams="v:0", keyframes=True, cache=False)
+            self.assertEqual(info.duration, 3.0)
+            self.assertEqual((info.stream.width, info.stream.height, info.stream.r_frame_rate), (64, 48, 10.0))
+            self.assertEqual(info.keyframes, [0.0, 1.0, 2.0])
+            self.assertIsNone(info.size)
+            with self.assertRaises(AttributeError):
+                info.extra = 1
+
+    def test_streams(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.nut")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=64x48:rate=10:duration=2", "-c:v", "mpeg4",
+                        source])
+            command = core.Command("pipe:0", "pipe:1", input_format="nut", format="matroska",
+                                   codecs=[core.Codec(copy=True)])
+            sink = io.BytesIO()
+            with open(source, "rb") as f:
+                command.run(stdin=f, stdout=sink, buffer_size=16384)
+        attributes = get_file_attributes(io.BytesIO(sink.getvalue()))
+        self.assertEqual(attributes['format']['format_name'], "matroska,webm")
+        info = probe(io.BytesIO(sink.getvalue()), stream_fields=("codec_name", "width"), select_streams="v:0")
+        self.assertEqual((info.stream.codec_name, info.stream.width), ("mpeg4", 64))
+        with self.assertRaises(ValueError):
+            core.Command("in.mp4", "pipe:1")
+        with self.assertRaises(ValueError):
+            command.run()
+
+
+@skipIf(numpy is None, "NumPy is not installed")
+class FramesTestCase(TestCase):
+    def test_frames(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "color=c=red:size=64x48:rate=10:duration=2", source])
+            command = Command(input=source, output="unused")
+            shapes, previous = [], None
+            for batch in frames(command, batch_size=8):
+                shapes.append(batch.shape)
+                if previous is not None:
+                    self.assertTrue(numpy.shares_memory(batch, previous))
+                previous = batch
+            self.assertEqual(shapes, [(8, 48, 64, 3), (8, 48, 64, 3), (4, 48, 64, 3)])
+            self.assertTrue(numpy.allclose(previous[0, 0, 0], [255, 0, 0], atol=4))
+
+            command = core.Command(source, "unused", ss_position="00:00:01", duration="00:00:00.5")
+            selected = [frame.copy() for frame in frames(command, size=(32, 24))]
+            self.assertEqual(len(selected), 5)
+            self.assertEqual(selected[0].shape, (24, 32, 3))
+            with self.assertRaises(runner.InvalidInput):
+                list(frames(core.Command(os.path.join(tmp, "missing.mp4"), "unused"), size=(32, 24)))
+
+    def test_rotated(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source, rotated = os.path.join(tmp, "source.mp4"), os.path.join(tmp, "rotated.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=64x48:rate=10:duration=1", source])
+            runner.run([FFMPEG_PATH, "-display_rotation", "90", "-i", source, "-c", "copy", rotated])
+            expected = [frame.copy() for frame in frames(Command(input=source, output="unused"))]
+            decoded = [frame.copy() for frame in frames(Command(input=rotated, output="unused"))]
+            self.assertEqual((len(decoded), decoded[0].shape), (len(expected), (48, 64, 3)))
+            self.assertTrue(all(numpy.array_equal(a, b) for a, b in zip(expected, decoded)))
+
+
+class ThumbnailsTestCase(TestCase):
+    def test_args(self):
+        cmd = Command(input="input.mp4", output="thumb-%02d.jpg")
+        self.assertEqual(thumbnails_args(cmd, 4, scale=ScaleFilter(width=160, height=-2), duration=20, seek=False),
+                         ["/usr/bin/ffmpeg", "-ss", "00:00:02.500000", "-i", "input.mp4", "-t", "00:00:17.500000",
+                          "-filter:v", "fps=1/5.0,scale=160:-2", "-map", "0:v:0", "-frames:v", "4", "thumb-%02d.jpg"])
+        args = thumbnails_args(cmd, 2, duration=600, keyframes_only=True)
+        self.assertEqual(args, ["/usr/bin/ffmpeg", "-ss", "00:02:30", "-skip_frame", "nokey", "-i", "input.mp4",
+                                "-ss", "00:07:30", "-skip_frame", "nokey", "-i", "input.mp4",
+                                "-map", "0:v:0", "-frames:v", "1", "thumb-01.jpg",
+                                "-map", "1:v:0", "-frames:v", "1", "thumb-02.jpg"])
+        with self.assertRaises(ValueError):
+            thumbnails_args(Command(input="input.mp4", output="thumb.jpg"), 2, duration=10)
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=320x240:rate=10:duration=6", source])
+            for seek in (False, True):
+                paths = thumbnails(core.Command(source, os.path.join(tmp, "t-%d.jpg"), overwrite=True), 3,
+                                   scale=(64, 48), seek=seek)
+                self.assertEqual([os.path.basename(p) for p in paths], ["t-1.jpg", "t-2.jpg", "t-3.jpg"])
+
+            vtt = os.path.join(tmp, "sprites.vtt")
+            sheet = sprite_sheet(core.Command(source, os.path.join(tmp, "s-%d.jpg"), overwrite=True),
+                                 interval=1, columns=2, rows=2, size=(32, 24), vtt=vtt)
+            self.assertEqual((sheet.count, len(sheet.paths)), (6, 2))
+            self.assertTrue(all(os.path.exists(path) for path in sheet.paths))
+            self.assertEqual(probe(sheet.paths[0], stream_fields=("width", "height")).stream.width, 64)
+            with open(vtt) as f:
+                cues = f.read().split("\n\n")
+            self.assertEqual(cues[0], "WEBVTT")
+            self.assertEqual(cues[4], "00:00:03.000 --> 00:00:04.000\ns-1.jpg#xywh=32,24,32,24")
+            self.assertEqual(cues[5], "00:00:04.000 --> 00:00:05.000\ns-2.jpg#xywh=0,0,32,24")
+
+
+class KeyframeIndexTestCase(CacheTestCase):
+    def test_lookup_and_storage(self):
+        index = KeyframeIndex([0.0, 2.0, 4.0, 6.0])
+        self.assertEqual((index.before(5.5), index.before(4.0), index.before(-1)), (4.0, 4.0, 0.0))
+        self.assertEqual((index.after(4.5), index.after(7)), (6.0, None))
+        with tempfile.TemporaryDirectory() as tmp:
+            index.save(os.path.join(tmp, "index.f64"))
+            loaded = KeyframeIndex.load(os.path.join(tmp, "index.f64"))
+            self.assertIsInstance(loaded.timestamps, memoryview)
+            self.assertEqual(list(loaded), [0.0, 2.0, 4.0, 6.0])
+            self.assertEqual(loaded.before(3), 2.0)
+
+    def test_command_seek(self):
+        index = KeyframeIndex([0.0, 2.0, 4.0, 6.0])
+        cmd = Command(input="input.mp4", output="output.mp4", ss_position="00:00:05.5", to_position="00:00:08")
+        cmd.use_keyframe_index(index)
+        self.assertEqual(cmd.generate(), '/usr/bin/ffmpeg -ss 4 -i "input.mp4" -to 4 -ss 1.5 "output.mp4"')
+
+        cmd = Command(input="input.mp4", output="output.mp4", ss_position="00:00:04")
+        cmd.use_keyframe_index(index)
+        self.assertEqual(cmd.generate(), '/usr/bin/ffmpeg -ss 4 -i "input.mp4" "output.mp4"')
+
+        cmd = Command(input="input.mp4", output="output.mp4", ss_position="00:00:04",
+                      add_ss_position_before_input=True)
+        self.assertEqual(cmd.generate(), '/usr/bin/ffmpeg -ss 00:00:04 -i "input.mp4" "output.mp4"')
+
+    def test_build(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=64x48:rate=10:duration=3", "-g", "10",
+                        source])
+            index = get_keyframe_index(source, cache_dir=tmp)
+            self.assertEqual(list(index), [0.0, 1.0, 2.0])
+            self.assertTrue(os.listdir(os.path.join(tmp, "keyframes")))
+
+            # Room for one index of three keyframes, the older one is removed
+            settings.configure(FFMPEG_KEYFRAME_CACHE_SIZE=24)
+            other = os.path.join(tmp, "other.mp4")
+            shutil.copyfile(source, other)
+            get_keyframe_index(other, cache_dir=tmp)
+            self.assertEqual(len(os.listdir(os.path.join(tmp, "keyframes"))), 1)
+
+    def test_build_errors(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # More errors than a pipe buffer holds, written before the packets
+            ffprobe = os.path.join(tmp, "ffprobe")
+            with open(ffprobe, "w") as f:
+                f.write("#!%s\nimport sys\nsys.stderr.write('Invalid data\\n' * 100000)\n"
+                        "print('0.000000,K_')\nsys.exit(1)\n" % sys.executable)
+            os.chmod(ffprobe, 0o755)
+            settings.configure(FFPROBE_PATH=ffprobe)
+            with self.assertRaises(subprocess.CalledProcessError) as raised:
+                KeyframeIndex.build("input.mp4")
+            self.assertIn("Invalid data", raised.exception.stderr)
+
+
+class SegmentsTestCase(CacheTestCase):
+    def test_plan(self):
+        keyframes = KeyframeIndex([float(t) for t in range(0, 60, 5)])
+        segments = plan_segments(keyframes, 0, 60, 4)
+        self.assertEqual([(s.start, s.end) for s in segments], [(0, 15), (15, 30), (30, 45), (45, 60)])
+        segments = plan_segments(keyframes, 12, 20, 4, min_duration=2)
+        self.assertEqual([(s.start, s.end) for s in segments], [(12, 15), (15, 20)])
+
+        segments[1].path = "segment.mp4"
+        cmd = Command(input="input.mp4", output="output.mp4", overwrite=False)
+        cmd.add_codec(Codec(codec="h264", stream=StreamSpecifier.Video))
+        self.assertEqual(segment_command(cmd, segments[1]).generate(as_str=False),
+                         ["/usr/bin/ffmpeg", "-ss", "00:00:15", "-i", "input.mp4", "-y", "-t", "00:00:05",
+                          "-c:v", "h264", "segment.mp4"])
+
+    def test_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            output = os.path.join(tmp, "output.mp4")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=64x48:rate=10:duration=9", "-g", "20",
+                        source])
+            cmd = Command(input=source, output=output)
+            cmd.add_codec(Codec(codec="mpeg4", stream=StreamSpecifier.Video))
+            transcode = SegmentedTranscode(cmd, segments=3)
+            transcode.run()
+            self.assertEqual(len(transcode.segments), 3)
+            info = probe(output, stream_fields=("codec_name", "nb_frames"), cache=False)
+            self.assertEqual((info.stream.codec_name, info.stream.nb_frames), ("mpeg4", 90))
+
+    def test_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            segments = []
+            for i in range(32):
+                segments.append(Segment(i, i, i + 1, os.path.join(tmp, "segment-%d.mp4" % i)))
+                with open(segments[-1].path, "wb") as f:
+                    f.write(b"x" * i)
+            manifest = Manifest(os.path.join(tmp, "manifest.json"), segments[1].path, ["ffmpeg"])
+            threads = [threading.Thread(target=manifest.record, args=(segment,)) for segment in segments]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            loaded = Manifest(manifest.path, segments[1].path, ["ffmpeg"])
+            self.assertTrue(loaded.load())
+            self.assertTrue(all(loaded.finished(segment) for segment in segments))
+
+            with mock.patch("json.dump", side_effect=OSError("No space left on device")):
+                with self.assertRaises(OSError):
+                    manifest.record(segments[0])
+            self.assertFalse([name for name in os.listdir(tmp) if name.endswith(".tmp")])
+
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "source.mp4")
+            output = os.path.join(tmp, "output.mp4")
+            workdir = os.path.join(tmp, "work")
+            runner.run([FFMPEG_PATH, "-f", "lavfi", "-i", "testsrc=size=64x48:rate=10:duration=9", "-g", "20",
+                        source])
+            cmd = Command(input=source, output=output, overwrite=True)
+            cmd.add_codec(Codec(codec="mpeg4", stream=StreamSpecifier.Video))
+            with self.assertRaises(ValueError):
+                SegmentedTranscode(cmd, segments=3, resume=True)
+            # The process dies after encoding, before the segments are joined
+            with mock.patch.object(SegmentedTranscode, "_join", side_effect=KeyboardInterrupt):
+                with self.assertRaises(KeyboardInterrupt):
+                    SegmentedTranscode(cmd, segments=3, workdir=workdir, resume=True).run()
+            os.unlink(os.path.join(workdir, "segment-00001.mp4"))
+
+            with mock.patch.object(runner, "run", wraps=runner.run) as run:
+                SegmentedTranscode(cmd, segments=3, workdir=workdir, resume=True).run()
+            encoded = [call[0][0][-1] for call in run.call_args_list[:-1]]
+            self.assertEqual([os.path.basename(path) for path in encoded], ["segment-00001.mp4"])
+            self.assertEqual(os.listdir(workdir), [])
+            self.assertEqual(probe(output, stream_fields=("nb_frames",), cache=False).stream.nb_frames, 90)